@@ -0,0 +1,77 @@
+// ginst compile benchmark: standard containers, algorithms and strings
+#include <algorithm>
+#include <iostream>
+#include <map>
+#include <numeric>
+#include <set>
+#include <sstream>
+#include <string>
+#include <unordered_map>
+#include <vector>
+
+namespace {
+
+struct Record {
+    std::string name;
+    std::vector<int> scores;
+    std::map<std::string, double> attributes;
+};
+
+std::vector<std::string> split(const std::string &line, char separator)
+{
+    std::vector<std::string> fields;
+    std::stringstream stream(line);
+    std::string field;
+    while (std::getline(stream, field, separator))
+        fields.push_back(field);
+    return fields;
+}
+
+Record parse(const std::string &line)
+{
+    Record record;
+    std::vector<std::string> fields = split(line, ',');
+    if (fields.empty())
+        return record;
+    record.name = fields[0];
+    for (size_t i = 1; i < fields.size(); ++i) {
+        std::vector<std::string> pair = split(fields[i], '=');
+        if (pair.size() == 2)
+            record.attributes[pair[0]] = std::stod(pair[1]);
+        else
+            record.scores.push_back(std::stoi(fields[i]));
+    }
+    return record;
+}
+
+template <typename Key, typename Value>
+std::vector<std::pair<Key, Value>> sortedByValue(const std::unordered_map<Key, Value> &map)
+{
+    std::vector<std::pair<Key, Value>> items(map.begin(), map.end());
+    std::sort(items.begin(), items.end(), [](const auto &a, const auto &b) { return a.second > b.second; });
+    return items;
+}
+
+} // namespace
+
+int main()
+{
+    std::vector<Record> records;
+    std::string line;
+    while (std::getline(std::cin, line))
+        records.push_back(parse(line));
+
+    std::unordered_map<std::string, long> totals;
+    std::set<std::string> attributeNames;
+    for (const Record &record : records) {
+        totals[record.name] += std::accumulate(record.scores.begin(), record.scores.end(), 0L);
+        for (const auto &attribute : record.attributes)
+            attributeNames.insert(attribute.first);
+    }
+
+    for (const auto &item : sortedByValue(totals))
+        std::cout << item.first << ' ' << item.second << '\n';
+    for (const std::string &name : attributeNames)
+        std::cout << name << '\n';
+    return 0;
+}
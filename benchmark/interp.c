@@ -0,0 +1,150 @@
+/* ginst compile benchmark: a small tokenizer and stack-based bytecode interpreter */
+#include <ctype.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+
+enum op { OP_PUSH, OP_ADD, OP_SUB, OP_MUL, OP_DIV, OP_MOD, OP_DUP, OP_SWAP, OP_JZ, OP_JMP, OP_LOAD, OP_STORE, OP_PRINT, OP_HALT };
+
+struct insn {
+    enum op op;
+    long arg;
+};
+
+struct program {
+    struct insn *code;
+    size_t length;
+    size_t capacity;
+};
+
+struct token {
+    enum { TOK_NUMBER, TOK_WORD, TOK_END } kind;
+    long number;
+    char word[32];
+};
+
+static const char *next_token(const char *p, struct token *tok)
+{
+    size_t n = 0;
+
+    while (isspace((unsigned char)*p))
+        p++;
+    if (!*p) {
+        tok->kind = TOK_END;
+        return p;
+    }
+    if (isdigit((unsigned char)*p) || (*p == '-' && isdigit((unsigned char)p[1]))) {
+        tok->kind = TOK_NUMBER;
+        tok->number = strtol(p, (char **)&p, 10);
+        return p;
+    }
+    tok->kind = TOK_WORD;
+    while (*p && !isspace((unsigned char)*p) && n < sizeof(tok->word) - 1)
+        tok->word[n++] = *p++;
+    tok->word[n] = '\0';
+    return p;
+}
+
+static void emit(struct program *prog, enum op op, long arg)
+{
+    if (prog->length == prog->capacity) {
+        prog->capacity = prog->capacity ? prog->capacity * 2 : 64;
+        prog->code = realloc(prog->code, prog->capacity * sizeof(*prog->code));
+        if (!prog->code)
+            abort();
+    }
+    prog->code[prog->length].op = op;
+    prog->code[prog->length].arg = arg;
+    prog->length++;
+}
+
+static int compile_word(struct program *prog, const char *word)
+{
+    static const struct { const char *name; enum op op; } words[] = {
+        { "+", OP_ADD }, { "-", OP_SUB }, { "*", OP_MUL }, { "/", OP_DIV }, { "%", OP_MOD },
+        { "dup", OP_DUP }, { "swap", OP_SWAP }, { "print", OP_PRINT }, { "halt", OP_HALT },
+    };
+    size_t i;
+
+    for (i = 0; i < sizeof(words) / sizeof(words[0]); i++) {
+        if (strcmp(words[i].name, word) == 0) {
+            emit(prog, words[i].op, 0);
+            return 0;
+        }
+    }
+    if (word[0] == '@' && isdigit((unsigned char)word[1])) {
+        emit(prog, OP_LOAD, atol(word + 1));
+        return 0;
+    }
+    if (word[0] == '!' && isdigit((unsigned char)word[1])) {
+        emit(prog, OP_STORE, atol(word + 1));
+        return 0;
+    }
+    if (word[0] == '?' && isdigit((unsigned char)word[1])) {
+        emit(prog, OP_JZ, atol(word + 1));
+        return 0;
+    }
+    if (word[0] == '>' && isdigit((unsigned char)word[1])) {
+        emit(prog, OP_JMP, atol(word + 1));
+        return 0;
+    }
+    return -1;
+}
+
+int compile(struct program *prog, const char *source)
+{
+    struct token tok;
+
+    for (source = next_token(source, &tok); tok.kind != TOK_END; source = next_token(source, &tok)) {
+        if (tok.kind == TOK_NUMBER)
+            emit(prog, OP_PUSH, tok.number);
+        else if (compile_word(prog, tok.word) != 0)
+            return -1;
+    }
+    emit(prog, OP_HALT, 0);
+    return 0;
+}
+
+long run(const struct program *prog, long *memory, size_t memorySize)
+{
+    long stack[256];
+    size_t sp = 0, pc = 0;
+    long a, b;
+
+#define POP() (sp ? stack[--sp] : 0)
+#define PUSH(v) do { if (sp < 256) stack[sp++] = (v); } while (0)
+    while (pc < prog->length) {
+        const struct insn *in = &prog->code[pc++];
+        switch (in->op) {
+        case OP_PUSH: PUSH(in->arg); break;
+        case OP_ADD: b = POP(); a = POP(); PUSH(a + b); break;
+        case OP_SUB: b = POP(); a = POP(); PUSH(a - b); break;
+        case OP_MUL: b = POP(); a = POP(); PUSH(a * b); break;
+        case OP_DIV: b = POP(); a = POP(); PUSH(b ? a / b : 0); break;
+        case OP_MOD: b = POP(); a = POP(); PUSH(b ? a % b : 0); break;
+        case OP_DUP: a = POP(); PUSH(a); PUSH(a); break;
+        case OP_SWAP: b = POP(); a = POP(); PUSH(b); PUSH(a); break;
+        case OP_JZ: if (POP() == 0) pc = (size_t)in->arg; break;
+        case OP_JMP: pc = (size_t)in->arg; break;
+        case OP_LOAD: PUSH((size_t)in->arg < memorySize ? memory[in->arg] : 0); break;
+        case OP_STORE: a = POP(); if ((size_t)in->arg < memorySize) memory[in->arg] = a; break;
+        case OP_PRINT: printf("%ld\n", POP()); break;
+        case OP_HALT: return sp ? stack[sp - 1] : 0;
+        }
+    }
+#undef POP
+#undef PUSH
+    return 0;
+}
+
+int main(int argc, char **argv)
+{
+    struct program prog = { 0 };
+    long memory[16] = { 0 };
+
+    if (argc < 2 || compile(&prog, argv[1]) != 0)
+        return 1;
+    run(&prog, memory, sizeof(memory) / sizeof(memory[0]));
+    free(prog.code);
+    return 0;
+}
@@ -0,0 +1,97 @@
+// ginst compile benchmark: template instantiation, variadics and type erasure
+#include <array>
+#include <cstddef>
+#include <functional>
+#include <iostream>
+#include <memory>
+#include <tuple>
+#include <type_traits>
+#include <utility>
+#include <vector>
+
+template <typename T, std::size_t Rows, std::size_t Cols>
+struct Matrix {
+    std::array<T, Rows * Cols> values{};
+
+    T &operator()(std::size_t r, std::size_t c) { return values[r * Cols + c]; }
+    const T &operator()(std::size_t r, std::size_t c) const { return values[r * Cols + c]; }
+
+    template <std::size_t Other>
+    Matrix<T, Rows, Other> operator*(const Matrix<T, Cols, Other> &rhs) const
+    {
+        Matrix<T, Rows, Other> out;
+        for (std::size_t r = 0; r < Rows; ++r)
+            for (std::size_t c = 0; c < Other; ++c)
+                for (std::size_t k = 0; k < Cols; ++k)
+                    out(r, c) += (*this)(r, k) * rhs(k, c);
+        return out;
+    }
+};
+
+template <typename... Ts>
+struct Visitor : Ts... {
+    using Ts::operator()...;
+};
+template <typename... Ts>
+Visitor(Ts...) -> Visitor<Ts...>;
+
+template <typename Tuple, std::size_t... I>
+double sumTuple(const Tuple &tuple, std::index_sequence<I...>)
+{
+    return (0.0 + ... + static_cast<double>(std::get<I>(tuple)));
+}
+
+template <typename... Ts>
+double sum(const std::tuple<Ts...> &tuple)
+{
+    return sumTuple(tuple, std::index_sequence_for<Ts...>{});
+}
+
+class Shape {
+public:
+    virtual ~Shape() = default;
+    virtual double area() const = 0;
+};
+
+template <typename Measure>
+class Generic : public Shape {
+public:
+    explicit Generic(Measure measure) : measure_(std::move(measure)) {}
+    double area() const override { return measure_(); }
+
+private:
+    Measure measure_;
+};
+
+template <typename Measure>
+std::unique_ptr<Shape> makeShape(Measure measure)
+{
+    return std::make_unique<Generic<Measure>>(std::move(measure));
+}
+
+int main()
+{
+    Matrix<double, 4, 4> a;
+    Matrix<double, 4, 3> b;
+    for (std::size_t i = 0; i < 16; ++i)
+        a.values[i] = static_cast<double>(i);
+    for (std::size_t i = 0; i < 12; ++i)
+        b.values[i] = static_cast<double>(i) / 2;
+    Matrix<double, 4, 3> c = a * b;
+
+    std::vector<std::unique_ptr<Shape>> shapes;
+    shapes.push_back(makeShape([] { return 3.0 * 4.0; }));
+    shapes.push_back(makeShape([r = 2.0] { return 3.14159 * r * r; }));
+    shapes.push_back(makeShape(std::function<double()>([] { return 0.5 * 3.0 * 5.0; })));
+
+    double total = sum(std::make_tuple(1, 2.5f, 3.0, 4L, c(3, 2)));
+    for (const auto &shape : shapes)
+        total += shape->area();
+
+    auto describe = Visitor{
+        [](int v) { return v * 2.0; },
+        [](double v) { return v / 2.0; },
+    };
+    std::cout << total + describe(3) + describe(4.0) << '\n';
+    return 0;
+}
@@ -4,14 +4,35 @@ ginst.py - A script to make/install/download GCC
 MIT License - Charles Machalow
 '''
 import ftplib
+import http.client
+import http.server
 import logging
 import multiprocessing
 import os
 import re
 import shutil
+import signal
 import subprocess
 import sys
+import tarfile
+import tempfile
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
 import argparse
+import asyncio
+import bisect
+import codecs
+import collections
+import concurrent.futures
+import contextlib
+import fcntl
+import gzip
+import hashlib
+import json
+import selectors
+import time
 
 try:
     raw_input
@@ -28,32 +49,570 @@ logger.addHandler(ch)
 
 THIS_FOLDER = os.path.abspath(os.path.dirname(__file__))
 
-GCC_LOCAL_COMPRESSED_SOURCE_PATH = os.path.join(THIS_FOLDER, 'gcc.tar.gz')
 GCC_SOURCE_URL = "http://ftpmirror.gnu.org/gcc/gcc-%s/gcc-%s.tar.gz"
+GCC_SOURCE_MIRRORS = [
+    GCC_SOURCE_URL,
+    "https://mirrors.ocf.berkeley.edu/gnu/gcc/gcc-%s/gcc-%s.tar.gz",
+    "https://mirrors.kernel.org/gnu/gcc/gcc-%s/gcc-%s.tar.gz",
+    "https://ftp.gnu.org/gnu/gcc/gcc-%s/gcc-%s.tar.gz",
+    "https://gcc.gnu.org/pub/gcc/releases/gcc-%s/gcc-%s.tar.gz",
+]
+# sha512 sums of every archive of a release, published next to it on gcc.gnu.org
+GCC_CHECKSUM_URL = "https://gcc.gnu.org/pub/gcc/releases/gcc-%s/sha512.sum"
+GCC_MIRROR_RANKING_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'ginst', 'mirrors.json')
+MIRROR_RANKING_HALF_LIFE = 7 * 24 * 60 * 60
+MIRROR_REPROBE_INTERVAL = 6 * 60 * 60
+MIRROR_PROBE_TIMEOUT = 10
+GCC_SOURCE_CACHE_FOLDER = os.path.join(os.path.expanduser('~'), '.cache', 'ginst', 'sources')
+GCC_SOURCE_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+GCC_PREREQ_FOLDER = os.path.join(os.path.expanduser('~'), '.cache', 'ginst', 'prerequisites')
+GCC_PREREQ_PREFIX_FOLDER = os.path.join(os.path.expanduser('~'), '.cache', 'ginst', 'prefixes')
+GCC_ARTIFACT_FOLDER = os.path.join(os.path.expanduser('~'), '.cache', 'ginst', 'artifacts')
+ARTIFACT_SERVER_PORT = 8470
+ARTIFACT_SERVER_TIMEOUT = 10
 GCC_FTP_BASE = 'mirrors.ocf.berkeley.edu'
+GCC_FTP_PORT = ftplib.FTP_PORT
 GCC_FTP_VERSION_FOLDER = 'gnu/gcc'
-GCC_FTP_REGEX = r'%s/gcc\-(\d?\.\d*\.\d*)$' % GCC_FTP_VERSION_FOLDER
+GCC_FTP_REGEX = r'%s/gcc\-(\d+\.\d+\.\d+)$' % GCC_FTP_VERSION_FOLDER
+GCC_VERSION_CATALOGUE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'ginst', 'versions.json')
+GCC_VERSION_CATALOGUE_TTL = 24 * 60 * 60
+GCC_HOST_PROFILE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'ginst', 'host.json')
+HOST_PROFILE_TTL = 24 * 60 * 60
+DPKG_STATUS_PATH = '/var/lib/dpkg/status'
+APT_LISTS_FOLDER = '/var/lib/apt/lists'
+APT_LISTS_MAX_AGE = 24 * 60 * 60
+GINST_PREREQ_PACKAGES = ['wget', 'gcc', 'g++', 'gcc-multilib', 'g++-multilib', 'build-essential', 'libc6-dev', 'zlib1g-dev',
+                         'flex', 'bison', 'texinfo', 'automake']
+GCC_LOG_FOLDER = os.path.join(THIS_FOLDER, 'logs')
+GCC_STATE_FOLDER = os.path.join(THIS_FOLDER, 'state')
+GCC_PROFILE_HISTORY_PATH = os.path.join(GCC_LOG_FOLDER, 'profile-history.jsonl')
+GCC_BENCHMARK_FOLDER = os.path.join(THIS_FOLDER, 'benchmark')
+GCC_TRIPLE = 'x86_64-linux-gnu'
+BENCHMARK_REPEATS = 3
+SYSTEM_CALL_TAIL_LINES = 200
+ASYNC_OUTPUT_EVENT_BACKLOG = 1000
+DOWNLOAD_CONNECTIONS = 4
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_TIMEOUT = 60
+EXTRACT_THREADS = min(8, multiprocessing.cpu_count())
+MAKE_JOB_MEMORY_ESTIMATE = 1024 * 1024 * 1024
+MAKE_HEAVY_JOB_MEMORY_ESTIMATE = 3 * 1024 * 1024 * 1024
+MAKE_MEMORY_RESERVE = 0.1
+MAKE_MEMORY_PRESSURE_THRESHOLD = 10.0
+MAKE_JOB_CONTROL_INTERVAL = 5
+PROFILER_SAMPLE_INTERVAL = 1
+GCC_SCRATCH_FOLDER = '/dev/shm'
+SCRATCH_BUILD_BYTES = 12 * 1024 * 1024 * 1024
+SCRATCH_RESERVE_BYTES = 1024 * 1024 * 1024
+SCRATCH_CHECK_INTERVAL = 5
+
+# make output -> build phase, for logging and for phases whose jobs need much more memory (name, regex, heavy)
+MAKE_PHASES = [
+    ('lto', re.compile(r'lto-wrapper|lto1|-flto'), True),
+    ('genattrtab', re.compile(r'insn-attrtab|insn-automata|genattrtab'), True),
+    ('target-libs', re.compile(r'Configuring in \./[\w-]+-linux-gnu/'), False),
+    ('stagefeedback', re.compile(r'Configuring stage feedback'), False),
+    ('stagetrain', re.compile(r'Configuring stage train'), False),
+    ('stageprofile', re.compile(r'Configuring stage profile'), False),
+    ('stage3', re.compile(r'Configuring stage 3'), False),
+    ('stage2', re.compile(r'Configuring stage 2'), False),
+    ('stage1', re.compile(r'Configuring stage 1'), False),
+]
+
+# build profile -> (languages, configure args, make target). fast skips the 3-stage bootstrap for a quick
+# working compiler; optimized trains the compiler on itself and links it with LTO so it compiles faster;
+# fast-compiler does the same without 32-bit libraries and is benchmarked against the standard build
+BUILD_PROFILES = {
+    'fast': ('c', '--disable-bootstrap --disable-multilib', ''),
+    'standard': ('c,c++', '--enable-multilib', ''),
+    'optimized': ('c,c++', '--enable-multilib --with-build-config=bootstrap-lto', 'profiledbootstrap'),
+    'fast-compiler': ('c,c++', '--disable-multilib --with-build-config=bootstrap-lto', 'profiledbootstrap'),
+}
+DEFAULT_BUILD_PROFILE = 'standard'
+
+# archive magic -> parallel decompressors tar can drive via -I, in order of preference
+PARALLEL_DECOMPRESSORS = [
+    (b'\x1f\x8b', ['pigz']),
+    (b'\xfd7zXZ\x00', ['pixz', 'xz -T0']),
+    (b'BZh', ['lbzip2', 'pbzip2']),
+    (b'\x28\xb5\x2f\xfd', ['zstd -T0']),
+]
+
+# compressors for packaged installs, in order of preference (tool, extension, tar -I command)
+ARTIFACT_COMPRESSORS = [
+    ('zstd', '.tar.zst', 'zstd -T0 -12'),
+    ('xz', '.tar.xz', 'xz -T0 -6'),
+]
+
+# archive magic -> tar's own option for it, needed when tar reads the archive from a pipe
+TAR_DECOMPRESS_OPTIONS = [
+    (b'\x1f\x8b', '-z'),
+    (b'\xfd7zXZ\x00', '-J'),
+    (b'BZh', '-j'),
+    (b'\x28\xb5\x2f\xfd', '--zstd'),
+]
+
+def _atomicWriteJson(path, data, sortKeys=False):
+    '''
+    Writes data as json to path through a temporary file, so readers never see a partial file
+    '''
+    folder = os.path.dirname(path)
+    if folder and not os.path.isdir(folder):
+        os.makedirs(folder, exist_ok=True)
+    tmpPath = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+    with open(tmpPath, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=sortKeys)
+    os.replace(tmpPath, path)
+
+def _runCheckedCommand(command, step, failureMessage, cwd=None, logPath=None):
+    '''
+    Runs command in a SystemCall, raising EnvironmentError if it fails. The default runCommand of helpers
+    that GInst routes through its own calls instead (for the resource summary, the jobserver and cancelling).
+    '''
+    call = SystemCall(command, tailLines=SYSTEM_CALL_TAIL_LINES, logPath=logPath, cwd=cwd)
+    if call.failed():
+        raise EnvironmentError(call.describeFailure(failureMessage))
+    return call
+
+def _hashFile(path, algorithm='sha256'):
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class VersionCatalogue(object):
+    # 'latest', 'latest 12', 'latest 12.x', '12.x', '>= 9.1' or '12.2.0'
+    QUERY_REGEX = re.compile(r'^(?:latest(?:\s+(?P<latestVersion>\d+(?:\.\d+)*)(?:\.x)?)?|>=\s*(?P<minimum>\d+(?:\.\d+)*)|(?P<exact>\d+(?:\.\d+)*)(?P<series>\.x)?)$')
+
+    def __init__(self, cachePath=GCC_VERSION_CATALOGUE_PATH, ttl=GCC_VERSION_CATALOGUE_TTL, ftpHost=GCC_FTP_BASE, ftpPort=GCC_FTP_PORT):
+        '''
+        The list of gcc versions on the ftp mirror, cached on disk for ttl seconds. A stale cache is
+        still served while a background thread refreshes it; refreshes first ask the server whether
+        the release folder changed and only list it again if it did.
+        '''
+        self.cachePath = cachePath
+        self.ttl = ttl
+        self.ftpHost = ftpHost
+        self.ftpPort = ftpPort
+        self._lock = threading.Lock()
+        self._refreshThread = None
+        self._setCache(self._loadCache())
+
+    def _loadCache(self):
+        try:
+            with open(self.cachePath, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _saveCache(self, cache):
+        _atomicWriteJson(self.cachePath, cache)
+
+    def _setCache(self, cache):
+        versions = cache['versions'] if cache else []
+        # kept sorted by numeric key so every query below is a bisect
+        keys = sorted(self.versionKey(v) for v in versions)
+        with self._lock:
+            self._cache = cache
+            # swapped as one tuple so a query never sees the keys of one listing and the versions of another
+            self._index = (keys, ['.'.join(str(p) for p in k) for k in keys])
+
+    @classmethod
+    def versionKey(cls, version):
+        return tuple(int(p) for p in version.split('.'))
+
+    def _getFolderModifiedTime(self, ftp):
+        for command in ('MLST %s' % GCC_FTP_VERSION_FOLDER, 'MDTM %s' % GCC_FTP_VERSION_FOLDER):
+            try:
+                response = ftp.sendcmd(command)
+            except ftplib.all_errors:
+                continue
+            match = re.search(r'modify=(\d+)', response, re.IGNORECASE) or re.match(r'213 (\d+)', response)
+            if match:
+                return match.group(1)
+        return None
+
+    def refresh(self, conditional=True):
+        ftp = ftplib.FTP(timeout=DOWNLOAD_TIMEOUT)
+        ftp.connect(self.ftpHost, self.ftpPort)
+        try:
+            ftp.login()
+            modified = self._getFolderModifiedTime(ftp)
+            with self._lock:
+                cache = self._cache
+            if conditional and cache and modified is not None and cache.get('modified') == modified:
+                logger.debug("gcc version listing is unchanged since %s" % modified)
+                versions = cache['versions']
+            else:
+                versions = []
+                for entry in ftp.nlst(GCC_FTP_VERSION_FOLDER):
+                    matches = re.findall(GCC_FTP_REGEX, entry)
+                    if matches:
+                        versions.append(matches[0])
+        finally:
+            try:
+                ftp.quit()
+            except ftplib.all_errors:
+                ftp.close()
+
+        cache = {'fetched': time.time(), 'modified': modified, 'versions': versions}
+        self._saveCache(cache)
+        self._setCache(cache)
+
+    def _backgroundRefresh(self):
+        try:
+            self.refresh()
+        except ftplib.all_errors as ex:
+            logger.debug("Background refresh of the gcc version listing failed: %s" % ex)
+
+    def _getIndex(self):
+        '''
+        Returns (sorted keys, versions) of the current listing, fetching it if there is none and starting a
+        background refresh if it is stale
+        '''
+        with self._lock:
+            cache = self._cache
+        if cache is None:
+            self.refresh()
+        elif time.time() - cache['fetched'] > self.ttl:
+            with self._lock:
+                if self._refreshThread is None or not self._refreshThread.is_alive():
+                    self._refreshThread = threading.Thread(target=self._backgroundRefresh, name='ginst-version-refresh')
+                    self._refreshThread.daemon = True
+                    self._refreshThread.start()
+        with self._lock:
+            return self._index
+
+    def getVersions(self):
+        '''
+        Returns all known versions, oldest first
+        '''
+        return list(self._getIndex()[1])
+
+    def _prefixBounds(self, prefix):
+        keys, versions = self._getIndex()
+        if not prefix:
+            return versions, 0, len(keys)
+        key = self.versionKey(prefix)
+        upper = key[:-1] + (key[-1] + 1,)
+        return versions, bisect.bisect_left(keys, key), bisect.bisect_left(keys, upper)
+
+    def matching(self, prefix):
+        '''
+        All versions within a series, e.g. matching('12') -> ['12.1.0', '12.2.0', ...]
+        '''
+        versions, low, high = self._prefixBounds(prefix)
+        return versions[low:high]
+
+    def latest(self, prefix=None):
+        '''
+        The newest version, optionally within a series (latest('12') -> '12.x.y'), or None
+        '''
+        versions, low, high = self._prefixBounds(prefix)
+        return versions[high - 1] if high > low else None
+
+    def atLeast(self, version):
+        keys, versions = self._getIndex()
+        return versions[bisect.bisect_left(keys, self.versionKey(version)):]
+
+    def exact(self, version):
+        '''
+        Returns [version] if it is a known version, otherwise []
+        '''
+        keys, versions = self._getIndex()
+        key = self.versionKey(version)
+        index = bisect.bisect_left(keys, key)
+        return [versions[index]] if index < len(keys) and keys[index] == key else []
+
+    def query(self, spec):
+        '''
+        Resolves a textual query to a list of versions: 'latest', 'latest 12.x', '12.x', '>= 9' or an exact version.
+        Raises EnvironmentError for anything else.
+        '''
+        spec = spec.strip()
+        match = self.QUERY_REGEX.match(spec)
+        if match is None:
+            raise EnvironmentError("No gcc version matches %s" % spec)
+        if match.group('minimum'):
+            return self.atLeast(match.group('minimum'))
+        if spec.startswith('latest'):
+            version = self.latest(match.group('latestVersion'))
+            return [version] if version else []
+        if match.group('series'):
+            return self.matching(match.group('exact'))
+        return self.exact(match.group('exact'))
+
+class HostProfile(object):
+    TOOLS = ('gcc', 'g++', 'make', 'tar', 'wget', 'flex', 'bison', 'makeinfo', 'automake', 'apt-get', 'dpkg',
+             'pigz', 'pixz', 'xz', 'lbzip2', 'pbzip2', 'zstd', 'ccache')
+    MULTILIB_HEADERS = ('/usr/include/x86_64-linux-gnu/gnu/stubs-32.h', '/usr/include/gnu/stubs-32.h')
+    # facts that can change while we run or between runs with the same cache key (taskset, a container's cpu
+    # limit), never taken from the disk cache; VOLATILE_PROBES gathers them
+    VOLATILE = ('memAvailable', 'diskFree', 'cores', 'cpuQuota')
+    VOLATILE_PROBES = ('memory', 'diskFree', 'cores', 'cpuQuota')
+
+    def __init__(self, cachePath=GCC_HOST_PROFILE_PATH, ttl=HOST_PROFILE_TTL):
+        '''
+        What ginst needs to know about this host (euid, tool paths, cores and cgroup cpu quota, memory,
+        free disk, glibc, multilib headers), gathered in-process by parallel probes instead of forking.
+        Stable facts are cached on disk for ttl seconds, keyed by euid and PATH (and PATH folder mtimes,
+        so installing a tool invalidates it).
+        '''
+        self.cachePath = cachePath
+        self.ttl = ttl
+        self.facts = self._load()
+
+    instance = None
+    _instanceLock = threading.Lock()
+
+    @classmethod
+    def get(cls):
+        '''
+        Returns the profile for this run, probing the host the first time
+        '''
+        with cls._instanceLock:
+            if cls.instance is None:
+                cls.instance = HostProfile()
+            return cls.instance
+
+    @classmethod
+    def _getPathFolders(cls):
+        return [folder for folder in os.environ.get('PATH', '').split(os.pathsep) if folder]
+
+    @classmethod
+    def _getCacheKey(cls):
+        mtimes = []
+        for folder in cls._getPathFolders():
+            try:
+                mtimes.append('%s:%d' % (folder, os.stat(folder).st_mtime))
+            except OSError:
+                mtimes.append('%s:-' % folder)
+        return hashlib.sha256(('%d|%s' % (os.geteuid(), '|'.join(mtimes))).encode()).hexdigest()
+
+    @classmethod
+    def _probeTools(cls):
+        tools = dict.fromkeys(cls.TOOLS)
+        for folder in cls._getPathFolders():
+            for tool in cls.TOOLS:
+                path = os.path.join(folder, tool)
+                if tools[tool] is None and os.path.isfile(path) and os.access(path, os.X_OK):
+                    tools[tool] = path
+        return tools
+
+    @classmethod
+    def _probeCpuQuota(cls):
+        '''
+        Returns the cgroup cpu limit in cores, or None if unlimited
+        '''
+        candidates = []
+        try:
+            with open('/proc/self/cgroup', 'r') as f:
+                for line in f:
+                    hierarchy, controllers, path = line.rstrip('\n').split(':', 2)
+                    if hierarchy == '0':
+                        candidates.append(('/sys/fs/cgroup%s/cpu.max' % path.rstrip('/'), None))
+                    elif 'cpu' in controllers.split(','):
+                        candidates.append(('/sys/fs/cgroup/cpu,cpuacct%s/cpu.cfs_quota_us' % path.rstrip('/'),
+                                           '/sys/fs/cgroup/cpu,cpuacct%s/cpu.cfs_period_us' % path.rstrip('/')))
+        except (IOError, ValueError):
+            pass
+        candidates += [('/sys/fs/cgroup/cpu.max', None), ('/sys/fs/cgroup/cpu/cpu.cfs_quota_us', '/sys/fs/cgroup/cpu/cpu.cfs_period_us')]
+        for quotaPath, periodPath in candidates:
+            try:
+                with open(quotaPath, 'r') as f:
+                    fields = f.read().split()
+                if periodPath is not None:
+                    with open(periodPath, 'r') as f:
+                        fields.append(f.read().strip())
+            except IOError:
+                continue
+            if fields[0] in ('max', '-1'):
+                return None
+            return float(fields[0]) / float(fields[1])
+        return None
+
+    @classmethod
+    def _probeMemory(cls):
+        info = AdaptiveJobController.readMemInfo()
+        return {'memTotal': info['MemTotal'], 'memAvailable': info['MemAvailable']}
+
+    @classmethod
+    def _probeDiskFree(cls):
+        stat = os.statvfs(THIS_FOLDER)
+        return stat.f_bavail * stat.f_frsize
+
+    def _probe(self, names):
+        probes = {
+            'euid': os.geteuid,
+            'tools': self._probeTools,
+            'cores': lambda: len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else multiprocessing.cpu_count(),
+            'cpuQuota': self._probeCpuQuota,
+            'memory': self._probeMemory,
+            'diskFree': self._probeDiskFree,
+            'glibc': lambda: os.confstr('CS_GNU_LIBC_VERSION'),
+            'multilib': lambda: any(os.path.isfile(path) for path in self.MULTILIB_HEADERS),
+        }
+        facts = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(names)) as pool:
+            futures = dict((name, pool.submit(probes[name])) for name in names)
+            for name, future in futures.items():
+                try:
+                    value = future.result()
+                except (IOError, OSError, ValueError, KeyError) as ex:
+                    logger.debug("Unable to probe %s: %s" % (name, ex))
+                    value = None
+                if name == 'memory':
+                    facts.update(value or {'memTotal': None, 'memAvailable': None})
+                else:
+                    facts[name] = value
+        return facts
+
+    def _load(self, useCache=True):
+        key = self._getCacheKey()
+        try:
+            if not useCache:
+                raise IOError("Skipping the cache")
+            with open(self.cachePath, 'r') as f:
+                cached = json.load(f)
+            if cached.get('key') == key and time.time() - cached.get('time', 0) < self.ttl:
+                facts = cached['facts']
+                facts.update(self._probe(self.VOLATILE_PROBES))
+                return facts
+        except (IOError, ValueError, KeyError):
+            pass
+
+        facts = self._probe(['euid', 'tools', 'cores', 'cpuQuota', 'memory', 'diskFree', 'glibc', 'multilib'])
+        try:
+            _atomicWriteJson(self.cachePath, {'key': key, 'time': time.time(),
+                                              'facts': dict((k, v) for k, v in facts.items() if k not in self.VOLATILE)})
+        except (IOError, OSError) as ex:
+            logger.debug("Unable to cache the host profile: %s" % ex)
+        logger.debug("Host profile: %s" % facts)
+        return facts
+
+    def reload(self):
+        '''
+        Probes everything again, e.g. after installing packages
+        '''
+        self.facts = self._load(useCache=False)
+
+    def isRoot(self):
+        return self.facts['euid'] == 0
+
+    def which(self, tool):
+        '''
+        Returns the path to tool (from the PATH scan), or None
+        '''
+        tools = self.facts['tools']
+        if tool not in tools:
+            # not one of the usual suspects, scan for it once and remember it
+            tools[tool] = None
+            for folder in self._getPathFolders():
+                path = os.path.join(folder, tool)
+                if os.path.isfile(path) and os.access(path, os.X_OK):
+                    tools[tool] = path
+                    break
+        return tools[tool]
+
+    def getCpuCount(self):
+        '''
+        Cores we may actually use: the affinity mask, capped by any cgroup cpu quota
+        '''
+        cores = self.facts['cores'] or multiprocessing.cpu_count()
+        if self.facts['cpuQuota']:
+            cores = min(cores, max(1, int(self.facts['cpuQuota'] + 0.5)))
+        return cores
+
+    def getGlibcVersion(self):
+        return self.facts['glibc']
+
+    def hasMultilib(self):
+        return bool(self.facts['multilib'])
+
+class PackageResolver(object):
+    def __init__(self, statusPath=DPKG_STATUS_PATH, listsFolder=APT_LISTS_FOLDER, maxListAge=APT_LISTS_MAX_AGE):
+        '''
+        Works out which apt packages are missing by reading the dpkg status database directly, and
+        whether the apt package lists are recent enough to install from without an update
+        '''
+        self.statusPath = statusPath
+        self.listsFolder = listsFolder
+        self.maxListAge = maxListAge
+
+    def getInstalled(self):
+        '''
+        Returns the names (and virtual names they provide) of every installed package
+        '''
+        installed = set()
+        with open(self.statusPath, 'r', encoding='utf-8', errors='replace') as f:
+            stanzas = f.read().split('\n\n')
+        for stanza in stanzas:
+            fields = {}
+            for line in stanza.splitlines():
+                if line and not line[0].isspace() and ':' in line:
+                    name, value = line.split(':', 1)
+                    fields[name] = value.strip()
+            if 'Package' not in fields or not fields.get('Status', '').endswith(' installed'):
+                continue
+            installed.add(fields['Package'])
+            if 'Architecture' in fields:
+                installed.add('%s:%s' % (fields['Package'], fields['Architecture']))
+            for provided in fields.get('Provides', '').split(','):
+                provided = provided.split('(')[0].strip()
+                if provided:
+                    installed.add(provided)
+        return installed
+
+    def getMissing(self, packages):
+        installed = self.getInstalled()
+        return [package for package in packages if package not in installed]
+
+    def listsAreFresh(self):
+        try:
+            names = [name for name in os.listdir(self.listsFolder) if name not in ('lock', 'partial', 'auxfiles')]
+        except OSError:
+            return False
+        newest = max([os.path.getmtime(os.path.join(self.listsFolder, name)) for name in names] or [0])
+        return time.time() - newest < self.maxListAge
 
 class GccVersion(object):
-    def __init__(self, versionString, extraConfigureArgs=''):
+    def __init__(self, versionString, extraConfigureArgs='', profile=DEFAULT_BUILD_PROFILE):
         if isinstance(versionString, (str, bytes)):
             self.rawVersionString = versionString
         else:
             raise AttributeError("versionString should be string-like")
+        if profile not in BUILD_PROFILES:
+            raise AttributeError("profile should be one of %s" % ', '.join(sorted(BUILD_PROFILES)))
 
         self.extraConfigureArgs = extraConfigureArgs
+        self.profile = profile
+        # package -> prefix of a shared gmp/mpfr/mpc/isl build to use instead of building them in-tree
+        self.prerequisitePrefixes = {}
+
+    catalogue = None
+
+    @classmethod
+    def getCatalogue(cls):
+        if cls.catalogue is None:
+            cls.catalogue = VersionCatalogue()
+        return cls.catalogue
 
     @classmethod
     def getPossibleGccVersions(cls):
-        retList = []
-        f = ftplib.FTP(GCC_FTP_BASE)
-        f.login()
-        listing = f.nlst(GCC_FTP_VERSION_FOLDER)
-        for i in listing:
-            matches = re.findall(GCC_FTP_REGEX, i)
-            if matches:
-                retList.append(matches[0])
-        return retList
+        return cls.getCatalogue().getVersions()
+
+    @classmethod
+    def resolveVersionString(cls, spec):
+        '''
+        Turns a query like 'latest' or '12.x' into a concrete version, leaving exact versions untouched
+        '''
+        if not (spec.startswith('latest') or spec.endswith('.x')):
+            return spec
+        versions = cls.getCatalogue().query(spec)
+        if not versions:
+            raise EnvironmentError("No gcc version matches %s" % spec)
+        return versions[-1]
 
     @classmethod
     def selectGccVersion(cls):
@@ -79,40 +638,245 @@ class GccVersion(object):
     def getSourceUrl(self):
         return GCC_SOURCE_URL % (self.rawVersionString, self.rawVersionString)
 
+    def getSourceUrls(self):
+        return [mirror % (self.rawVersionString, self.rawVersionString) for mirror in GCC_SOURCE_MIRRORS]
+
+    def getSourceArchiveName(self):
+        return 'gcc-%s.tar.gz' % self.rawVersionString
+
+    def getChecksumUrl(self):
+        return GCC_CHECKSUM_URL % self.rawVersionString
+
     def getLocalUncompressedSourcePath(self):
         return os.path.join(THIS_FOLDER, 'gcc-%s' % self.rawVersionString)
 
+    def getBuildName(self):
+        '''
+        gcc-<version>, suffixed with the profile for anything but the standard one so profiles can coexist
+        '''
+        if self.profile == DEFAULT_BUILD_PROFILE:
+            return 'gcc-%s' % self.rawVersionString
+        return 'gcc-%s-%s' % (self.rawVersionString, self.profile)
+
     def getLocalBuildPath(self):
-        return os.path.join(self.getLocalUncompressedSourcePath(), 'build')
+        if self.profile == DEFAULT_BUILD_PROFILE:
+            return os.path.join(self.getLocalUncompressedSourcePath(), 'build')
+        return os.path.join(self.getLocalUncompressedSourcePath(), 'build-%s' % self.profile)
 
-    def getConfigureCommand(self):
-        if SystemCall.hasRoot():
+    def getMakeTarget(self):
+        return BUILD_PROFILES[self.profile][2]
+
+    def getInstallPrefix(self):
+        if HostProfile.get().isRoot():
             prefix = '/usr/local/'
         else:
             prefix = os.path.expanduser('~/')
+        return prefix + self.getBuildName()
+
+    def getCompilerPaths(self):
+        '''
+        Returns the (gcc, g++) this version installs
+        '''
+        binFolder = os.path.join(self.getInstallPrefix(), 'bin')
+        return os.path.join(binFolder, 'gcc-%s' % self.rawVersionString), os.path.join(binFolder, 'g++-%s' % self.rawVersionString)
+
+    def getConfigureArguments(self, includePrerequisites=True):
+        '''
+        Everything passed to configure apart from the install prefix. The shared prerequisite prefixes
+        can be left out, they are linked in statically and don't change what gets installed.
+        '''
+        languages, profileArgs = BUILD_PROFILES[self.profile][:2]
+        arguments = "-v --with-system-zlib --build=%s --host=%s --target=%s --enable-checking=release --enable-languages=%s %s --program-suffix=-%s %s" \
+        % (GCC_TRIPLE, GCC_TRIPLE, GCC_TRIPLE, languages, profileArgs, self.rawVersionString, self.extraConfigureArgs)
+        if includePrerequisites:
+            for package in sorted(self.prerequisitePrefixes):
+                arguments += ' --with-%s=%s' % (package, self.prerequisitePrefixes[package])
+        return arguments
 
-        return self.getLocalUncompressedSourcePath() + \
-        "/configure -v --with-system-zlib --build=x86_64-linux-gnu --host=x86_64-linux-gnu --target=x86_64-linux-gnu --prefix=%sgcc-%s --enable-checking=release --enable-languages=c,c++ --enable-multilib --program-suffix=-%s %s" \
-        % (prefix, self.rawVersionString, self.rawVersionString, self.extraConfigureArgs)
+    def getConfigureCommand(self):
+        return "%s/configure --prefix=%s %s" % (self.getLocalUncompressedSourcePath(), self.getInstallPrefix(), self.getConfigureArguments())
 
 class SystemCall(object):
-    def __init__(self, cmd):
+    READ_SIZE = 64 * 1024
+
+    def __init__(self, cmd, tailLines=None, logPath=None, cwd=None, env=None, passFds=(), lineCallback=None, onStart=None):
+        '''
+        tailLines - if given, only the last tailLines lines of output are kept in memory
+        logPath - if given, the full output is streamed to this gzip-compressed file
+        cwd - directory to run the command in (defaults to the current directory)
+        env - extra environment variables for the command
+        passFds - file descriptors the command should inherit (e.g. a make jobserver pipe)
+        lineCallback - called with each line of output as it arrives
+        onStart - if given, the command runs in its own session and onStart is called with its pid,
+            which is also its process group id (for os.killpg)
+        '''
         self.cmd = cmd
+        self.tailLines = tailLines
+        self.logPath = logPath
+        self.cwd = cwd
+        self.env = env
+        self.passFds = passFds
+        self.lineCallback = lineCallback
+        self.onStart = onStart
         self._execute()
 
+    def _handleLine(self, line):
+        logger.debug("| %s", line)
+        self._lines.append(line)
+        if self.lineCallback is not None:
+            self.lineCallback(line)
+
+    def _openLog(self):
+        if self.logPath is None:
+            return None
+        logFolder = os.path.dirname(self.logPath)
+        if logFolder and not os.path.isdir(logFolder):
+            os.makedirs(logFolder)
+        return gzip.open(self.logPath, 'wb', compresslevel=6)
+
+    def _feed(self, chunk, log):
+        '''
+        Takes a chunk of output: logs it raw and hands complete lines to _handleLine (an empty chunk flushes)
+        '''
+        if not chunk:
+            self._pending += self._decoder.decode(b'', final=True)
+            if self._pending:
+                self._handleLine(self._pending.rstrip('\r'))
+            self._pending = ''
+            return
+        self.stats['bytesRead'] += len(chunk)
+        if log is not None:
+            log.write(chunk)
+        self._pending += self._decoder.decode(chunk)
+        if '\n' in self._pending:
+            lines = self._pending.split('\n')
+            self._pending = lines.pop()
+            for line in lines:
+                self._handleLine(line.rstrip('\r'))
+
+    def _pump(self, fd, log):
+        # block in select() until the child writes or closes its end of the pipe,
+        # so the parent sleeps for the whole build instead of spinning on poll()
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._pending = ''
+        with selectors.DefaultSelector() as selector:
+            selector.register(fd, selectors.EVENT_READ)
+            while True:
+                selector.select()
+                self.stats['wakeups'] += 1
+                chunk = os.read(fd, self.READ_SIZE)
+                self._feed(chunk, log)
+                if not chunk:
+                    break
+
     def _execute(self):
         logger.debug("About to call %s" % self.cmd)
-        self.output = ''
-        self.process = subprocess.Popen(self.cmd, shell=True, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
-        while self.process.returncode is None:
-            self.process.poll()
-            self.process.stdout.flush()
-            line = self.process.stdout.readline().rstrip(os.linesep)
-            logger.debug("| %s" % line)
-            self.output += line
-
-        self.retCode = self.process.returncode
+        self._lines = collections.deque(maxlen=self.tailLines)
+        self.stats = {'bytesRead': 0, 'wakeups': 0}
+        self.resources = {}
+        startWall = time.time()
+        startCpu = time.thread_time()
+        log = self._openLog()
+        env = dict(os.environ, **self.env) if self.env else None
+        newSession = self.onStart is not None
+        self.process = subprocess.Popen(self.cmd, shell=True, stderr=subprocess.STDOUT, stdout=subprocess.PIPE,
+                                        cwd=self.cwd, env=env, pass_fds=self.passFds, start_new_session=newSession)
+        try:
+            if newSession:
+                self.onStart(self.process.pid)
+            self._pump(self.process.stdout.fileno(), log)
+        except BaseException:
+            # outside our process group the command doesn't see a Ctrl-C, so stop it here
+            if newSession:
+                try:
+                    os.killpg(self.process.pid, signal.SIGTERM)
+                except (ProcessLookupError, PermissionError):
+                    pass
+            raise
+        finally:
+            self.process.stdout.close()
+            if log is not None:
+                log.close()
+            self.retCode = self._reap()
+
+        wallTime = time.time() - startWall
+        self.resources['wallTime'] = wallTime
+        cpuTime = time.thread_time() - startCpu
+        self.stats['wallTime'] = wallTime
+        self.stats['parentCpuTime'] = cpuTime
+        self.stats['cpuOverhead'] = cpuTime / wallTime if wallTime else 0.0
+        self.stats['throughput'] = self.stats['bytesRead'] / wallTime if wallTime else 0.0
         logger.debug("... return code: %d" % self.retCode)
+        logger.debug("... %(bytesRead)d bytes in %(wallTime).2fs (%(throughput).0f B/s), "
+                     "parent cpu %(parentCpuTime).3fs (%(cpuOverhead).2f%%), %(wakeups)d wakeups"
+                     % dict(self.stats, cpuOverhead=self.stats['cpuOverhead'] * 100))
+
+    @classmethod
+    def _readProcIo(cls, pid):
+        counters = {}
+        try:
+            with open('/proc/%d/io' % pid, 'r') as f:
+                for line in f:
+                    name, value = line.split(':', 1)
+                    counters[name] = int(value)
+        except (IOError, ValueError):
+            pass
+        return counters
+
+    def _reap(self):
+        '''
+        Waits for the command and fills in self.resources: CPU time and peak RSS of the whole process
+        tree (from wait4) and its I/O (read from /proc while the exited shell is still a zombie, at
+        which point it includes every child it waited for)
+        '''
+        pid = self.process.pid
+        io = {}
+        if hasattr(os, 'waitid'):
+            try:
+                os.waitid(os.P_PID, pid, os.WEXITED | os.WNOWAIT)
+                io = self._readProcIo(pid)
+            except ChildProcessError:
+                pass
+        try:
+            _, status, usage = os.wait4(pid, 0)
+        except ChildProcessError:
+            return self.process.wait()
+        self.process.returncode = os.waitstatus_to_exitcode(status)
+        self.resources = {
+            'userTime': usage.ru_utime,
+            'systemTime': usage.ru_stime,
+            'maxRss': usage.ru_maxrss * 1024,
+            'readBytes': io.get('read_bytes', 0),
+            'writeBytes': io.get('write_bytes', 0),
+            'readChars': io.get('rchar', 0),
+            'writeChars': io.get('wchar', 0),
+        }
+        logger.debug("... user %(userTime).2fs, sys %(systemTime).2fs, max rss %(maxRss)d, read %(readBytes)d, wrote %(writeBytes)d bytes"
+                     % self.resources)
+        return self.process.returncode
+
+    @property
+    def output(self):
+        return '\n'.join(self._lines)
+
+    def getTail(self, numLines=20):
+        '''
+        Returns the last numLines lines of output (bounded by tailLines if set)
+        '''
+        lines = list(self._lines)[-numLines:] if numLines else list(self._lines)
+        return '\n'.join(lines)
+
+    def describeFailure(self, message, numLines=20):
+        '''
+        Builds an error message containing the tail of the output and where to find the full log
+        '''
+        message = '%s (return code: %d)' % (message, self.retCode)
+        if self.logPath:
+            message += '\nFull log: %s' % self.logPath
+        tail = self.getTail(numLines)
+        if tail:
+            message += '\nLast %d lines of output:\n%s' % (numLines, tail)
+        return message
 
     def succeeded(self):
         return self.retCode == 0
@@ -122,110 +886,2709 @@ class SystemCall(object):
 
     @classmethod
     def hasRoot(cls):
-        logger.debug("Checking for root")
-        return SystemCall('ls /root').succeeded()
+        return HostProfile.get().isRoot()
+
+class AsyncSystemCall(SystemCall):
+    def __init__(self, cmd, tailLines=None, logPath=None, cwd=None, env=None, passFds=(), lineCallback=None, onStart=None):
+        '''
+        SystemCall for asyncio: nothing runs until run() is awaited. The command always gets its own process
+        group, so cancel() (or cancelling run()) stops it along with everything it started.
+        '''
+        self.cmd = cmd
+        self.tailLines = tailLines
+        self.logPath = logPath
+        self.cwd = cwd
+        self.env = env
+        self.passFds = passFds
+        self.lineCallback = lineCallback
+        self.onStart = onStart
+        self.process = None
+        self.retCode = None
+        self.cancelled = False
+        self._lines = collections.deque(maxlen=tailLines)
+        self.stats = {'bytesRead': 0, 'wakeups': 0}
+        self.resources = {}
+
+    def terminate(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGTERM)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    def cancel(self):
+        self.cancelled = True
+        if self.process is not None and self.process.returncode is None:
+            self.terminate()
+
+    async def _wait(self):
+        '''
+        Waits for the command to exit without tying up a thread, then reaps it (wait4 returns at once by
+        then): a pidfd turns readable when the command exits. Without pidfds (Linux < 5.3) a thread of
+        this call's own waits instead, never one of the loop's shared executor.
+        '''
+        loop = asyncio.get_running_loop()
+        exited = loop.create_future()
+
+        def onExit():
+            if not exited.done():
+                exited.set_result(None)
+
+        try:
+            pidfd = os.pidfd_open(self.process.pid)
+        except (AttributeError, OSError):
+            pidfd = None
+        if pidfd is not None:
+            loop.add_reader(pidfd, onExit)
+        else:
+            def waitForExit():
+                try:
+                    os.waitid(os.P_PID, self.process.pid, os.WEXITED | os.WNOWAIT)
+                except ChildProcessError:
+                    pass
+                loop.call_soon_threadsafe(onExit)
+            waiter = threading.Thread(target=waitForExit, name='ginst-reaper')
+            waiter.daemon = True
+            waiter.start()
+        try:
+            await exited
+        finally:
+            if pidfd is not None:
+                loop.remove_reader(pidfd)
+                os.close(pidfd)
+        return self._reap()
+
+    async def run(self):
+        logger.debug("About to call %s" % self.cmd)
+        loop = asyncio.get_running_loop()
+        startWall = time.time()
+        log = self._openLog()
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._pending = ''
+        env = dict(os.environ, **self.env) if self.env else None
+        transport = None
+        try:
+            # a plain Popen reaped by SystemCall._reap (wait4) rather than asyncio's child watcher, so the
+            # call's CPU time, peak RSS and I/O are accounted like a blocking SystemCall's
+            self.process = subprocess.Popen(self.cmd, shell=True, stderr=subprocess.STDOUT, stdout=subprocess.PIPE,
+                                            cwd=self.cwd, env=env, pass_fds=self.passFds, start_new_session=True)
+            if self.onStart is not None:
+                self.onStart(self.process.pid)
+            if self.cancelled:
+                self.terminate()
+            reaper = asyncio.ensure_future(self._wait())
+            try:
+                reader = asyncio.StreamReader(limit=self.READ_SIZE, loop=loop)
+                transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader, loop=loop), self.process.stdout)
+                while True:
+                    chunk = await reader.read(self.READ_SIZE)
+                    self.stats['wakeups'] += 1
+                    self._feed(chunk, log)
+                    if not chunk:
+                        break
+                self.retCode = await asyncio.shield(reaper)
+            except asyncio.CancelledError:
+                self.cancel()
+                self.retCode = await asyncio.shield(reaper)
+                raise
+            except BaseException:
+                self.terminate()
+                self.retCode = await asyncio.shield(reaper)
+                raise
+        finally:
+            if transport is not None:
+                transport.close()
+            if log is not None:
+                log.close()
+            self.resources['wallTime'] = self.stats['wallTime'] = time.time() - startWall
+        logger.debug("... return code: %d" % self.retCode)
+        return self
+
+class HttpConnectionPool(object):
+    REDIRECT_CODES = (301, 302, 303, 307, 308)
+    MAX_REDIRECTS = 5
+
+    def __init__(self, timeout=DOWNLOAD_TIMEOUT):
+        '''
+        Keep-alive http(s) connections shared between threads, so several requests to one host (a HEAD
+        and its ranges, or a handful of small archives) pay for one TCP/TLS handshake instead of one each.
+        Requests that go through a proxy fall back to urllib.
+        '''
+        self.timeout = timeout
+        self._idle = collections.defaultdict(list)
+        self._lock = threading.Lock()
+        self.stats = {'connections': 0, 'requests': 0}
+
+    def _acquire(self, scheme, netloc):
+        with self._lock:
+            self.stats['requests'] += 1
+            if self._idle[(scheme, netloc)]:
+                return self._idle[(scheme, netloc)].pop()
+            self.stats['connections'] += 1
+        connectionClass = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        return connectionClass(netloc, timeout=self.timeout)
+
+    def _release(self, scheme, netloc, connection, response):
+        # only a fully read response leaves the connection ready for the next request
+        if response is not None and response.isclosed() and not response.will_close:
+            with self._lock:
+                self._idle[(scheme, netloc)].append(connection)
+        else:
+            connection.close()
+
+    @contextlib.contextmanager
+    def request(self, method, url, headers=None):
+        '''
+        Sends the request (following redirects) and yields the response; response.url is where it ended up.
+        Raises EnvironmentError for an error status.
+        '''
+        for redirect in range(self.MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            if parts.scheme not in ('http', 'https'):
+                raise EnvironmentError("Unsupported url %s" % url)
+            if urllib.request.getproxies().get(parts.scheme) and not urllib.request.proxy_bypass(parts.hostname):
+                with urllib.request.urlopen(urllib.request.Request(url, headers=headers or {}, method=method), timeout=self.timeout) as response:
+                    yield response
+                return
+
+            path = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+            connection = self._acquire(parts.scheme, parts.netloc)
+            response = None
+            try:
+                try:
+                    connection.request(method, path, headers=headers or {})
+                    response = connection.getresponse()
+                except (http.client.HTTPException, OSError):
+                    # a kept-alive connection the server has since closed, try once more on a fresh one
+                    connection.close()
+                    connection.request(method, path, headers=headers or {})
+                    response = connection.getresponse()
+                response.url = url
+                if response.status in self.REDIRECT_CODES and response.getheader('Location'):
+                    response.read()
+                    url = urllib.parse.urljoin(url, response.getheader('Location'))
+                    continue
+                if response.status >= 400:
+                    response.read()
+                    raise EnvironmentError("HTTP %d %s for %s" % (response.status, response.reason, url))
+                yield response
+                return
+            finally:
+                self._release(parts.scheme, parts.netloc, connection, response)
+        raise EnvironmentError("Too many redirects for %s" % url)
+
+    def close(self):
+        with self._lock:
+            for connections in self._idle.values():
+                for connection in connections:
+                    connection.close()
+            self._idle.clear()
+
+class Downloader(object):
+    CHUNK_SIZE = 256 * 1024
+    STATE_SAVE_INTERVAL = 4 * 1024 * 1024
+
+    def __init__(self, urls, destination, connections=DOWNLOAD_CONNECTIONS, expectedSize=None, checksum=None, algorithm='sha256',
+                 retries=DOWNLOAD_RETRIES, timeout=DOWNLOAD_TIMEOUT, pool=None, cancelEvent=None):
+        '''
+        Downloads urls (a url or a list of mirror urls for the same file, best first) to destination
+        using HTTP Range requests across several connections. A range that fails is retried against
+        the next mirror. Progress is kept in <destination>.part / <destination>.part.json so an
+        interrupted download resumes where it left off.
+        checksum - if given, the expected hex digest of the file (algorithm is any hashlib name, e.g. sha512)
+        pool - an HttpConnectionPool to reuse connections from (otherwise each request opens its own)
+        cancelEvent - a threading.Event; once set the download stops (keeping its progress) with an EnvironmentError
+        '''
+        self.urls = [urls] if isinstance(urls, str) else list(urls)
+        self.url = self.urls[0]
+        self.destination = destination
+        self.connections = max(1, connections)
+        self.expectedSize = expectedSize
+        self.checksum = checksum
+        self.algorithm = algorithm
+        self.retries = retries
+        self.timeout = timeout
+        self.pool = pool
+        self.cancelEvent = cancelEvent
+        self.partPath = destination + '.part'
+        self.statePath = destination + '.part.json'
+        self.stats = {}
+        self._lock = threading.Lock()
+        self._unsavedBytes = 0
+        self._resolved = {}
+        self._size = None
+        self.failedMirrors = set()
+
+    def _isCancelled(self):
+        return self.cancelEvent is not None and self.cancelEvent.is_set()
+
+    def _checkCancelled(self):
+        if self._isCancelled():
+            raise EnvironmentError("Download of %s was cancelled" % self.url)
+
+    def _backOff(self, seconds):
+        if self.cancelEvent is not None:
+            self.cancelEvent.wait(seconds)
+        else:
+            time.sleep(seconds)
+
+    def _open(self, url, method='GET', headers=None):
+        if self.pool is not None:
+            return self.pool.request(method, url, headers=headers)
+        return urllib.request.urlopen(urllib.request.Request(url, headers=headers or {}, method=method), timeout=self.timeout)
+
+    def _probe(self, url):
+        with self._open(url, method='HEAD') as response:
+            size = response.headers.get('Content-Length')
+            acceptsRanges = response.headers.get('Accept-Ranges', '').lower() == 'bytes'
+            response.read()
+            # pin the redirect target so every connection hits the same mirror
+            return response.url, int(size) if size is not None else None, acceptsRanges
+
+    def _resolveMirror(self, index):
+        '''
+        Returns the pinned url for mirror index, or None if it is unreachable or serves a different file
+        '''
+        with self._lock:
+            if index in self._resolved:
+                return self._resolved[index]
+        try:
+            url, size, acceptsRanges = self._probe(self.urls[index])
+            if size != self._size or not acceptsRanges:
+                url = None
+        except Exception as ex:
+            logger.debug("mirror %s is unusable: %s" % (self.urls[index], ex))
+            url = None
+        with self._lock:
+            self._resolved[index] = url
+        return url
+
+    def _mirrorForAttempt(self, attempt):
+        for offset in range(len(self.urls)):
+            index = (attempt + offset) % len(self.urls)
+            url = self._resolveMirror(index)
+            if url is not None:
+                return index, url
+        raise EnvironmentError("No usable mirror for %s" % self.url)
+
+    def _loadState(self, size):
+        try:
+            with open(self.statePath, 'r') as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if state.get('resource') != self._resourceName() or state.get('size') != size or not os.path.isfile(self.partPath) \
+                or os.path.getsize(self.partPath) != size:
+            return None
+        return state
+
+    def _resourceName(self):
+        return os.path.basename(urllib.parse.urlsplit(self.url).path)
+
+    def _saveState(self):
+        _atomicWriteJson(self.statePath, self._state)
+
+    def _newState(self, size):
+        with open(self.partPath, 'wb') as f:
+            f.truncate(size)
+        step = -(-size // self.connections)
+        ranges = [[start, min(start + step, size) - 1, 0] for start in range(0, size, step)]
+        return {'resource': self._resourceName(), 'size': size, 'ranges': ranges}
+
+    def _fetchRange(self, fd, rangeEntry, firstAttempt):
+        for attempt in range(self.retries):
+            self._checkCancelled()
+            start, end, done = rangeEntry
+            if start + done > end:
+                return
+            index, url = self._mirrorForAttempt(firstAttempt + attempt)
+            try:
+                with self._open(url, headers={'Range': 'bytes=%d-%d' % (start + done, end)}) as response:
+                    if response.status != 206:
+                        raise EnvironmentError("server ignored range request (status %d)" % response.status)
+                    while start + rangeEntry[2] <= end:
+                        self._checkCancelled()
+                        chunk = response.read(min(self.CHUNK_SIZE, end - start - rangeEntry[2] + 1))
+                        if not chunk:
+                            raise EnvironmentError("connection closed early")
+                        os.pwrite(fd, chunk, start + rangeEntry[2])
+                        with self._lock:
+                            rangeEntry[2] += len(chunk)
+                            self._unsavedBytes += len(chunk)
+                            if self._unsavedBytes >= self.STATE_SAVE_INTERVAL:
+                                self._unsavedBytes = 0
+                                self._saveState()
+                return
+            except Exception as ex:
+                self._checkCancelled()
+                logger.debug("range %d-%d try %d / %d from %s failed: %s" % (start, end, attempt + 1, self.retries, url, ex))
+                self.failedMirrors.add(self.urls[index])
+                if attempt % len(self.urls) == len(self.urls) - 1:
+                    # every mirror failed this round, back off before the next one
+                    self._backOff(min(2 ** attempt, 30))
+        raise EnvironmentError("Failed to download bytes %d-%d of %s" % (rangeEntry[0], rangeEntry[1], self.url))
+
+    def _downloadRanges(self, firstMirror):
+        self._state = self._loadState(self._size)
+        if self._state is None:
+            self._state = self._newState(self._size)
+        else:
+            logger.info("Resuming partial download of %s" % self.url)
+        resumedBytes = sum(r[2] for r in self._state['ranges'])
+
+        fd = os.open(self.partPath, os.O_WRONLY)
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.connections) as pool:
+                futures = [pool.submit(self._fetchRange, fd, r, firstMirror) for r in self._state['ranges']]
+                try:
+                    for future in futures:
+                        future.result()
+                finally:
+                    with self._lock:
+                        self._saveState()
+        finally:
+            os.close(fd)
+        return self._size - resumedBytes
+
+    def _downloadStream(self):
+        for attempt in range(self.retries):
+            self._checkCancelled()
+            url = self.urls[attempt % len(self.urls)]
+            try:
+                transferred = 0
+                with self._open(url) as response, open(self.partPath, 'wb') as f:
+                    while True:
+                        self._checkCancelled()
+                        chunk = response.read(self.CHUNK_SIZE)
+                        if not chunk:
+                            return transferred
+                        f.write(chunk)
+                        transferred += len(chunk)
+            except Exception as ex:
+                self._checkCancelled()
+                logger.debug("download try %d / %d from %s failed: %s" % (attempt + 1, self.retries, url, ex))
+                self._backOff(min(2 ** attempt, 30))
+        raise EnvironmentError("Failed to download %s" % self.url)
+
+    def _verify(self):
+        size = os.path.getsize(self.partPath)
+        if self.expectedSize is not None and size != self.expectedSize:
+            error = "Downloaded size %d does not match the expected %d" % (size, self.expectedSize)
+        elif self.checksum is not None and _hashFile(self.partPath, self.algorithm) != self.checksum:
+            error = "Checksum mismatch for %s" % self.url
+        else:
+            return
+        # a bad file must not be resumed from next time
+        for path in (self.partPath, self.statePath):
+            if os.path.exists(path):
+                os.remove(path)
+        raise EnvironmentError(error)
+
+    def download(self):
+        self._checkCancelled()
+        start = time.time()
+        acceptsRanges = False
+        for index, mirror in enumerate(self.urls):
+            try:
+                url, self._size, acceptsRanges = self._probe(mirror)
+                break
+            except Exception as ex:
+                logger.debug("mirror %s is unusable: %s" % (mirror, ex))
+        else:
+            raise EnvironmentError("None of the mirrors for %s are reachable" % self.url)
+        if self.expectedSize is not None and self._size is not None and self._size != self.expectedSize:
+            raise EnvironmentError("Server reports %d bytes but %d were expected" % (self._size, self.expectedSize))
+
+        if self._size and acceptsRanges:
+            self._resolved[index] = url
+            logger.debug("Downloading %s (%d bytes) over %d connections" % (url, self._size, self.connections))
+            transferred = self._downloadRanges(index)
+        else:
+            logger.debug("Server does not support ranges, downloading %s in a single stream" % url)
+            transferred = self._downloadStream()
+
+        self._verify()
+        os.replace(self.partPath, self.destination)
+        if os.path.exists(self.statePath):
+            os.remove(self.statePath)
+
+        elapsed = time.time() - start
+        self.stats = {'bytes': transferred, 'seconds': elapsed,
+                      'mbPerSecond': transferred / elapsed / (1024 * 1024) if elapsed else 0.0}
+        logger.info("Downloaded %.1f MB in %.1fs (%.2f MB/s)" % (transferred / (1024.0 * 1024), elapsed, self.stats['mbPerSecond']))
+        return self.destination
+
+class MirrorRanker(object):
+    PROBE_BYTES = 256 * 1024
+
+    def __init__(self, rankingPath=GCC_MIRROR_RANKING_PATH, halfLife=MIRROR_RANKING_HALF_LIFE,
+                 reprobeInterval=MIRROR_REPROBE_INTERVAL, timeout=MIRROR_PROBE_TIMEOUT):
+        '''
+        Orders mirrors by measured bandwidth. Each probe is a small Range request; scores are
+        persisted per host in rankingPath and decay with the given half life (seconds) so old
+        measurements count for less than fresh ones.
+        '''
+        self.rankingPath = rankingPath
+        self.halfLife = halfLife
+        self.reprobeInterval = reprobeInterval
+        self.timeout = timeout
+
+    @classmethod
+    def _host(cls, url):
+        return urllib.parse.urlsplit(url).netloc
+
+    def _load(self):
+        try:
+            with open(self.rankingPath, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _save(self, ranking):
+        _atomicWriteJson(self.rankingPath, ranking, sortKeys=True)
+
+    def _decayedScore(self, entry, now):
+        age = max(0.0, now - entry['updated'])
+        return entry['score'] * 0.5 ** (age / self.halfLife)
+
+    def probe(self, url):
+        '''
+        Returns (latency seconds, bytes per second) for url, or None if the probe failed
+        '''
+        start = time.time()
+        try:
+            request = urllib.request.Request(url, headers={'Range': 'bytes=0-%d' % (self.PROBE_BYTES - 1)})
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                latency = time.time() - start
+                received = len(response.read(self.PROBE_BYTES))
+        except Exception as ex:
+            logger.debug("probe of %s failed: %s" % (url, ex))
+            return None
+        elapsed = time.time() - start
+        return latency, received / elapsed if elapsed else float(received)
+
+    def record(self, ranking, url, result, now):
+        host = self._host(url)
+        measured = 0.0 if result is None else result[1]
+        entry = ranking.get(host)
+        if entry is not None:
+            # blend with the decayed history so one lucky or unlucky probe doesn't flip the order
+            measured = 0.5 * measured + 0.5 * self._decayedScore(entry, now)
+        ranking[host] = {'score': measured, 'latency': None if result is None else result[0], 'updated': now,
+                         'probed': now}
+
+    def recordFailures(self, urls):
+        '''
+        Marks mirrors that failed mid-download so they drop in the ranking
+        '''
+        if not urls:
+            return
+        now = time.time()
+        ranking = self._load()
+        for url in urls:
+            self.record(ranking, url, None, now)
+        self._save(ranking)
+
+    def rank(self, urls):
+        '''
+        Returns urls ordered fastest first, probing (concurrently) those without a recent measurement
+        '''
+        now = time.time()
+        ranking = self._load()
+        stale = [u for u in urls if now - ranking.get(self._host(u), {}).get('probed', 0) > self.reprobeInterval]
+        if stale:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(stale)) as pool:
+                results = list(pool.map(self.probe, stale))
+            for url, result in zip(stale, results):
+                self.record(ranking, url, result, now)
+            self._save(ranking)
+
+        def score(url):
+            entry = ranking.get(self._host(url))
+            return self._decayedScore(entry, now) if entry else 0.0
+        ranked = sorted(urls, key=score, reverse=True)
+        logger.debug("Mirror ranking: %s" % ', '.join('%s (%.2f MB/s)' % (self._host(u), score(u) / (1024 * 1024)) for u in ranked))
+        return ranked
+
+class ParallelExtractor(object):
+    BATCH_BYTES = 4 * 1024 * 1024
+    BATCH_FILES = 256
+
+    def __init__(self, destinationFolder, threads=EXTRACT_THREADS, cancelEvent=None):
+        '''
+        Writes the members of a tar stream into destinationFolder: decompression happens in the
+        calling thread while small files are written out in batches by a pool of threads.
+        Setting cancelEvent (a threading.Event) stops the extraction with an EnvironmentError.
+        '''
+        self.destinationFolder = destinationFolder
+        self.threads = max(1, threads)
+        self.cancelEvent = cancelEvent
+        self.stats = {}
+
+    @classmethod
+    def findParallelDecompressor(cls, magic):
+        '''
+        Returns an installed decompressor command usable with tar -I for an archive starting with magic, or None
+        '''
+        for prefix, commands in PARALLEL_DECOMPRESSORS:
+            if magic.startswith(prefix):
+                for command in commands:
+                    if HostProfile.get().which(command.split()[0]):
+                        return command
+        return None
+
+    @classmethod
+    def getParallelDecompressor(cls, archivePath):
+        with open(archivePath, 'rb') as f:
+            return cls.findParallelDecompressor(f.read(6))
+
+    def _targetPath(self, member):
+        root = os.path.normpath(self.destinationFolder)
+        path = os.path.normpath(os.path.join(root, member.name))
+        # the folder itself is fine as a directory ('./', which tar -C <folder> . writes first)
+        inside = path.startswith(root + os.sep) or (path == root and member.isdir())
+        if os.path.isabs(member.name) or not inside:
+            raise EnvironmentError("Refusing to extract %s outside of %s" % (member.name, self.destinationFolder))
+        return path
+
+    @classmethod
+    def _writeBatch(cls, batch):
+        for path, data, mode, mtime in batch:
+            with open(path, 'wb') as f:
+                f.write(data)
+            os.chmod(path, mode)
+            os.utime(path, (mtime, mtime))
+
+    def extractFrom(self, tar):
+        start = time.time()
+        self.stats = {'files': 0, 'bytes': 0}
+        links = []
+        batch = []
+        batchBytes = 0
+        pending = []
+        # bounds how many batches are held in memory waiting for a writer
+        slots = threading.BoundedSemaphore(self.threads * 2)
+
+        def submit(pool, batch):
+            slots.acquire()
+            future = pool.submit(self._writeBatch, batch)
+            future.add_done_callback(lambda f: slots.release())
+            pending.append(future)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.threads) as pool:
+            for member in tar:
+                if self.cancelEvent is not None and self.cancelEvent.is_set():
+                    raise EnvironmentError("Extraction into %s was cancelled" % self.destinationFolder)
+                path = self._targetPath(member)
+                if member.isdir():
+                    if not os.path.isdir(path):
+                        os.makedirs(path)
+                elif member.isfile():
+                    parent = os.path.dirname(path)
+                    if not os.path.isdir(parent):
+                        os.makedirs(parent)
+                    data = tar.extractfile(member).read()
+                    batch.append((path, data, member.mode & 0o7777, member.mtime))
+                    batchBytes += len(data)
+                    self.stats['files'] += 1
+                    self.stats['bytes'] += len(data)
+                    if batchBytes >= self.BATCH_BYTES or len(batch) >= self.BATCH_FILES:
+                        submit(pool, batch)
+                        batch, batchBytes = [], 0
+                elif member.issym() or member.islnk():
+                    links.append((path, member))
+            if batch:
+                submit(pool, batch)
+            for future in pending:
+                future.result()
+
+        # links go last so hard link targets are already on disk
+        for path, member in links:
+            if os.path.lexists(path):
+                os.remove(path)
+            if member.issym():
+                os.symlink(member.linkname, path)
+            else:
+                os.link(self._targetPath(tarfile.TarInfo(member.linkname)), path)
+
+        elapsed = time.time() - start
+        self.stats['seconds'] = elapsed
+        self.stats['mbPerSecond'] = self.stats['bytes'] / elapsed / (1024 * 1024) if elapsed else 0.0
+        logger.info("Extracted %d files (%.1f MB) in %.1fs (%.2f MB/s)" % (self.stats['files'],
+                    self.stats['bytes'] / (1024.0 * 1024), elapsed, self.stats['mbPerSecond']))
+
+    def extract(self, archivePath):
+        try:
+            with tarfile.open(archivePath, mode='r|*') as tar:
+                self.extractFrom(tar)
+        except tarfile.TarError as ex:
+            raise EnvironmentError("Unable to extract %s: %s" % (archivePath, ex))
+
+class StreamingExtractor(object):
+    CHUNK_SIZE = 256 * 1024
+
+    def __init__(self, url, destinationFolder, teePath=None, checksum=None, algorithm='sha256', timeout=DOWNLOAD_TIMEOUT,
+                 cancelEvent=None):
+        '''
+        Extracts the tarball at url into destinationFolder while it downloads: the response body is piped
+        into tar (optionally teeing it into teePath), which decompresses and writes out the files as the
+        chunks arrive. With checksum set the streamed bytes are hashed as well (algorithm is any hashlib
+        name) and a mismatch fails the run, after extraction; the caller should discard what was written.
+        Setting cancelEvent stops the download and tar.
+        '''
+        self.url = url
+        self.destinationFolder = destinationFolder
+        self.teePath = teePath
+        self.checksum = checksum
+        self.algorithm = algorithm
+        self.timeout = timeout
+        self.cancelEvent = cancelEvent
+        self.stats = {}
+
+    @classmethod
+    def getTarOptions(cls, magic):
+        '''
+        Returns the options tar needs to decompress an archive starting with magic (it can't tell from a pipe)
+        '''
+        decompressor = ParallelExtractor.findParallelDecompressor(magic)
+        if decompressor is not None:
+            return ['-I', decompressor]
+        for prefix, option in TAR_DECOMPRESS_OPTIONS:
+            if magic.startswith(prefix):
+                return [option]
+        return []
+
+    def _startTar(self, magic, output):
+        if not os.path.isdir(self.destinationFolder):
+            os.makedirs(self.destinationFolder)
+        command = ['tar'] + self.getTarOptions(magic) + ['-xf', '-', '-C', self.destinationFolder]
+        logger.debug("Streaming %s into %s" % (self.url, ' '.join(command)))
+        return subprocess.Popen(command, stdin=subprocess.PIPE, stdout=output, stderr=subprocess.STDOUT)
+
+    def _pipe(self, tarOutput, tee, digest):
+        '''
+        Copies the response body into tar (and tee), returning the tar process
+        '''
+        tar = None
+        try:
+            with urllib.request.urlopen(self.url, timeout=self.timeout) as response:
+                while True:
+                    if self.cancelEvent is not None and self.cancelEvent.is_set():
+                        raise EnvironmentError("Streaming download of %s was cancelled" % self.url)
+                    chunk = response.read(self.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if tar is None:
+                        tar = self._startTar(chunk, tarOutput)
+                    self.stats['bytes'] += len(chunk)
+                    if tee is not None:
+                        tee.write(chunk)
+                    if digest is not None:
+                        digest.update(chunk)
+                    tar.stdin.write(chunk)
+        except BrokenPipeError:
+            # tar gave up on the archive, its exit status and output say why
+            pass
+        except BaseException:
+            if tar is not None:
+                tar.kill()
+                tar.wait()
+            raise
+        return tar
+
+    def run(self):
+        start = time.time()
+        self.stats = {'bytes': 0}
+        digest = hashlib.new(self.algorithm) if self.checksum is not None else None
+        with tempfile.TemporaryFile() as tarOutput:
+            tee = open(self.teePath, 'wb') if self.teePath is not None else None
+            try:
+                tar = self._pipe(tarOutput, tee, digest)
+            except EnvironmentError:
+                raise
+            except Exception as ex:
+                raise EnvironmentError("Streaming download of %s failed: %s" % (self.url, ex))
+            finally:
+                if tee is not None:
+                    tee.close()
+            if tar is None:
+                raise EnvironmentError("%s is empty" % self.url)
+            try:
+                tar.stdin.close()
+            except BrokenPipeError:
+                pass
+            if tar.wait() != 0:
+                tarOutput.seek(0)
+                raise EnvironmentError("Unable to extract %s: %s" % (self.url, tarOutput.read().decode('utf-8', 'replace').strip()))
+        if digest is not None and digest.hexdigest() != self.checksum:
+            raise EnvironmentError("Checksum mismatch for %s" % self.url)
+
+        elapsed = time.time() - start
+        self.stats['seconds'] = elapsed
+        self.stats['mbPerSecond'] = self.stats['bytes'] / elapsed / (1024 * 1024) if elapsed else 0.0
+        logger.info("Downloaded and extracted %.1f MB in %.1fs (%.2f MB/s)"
+                    % (self.stats['bytes'] / (1024.0 * 1024), elapsed, self.stats['mbPerSecond']))
+        return self.destinationFolder
+
+class SourceCache(object):
+    def __init__(self, folder=GCC_SOURCE_CACHE_FOLDER, maxBytes=GCC_SOURCE_CACHE_MAX_BYTES):
+        '''
+        A content-addressed store of source archives: objects/<sha256> holds the data and
+        index.json maps archive names (e.g. gcc-10.4.0.tar.gz) to their checksum.
+        Least recently used objects are evicted once the cache grows past maxBytes.
+        '''
+        self.folder = folder
+        self.maxBytes = maxBytes
+        self.objectsFolder = os.path.join(folder, 'objects')
+        self.downloadsFolder = os.path.join(folder, 'downloads')
+        self.indexPath = os.path.join(folder, 'index.json')
+        for folder in (self.objectsFolder, self.downloadsFolder):
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+
+    @contextlib.contextmanager
+    def _locked(self, name='index'):
+        with open(os.path.join(self.folder, '.%s.lock' % name), 'a') as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+    def lockEntry(self, name):
+        '''
+        Serializes work on a single archive name across processes (e.g. two runs downloading the same version)
+        '''
+        return self._locked('entry-%s' % name)
+
+    def _readIndex(self):
+        try:
+            with open(self.indexPath, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _writeIndex(self, index):
+        _atomicWriteJson(self.indexPath, index, sortKeys=True)
+
+    def _objectPath(self, sha256):
+        return os.path.join(self.objectsFolder, sha256)
+
+    def getDownloadPath(self, name):
+        return os.path.join(self.downloadsFolder, name)
+
+    def get(self, name):
+        '''
+        Returns the path to the cached archive for name, or None on a miss or a corrupt entry
+        '''
+        with self._locked():
+            index = self._readIndex()
+            entry = index.get(name)
+            if entry is None:
+                return None
+            path = self._objectPath(entry['sha256'])
+            if not os.path.isfile(path) or os.path.getsize(path) != entry['size'] or _hashFile(path) != entry['sha256']:
+                logger.warning("Dropping missing/corrupt cache entry for %s" % name)
+                del index[name]
+                self._writeIndex(index)
+                if os.path.isfile(path):
+                    os.remove(path)
+                return None
+            # mtime doubles as the last-used time for LRU eviction
+            os.utime(path, None)
+            return path
+
+    def put(self, name, path):
+        '''
+        Moves the file at path into the cache under name and returns its cached path
+        '''
+        sha256 = _hashFile(path)
+        objectPath = self._objectPath(sha256)
+        tmpPath = '%s.%d.%d.tmp' % (objectPath, os.getpid(), threading.get_ident())
+        shutil.move(path, tmpPath)
+        os.replace(tmpPath, objectPath)
+        with self._locked():
+            index = self._readIndex()
+            index[name] = {'sha256': sha256, 'size': os.path.getsize(objectPath)}
+            self._writeIndex(index)
+            self._evict(index, keep=objectPath)
+        return objectPath
+
+    def _evict(self, index, keep=None):
+        objects = []
+        for sha256 in os.listdir(self.objectsFolder):
+            path = self._objectPath(sha256)
+            if path.endswith('.tmp'):
+                continue
+            stat = os.stat(path)
+            objects.append((stat.st_mtime, stat.st_size, path, sha256))
+        totalBytes = sum(o[1] for o in objects)
+        for mtime, size, path, sha256 in sorted(objects):
+            if totalBytes <= self.maxBytes:
+                break
+            if path == keep:
+                continue
+            logger.info("Evicting %s from the source cache" % sha256)
+            os.remove(path)
+            totalBytes -= size
+            for name in [n for n, e in index.items() if e['sha256'] == sha256]:
+                del index[name]
+        self._writeIndex(index)
+
+class ArtifactStore(object):
+    # a file directly in the store; no hidden files and no path separators
+    NAME_REGEX = re.compile(r'^[\w+-][\w.+-]*$')
+    DESCRIPTION_FIELDS = ('version', 'profile', 'configureArguments', 'glibc', 'triple')
+
+    def __init__(self, folder=GCC_ARTIFACT_FOLDER, servers=()):
+        '''
+        Prebuilt gcc installs, packaged as compressed tarballs of the install prefix (gcc finds its own
+        files relative to the driver, so they can be unpacked anywhere). <key>.json is the manifest:
+        what the build targets (version, configure arguments, glibc and host triple, which the key
+        hashes) plus the archive's name, size and sha256.
+        servers - base urls of ArtifactServers to fetch artifacts missing locally from
+        '''
+        self.folder = folder
+        self.servers = [server.rstrip('/') for server in servers]
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+    @classmethod
+    def getBuildDescription(cls, gccVersion):
+        return {
+            'version': gccVersion.rawVersionString,
+            'profile': gccVersion.profile,
+            'configureArguments': gccVersion.getConfigureArguments(includePrerequisites=False),
+            'glibc': HostProfile.get().getGlibcVersion(),
+            'triple': GCC_TRIPLE,
+        }
+
+    @classmethod
+    def getKey(cls, description):
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def getManifestPath(self, key):
+        return os.path.join(self.folder, '%s.json' % key)
+
+    @classmethod
+    def isValidName(cls, name):
+        return isinstance(name, str) and cls.NAME_REGEX.match(name) is not None
+
+    @classmethod
+    def isValidManifest(cls, manifest, key):
+        '''
+        Checks a manifest from elsewhere: it must be for key (and describe the build that key hashes) and
+        name an archive inside the store
+        '''
+        if not isinstance(manifest, dict) or manifest.get('key') != key or not cls.isValidName(manifest.get('archive')):
+            return False
+        return cls.getKey(dict((field, manifest.get(field)) for field in cls.DESCRIPTION_FIELDS)) == key
+
+    @classmethod
+    def canUnpack(cls, archive):
+        '''
+        tarfile reads gzip, bzip2 and xz itself, but zstd archives need the zstd tool
+        '''
+        return not archive.endswith('.tar.zst') or HostProfile.get().which('zstd') is not None
+
+    def find(self, gccVersion, cancelEvent=None):
+        '''
+        Returns the manifest of an artifact built for this version on a host like this one, or None
+        '''
+        key = self.getKey(self.getBuildDescription(gccVersion))
+        try:
+            with open(self.getManifestPath(key), 'r') as f:
+                manifest = json.load(f)
+            if os.path.isfile(os.path.join(self.folder, manifest['archive'])):
+                if self.canUnpack(manifest['archive']):
+                    return manifest
+                logger.info("Skipping the prebuilt %s, unpacking it needs zstd" % manifest['archive'])
+        except (IOError, ValueError):
+            pass
+        if self.servers:
+            return self._fetch(key, cancelEvent)
+        return None
+
+    def _fetch(self, key, cancelEvent=None):
+        '''
+        Downloads the artifact for key from whichever servers have it (as mirrors of each other, over
+        parallel range requests) into the local store and returns its manifest, or None
+        '''
+        manifest = None
+        holders = []
+        for server in self.servers:
+            try:
+                with urllib.request.urlopen('%s/artifacts/%s.json' % (server, key), timeout=ARTIFACT_SERVER_TIMEOUT) as response:
+                    serverManifest = json.loads(response.read().decode())
+            except Exception as ex:
+                logger.debug("artifact server %s has no %s: %s" % (server, key, ex))
+                continue
+            if not self.isValidManifest(serverManifest, key):
+                logger.warning("Ignoring an invalid manifest for %s from artifact server %s" % (key, server))
+                continue
+            if not self.canUnpack(serverManifest['archive']):
+                logger.info("Skipping the prebuilt %s on %s, unpacking it needs zstd" % (serverManifest['archive'], server))
+                continue
+            if manifest is None:
+                manifest = serverManifest
+            if serverManifest.get('sha256') == manifest['sha256']:
+                holders.append(server)
+        if manifest is None:
+            return None
+
+        logger.info("Fetching prebuilt %s (%.1f MB) from %s" % (manifest['archive'], manifest['size'] / (1024.0 * 1024), ', '.join(holders)))
+        downloader = Downloader(['%s/artifacts/%s' % (server, manifest['archive']) for server in holders],
+                                os.path.join(self.folder, manifest['archive']), expectedSize=manifest['size'], checksum=manifest['sha256'],
+                                cancelEvent=cancelEvent)
+        try:
+            downloader.download()
+        except EnvironmentError as ex:
+            logger.warning("Unable to fetch the prebuilt gcc: %s" % ex)
+            return None
+        _atomicWriteJson(self.getManifestPath(key), manifest, sortKeys=True)
+        return manifest
+
+    def package(self, gccVersion, prefix, runCommand=_runCheckedCommand):
+        '''
+        Compresses the install prefix into the store and returns its manifest. runCommand runs tar, as
+        runCommand(command, step, failureMessage), raising EnvironmentError if it fails.
+        '''
+        description = self.getBuildDescription(gccVersion)
+        key = self.getKey(description)
+        for tool, extension, compressor in ARTIFACT_COMPRESSORS:
+            if HostProfile.get().which(tool):
+                break
+        else:
+            raise EnvironmentError("Packaging needs one of %s" % ', '.join(c[0] for c in ARTIFACT_COMPRESSORS))
+
+        archive = '%s-%s%s' % (gccVersion.getBuildName(), key[:12], extension)
+        archivePath = os.path.join(self.folder, archive)
+        tmpPath = '%s.%d.%d.tmp' % (archivePath, os.getpid(), threading.get_ident())
+        logger.info("Packaging %s into %s" % (prefix, archivePath))
+        start = time.time()
+        try:
+            runCommand("tar -I '%s' -cf %s -C %s ." % (compressor, tmpPath, prefix), 'package', "Unable to package %s" % prefix)
+        except EnvironmentError:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            raise
+        os.replace(tmpPath, archivePath)
+
+        manifest = dict(description, key=key, archive=archive, size=os.path.getsize(archivePath), sha256=_hashFile(archivePath),
+                        prefix=prefix, created=time.time())
+        _atomicWriteJson(self.getManifestPath(key), manifest, sortKeys=True)
+        logger.info("Packaged %.1f MB in %.0fs" % (manifest['size'] / (1024.0 * 1024), time.time() - start))
+        return manifest
+
+    @classmethod
+    def _relocate(cls, oldPrefix, prefix):
+        '''
+        Points the absolute libdir paths libtool recorded in .la files at the new prefix
+        '''
+        for root, dirs, files in os.walk(prefix):
+            for name in files:
+                if not name.endswith('.la'):
+                    continue
+                path = os.path.join(root, name)
+                with open(path, 'r') as f:
+                    content = f.read()
+                if oldPrefix in content:
+                    with open(path, 'w') as f:
+                        f.write(content.replace(oldPrefix, prefix))
+
+    def unpack(self, manifest, prefix, runCommand=_runCheckedCommand, cancelEvent=None):
+        if not self.isValidName(manifest.get('archive')):
+            raise EnvironmentError("Invalid artifact archive name %r" % manifest.get('archive'))
+        archivePath = os.path.join(self.folder, manifest['archive'])
+        if _hashFile(archivePath) != manifest['sha256']:
+            raise EnvironmentError("Checksum mismatch for %s" % archivePath)
+        if not os.path.isdir(prefix):
+            os.makedirs(prefix)
+        logger.info("Unpacking %s into %s" % (archivePath, prefix))
+        decompressor = ParallelExtractor.getParallelDecompressor(archivePath)
+        if decompressor is not None:
+            runCommand("tar -I '%s' -xf %s -C %s" % (decompressor, archivePath, prefix), 'unpack', "Unable to unpack %s" % archivePath)
+        else:
+            ParallelExtractor(prefix, cancelEvent=cancelEvent).extract(archivePath)
+        if manifest.get('prefix') and os.path.normpath(manifest['prefix']) != os.path.normpath(prefix):
+            self._relocate(os.path.normpath(manifest['prefix']), os.path.normpath(prefix))
+
+class _ArtifactRequestHandler(http.server.BaseHTTPRequestHandler):
+    PATH_REGEX = re.compile(r'^/artifacts/([^/]+)$')
+
+    def log_message(self, format, *args):
+        logger.debug("artifact server: %s - %s" % (self.address_string(), format % args))
+
+    def do_HEAD(self):
+        self._send(False)
+
+    def do_GET(self):
+        self._send(True)
+
+    def _send(self, body):
+        match = self.PATH_REGEX.match(self.path)
+        path = os.path.join(self.server.store.folder, match.group(1)) if match and ArtifactStore.isValidName(match.group(1)) else None
+        if path is None or not os.path.isfile(path):
+            self.send_error(404)
+            return
+
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        rangeMatch = re.match(r'^bytes=(\d*)-(\d*)$', self.headers.get('Range', ''))
+        if rangeMatch and (rangeMatch.group(1) or rangeMatch.group(2)):
+            if rangeMatch.group(1):
+                start = int(rangeMatch.group(1))
+                end = min(int(rangeMatch.group(2)), size - 1) if rangeMatch.group(2) else size - 1
+            else:
+                start = max(0, size - int(rangeMatch.group(2)))
+            if start > end:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % size)
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Type', 'application/json' if path.endswith('.json') else 'application/octet-stream')
+        self.end_headers()
+        if body:
+            with open(path, 'rb') as f:
+                # sendfile keeps the archive out of userspace
+                self.connection.sendfile(f, offset=start, count=end - start + 1)
+
+class ArtifactServer(object):
+    def __init__(self, store, host='', port=ARTIFACT_SERVER_PORT):
+        '''
+        Serves an ArtifactStore over HTTP (GET/HEAD /artifacts/<name>, with Range support) so other
+        hosts can fetch prebuilt installs from it; one thread per connection
+        '''
+        self.store = store
+        self.httpServer = http.server.ThreadingHTTPServer((host, port), _ArtifactRequestHandler)
+        self.httpServer.daemon_threads = True
+        self.httpServer.store = store
+        self._thread = None
+
+    def getUrl(self):
+        host, port = self.httpServer.server_address[:2]
+        return 'http://%s:%d' % (host if host not in ('', '0.0.0.0') else '127.0.0.1', port)
+
+    def serveForever(self):
+        logger.info("Serving artifacts from %s at %s" % (self.store.folder, self.getUrl()))
+        try:
+            self.httpServer.serve_forever()
+        finally:
+            self.httpServer.server_close()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpServer.serve_forever, name='ginst-artifact-server')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.httpServer.shutdown()
+        self.httpServer.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+class PrerequisiteFetcher(object):
+    PACKAGES = ('gmp', 'mpfr', 'mpc', 'isl')
+    # the archives are a few MB each: one kept-alive connection per archive beats splitting them into ranges
+    CONNECTIONS = 1
+    ARCHIVE_REGEX = re.compile(r"^(gmp|mpfr|mpc|isl)='([^']+)'", re.MULTILINE)
+    BASE_URL_REGEX = re.compile(r"^base_url='([^']+)'", re.MULTILINE)
+
+    def __init__(self, sourcePath, sourceCache, folder=GCC_PREREQ_FOLDER, runCommand=_runCheckedCommand, cancelEvent=None):
+        '''
+        Does what contrib/download_prerequisites does, but concurrently and once per host: the pinned
+        gmp/mpfr/mpc/isl archives are read from the script, fetched in parallel into the source cache,
+        checked against contrib/prerequisites.sha512, unpacked once into folder and symlinked into
+        the source tree. Versions repeat across gcc releases, so most builds download nothing.
+        runCommand runs tar, as runCommand(command, step, failureMessage), raising EnvironmentError if it fails.
+        Setting cancelEvent stops the downloads.
+        '''
+        self.sourcePath = sourcePath
+        self.sourceCache = sourceCache
+        self.folder = folder
+        self.runCommand = runCommand
+        self.cancelEvent = cancelEvent
+
+    def getPrerequisites(self):
+        '''
+        Returns (base url, {package: archive name}) pinned by contrib/download_prerequisites
+        '''
+        try:
+            with open(os.path.join(self.sourcePath, 'contrib', 'download_prerequisites'), 'r') as f:
+                script = f.read()
+        except IOError as ex:
+            raise EnvironmentError("Unable to read contrib/download_prerequisites: %s" % ex)
+        archives = dict(self.ARCHIVE_REGEX.findall(script))
+        baseUrl = self.BASE_URL_REGEX.search(script)
+        if baseUrl is None or not all(package in archives for package in self.PACKAGES):
+            raise EnvironmentError("contrib/download_prerequisites is in an unknown format")
+        # old scripts use ftp, the same tree is served over https
+        return re.sub(r'^ftp://', 'https://', baseUrl.group(1)).rstrip('/') + '/', archives
+
+    def getChecksums(self):
+        checksums = {}
+        try:
+            with open(os.path.join(self.sourcePath, 'contrib', 'prerequisites.sha512'), 'r') as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) == 2:
+                        checksums[fields[1]] = fields[0]
+        except IOError:
+            pass
+        return checksums
+
+    def _fetchOne(self, baseUrl, archive, sha512, pool=None):
+        '''
+        Returns the shared unpacked folder for archive, downloading and unpacking it if needed
+        '''
+        name = re.sub(r'\.tar\.(gz|bz2|xz)$', '', archive)
+        unpackedPath = os.path.join(self.folder, name)
+        with self.sourceCache.lockEntry(archive):
+            if os.path.isdir(unpackedPath):
+                return unpackedPath
+
+            archivePath = self.sourceCache.get(archive)
+            if archivePath is None:
+                logger.info("Downloading %s" % archive)
+                downloadPath = Downloader(baseUrl + archive, self.sourceCache.getDownloadPath(archive), connections=self.CONNECTIONS,
+                                          checksum=sha512, algorithm='sha512', pool=pool, cancelEvent=self.cancelEvent).download()
+                archivePath = self.sourceCache.put(archive, downloadPath)
+
+            tmpFolder = '%s.%d.%d.tmp' % (unpackedPath, os.getpid(), threading.get_ident())
+            try:
+                os.makedirs(tmpFolder)
+                self.runCommand('tar xf %s -C %s' % (archivePath, tmpFolder), 'unpack-%s' % name, "Unable to unpack %s" % archive)
+                if not os.path.isdir(os.path.join(tmpFolder, name)):
+                    raise EnvironmentError("%s does not contain %s/" % (archive, name))
+                os.replace(os.path.join(tmpFolder, name), unpackedPath)
+            finally:
+                shutil.rmtree(tmpFolder, ignore_errors=True)
+            return unpackedPath
+
+    def fetch(self, link=True):
+        '''
+        Makes sure every prerequisite is unpacked in the shared folder and (with link set) links it into
+        the source tree. Returns {package: unpacked folder}.
+        '''
+        baseUrl, archives = self.getPrerequisites()
+        checksums = self.getChecksums()
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+
+        connectionPool = HttpConnectionPool()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.PACKAGES)) as pool:
+                futures = [(package, pool.submit(self._fetchOne, baseUrl, archives[package], checksums.get(archives[package]), connectionPool))
+                           for package in self.PACKAGES]
+                unpacked = dict((package, future.result()) for package, future in futures)
+        finally:
+            connectionPool.close()
+        if connectionPool.stats['requests']:
+            logger.debug("Prerequisite downloads made %(requests)d requests over %(connections)d connections" % connectionPool.stats)
+
+        for package, unpackedPath in unpacked.items():
+            linkPath = os.path.join(self.sourcePath, package)
+            if os.path.islink(linkPath):
+                os.remove(linkPath)
+            if not link:
+                continue
+            if os.path.exists(linkPath):
+                logger.info("Keeping the %s already in the source tree" % package)
+                continue
+            os.symlink(unpackedPath, linkPath)
+        return unpacked
+
+class PrerequisiteBuilder(object):
+    # package -> (packages it is built against, configure option for each of their prefixes), in build order
+    BUILD_ORDER = [
+        ('gmp', ()),
+        ('mpfr', (('gmp', '--with-gmp'),)),
+        ('isl', (('gmp', '--with-gmp-prefix'),)),
+        ('mpc', (('gmp', '--with-gmp'), ('mpfr', '--with-mpfr'))),
+    ]
+    STAMP = '.ginst-complete'
+
+    def __init__(self, sourceCache, folder=GCC_PREREQ_PREFIX_FOLDER, logFolder=None, runCommand=None, jobsFlag=None):
+        '''
+        Builds gmp/mpfr/mpc/isl once per version (and per versions of what they depend on) into shared
+        static prefixes under folder, for gcc builds to use via --with-gmp etc. instead of building
+        them in-tree in every bootstrap stage.
+        runCommand - runs each build as runCommand(command, step, failureMessage, cwd=...), raising
+            EnvironmentError if it fails (GInst passes its jobserver-aware call); by default a SystemCall
+        jobsFlag - the make parallelism flag for runCommand's commands (default -j<cores>)
+        '''
+        self.sourceCache = sourceCache
+        self.folder = folder
+        self.logFolder = logFolder
+        self.runCommand = runCommand or self._runCommand
+        self.jobsFlag = jobsFlag
+
+    def _runCommand(self, command, step, failureMessage, cwd=None):
+        logPath = os.path.join(self.logFolder, '%s.log.gz' % step) if self.logFolder else None
+        return _runCheckedCommand(command, step, failureMessage, cwd=cwd, logPath=logPath)
+
+    @classmethod
+    def _getName(cls, archive):
+        return re.sub(r'\.tar\.(gz|bz2|xz)$', '', archive)
+
+    def getPrefixes(self, archives):
+        '''
+        Returns {package: prefix} for the archives pinned by a gcc release (see PrerequisiteFetcher)
+        '''
+        prefixes = {}
+        for package, dependencies in self.BUILD_ORDER:
+            name = '+'.join([self._getName(archives[package])] + [self._getName(archives[d]) for d, _ in dependencies])
+            prefixes[package] = os.path.join(self.folder, name)
+        return prefixes
+
+    def isBuilt(self, prefix):
+        return os.path.isfile(os.path.join(prefix, self.STAMP))
+
+    def build(self, unpacked, archives):
+        '''
+        Builds whichever prefixes are missing from the unpacked sources and returns {package: prefix}
+        '''
+        prefixes = self.getPrefixes(archives)
+        for package, dependencies in self.BUILD_ORDER:
+            prefix = prefixes[package]
+            with self.sourceCache.lockEntry('prefix-%s' % os.path.basename(prefix)):
+                if self.isBuilt(prefix):
+                    continue
+                logger.info("Building %s into %s" % (os.path.basename(prefix), prefix))
+                shutil.rmtree(prefix, ignore_errors=True)
+                buildPath = '%s.%d.%d.build' % (prefix, os.getpid(), threading.get_ident())
+                os.makedirs(buildPath)
+                options = ' '.join('%s=%s' % (option, prefixes[dependency]) for dependency, option in dependencies)
+                jobsFlag = self.jobsFlag if self.jobsFlag is not None else ' -j%d' % HostProfile.get().getCpuCount()
+                command = '%s/configure --prefix=%s --disable-shared --enable-static --with-pic %s && make%s && make install' \
+                          % (unpacked[package], prefix, options, jobsFlag)
+                try:
+                    self.runCommand(command, 'prerequisite-%s' % package, "Unable to build %s" % os.path.basename(prefix), cwd=buildPath)
+                finally:
+                    shutil.rmtree(buildPath, ignore_errors=True)
+                open(os.path.join(prefix, self.STAMP), 'w').close()
+        return prefixes
+
+class JobServer(object):
+    def __init__(self, slots=None, adaptive=False):
+        '''
+        A GNU make jobserver shared by every make started with getEnvironment()/fds. Each build
+        holds one token for its make's implicit job slot (see slot()), so the total number of
+        running jobs across all builds never exceeds slots. With adaptive set, an
+        AdaptiveJobController withholds tokens while memory is short.
+        '''
+        self.slots = slots or HostProfile.get().getCpuCount()
+        self.readFd, self.writeFd = os.pipe()
+        os.write(self.writeFd, b'+' * self.slots)
+        self.fds = (self.readFd, self.writeFd)
+        self.controller = AdaptiveJobController(self) if adaptive else None
+        self._users = 0
+        self._usersLock = threading.Lock()
+
+    def getEnvironment(self):
+        # --jobserver-fds is the spelling make < 4.2 understands
+        return {'MAKEFLAGS': ' -j --jobserver-auth=%d,%d --jobserver-fds=%d,%d' % (self.readFd, self.writeFd, self.readFd, self.writeFd)}
+
+    def acquire(self):
+        while True:
+            try:
+                return os.read(self.readFd, 1)
+            except InterruptedError:
+                continue
+
+    def release(self, token=b'+'):
+        os.write(self.writeFd, token)
+
+    @contextlib.contextmanager
+    def slot(self):
+        with self._usersLock:
+            self._users += 1
+            if self._users == 1 and self.controller is not None:
+                self.controller.start()
+        token = self.acquire()
+        try:
+            yield
+        finally:
+            self.release(token)
+            with self._usersLock:
+                self._users -= 1
+                if self._users == 0 and self.controller is not None:
+                    self.controller.stop()
+
+    def onMakeOutput(self, line):
+        if self.controller is not None:
+            self.controller.onMakeOutput(line)
+
+    def close(self):
+        if self.controller is not None:
+            self.controller.stop()
+        os.close(self.writeFd)
+        os.close(self.readFd)
+
+class AdaptiveJobController(object):
+    def __init__(self, jobServer, interval=MAKE_JOB_CONTROL_INTERVAL):
+        '''
+        Periodically sizes the jobserver's usable slots to the memory that is actually available:
+        reads /proc/meminfo and /proc/pressure/memory, keeps a running estimate of memory per job
+        (raised during memory heavy phases like LTO) and withholds or returns tokens to match.
+        '''
+        self.jobServer = jobServer
+        self.interval = interval
+        self.target = jobServer.slots
+        self.phase = 'start'
+        self.jobMemory = MAKE_JOB_MEMORY_ESTIMATE
+        self._withheld = 0
+        self._wanted = 0
+        self._condition = threading.Condition()
+        self._stopped = threading.Event()
+        self._monitorThread = None
+        self._withdrawThread = None
+        self._baselineUsed = None
+
+    @classmethod
+    def readMemInfo(cls):
+        info = {}
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                name, value = line.split(':', 1)
+                info[name] = int(value.split()[0]) * 1024
+        return info
+
+    @classmethod
+    def readMemoryPressure(cls):
+        '''
+        Returns the share of the last 10s some task stalled on memory (percent), or None without PSI
+        '''
+        try:
+            with open('/proc/pressure/memory', 'r') as f:
+                for line in f:
+                    if line.startswith('some'):
+                        return float(re.search(r'avg10=([\d.]+)', line).group(1))
+        except (IOError, AttributeError):
+            pass
+        return None
+
+    def start(self):
+        self._stopped.clear()
+        meminfo = self.readMemInfo()
+        self._baselineUsed = meminfo['MemTotal'] - meminfo['MemAvailable']
+        self._monitorThread = threading.Thread(target=self._monitor, name='ginst-job-monitor')
+        self._monitorThread.daemon = True
+        self._monitorThread.start()
+        self._withdrawThread = threading.Thread(target=self._withdraw, name='ginst-job-withdraw')
+        self._withdrawThread.daemon = True
+        self._withdrawThread.start()
+
+    def stop(self):
+        self._stopped.set()
+        with self._condition:
+            self._wanted = 0
+            self._condition.notify_all()
+            while self._withheld:
+                self.jobServer.release()
+                self._withheld -= 1
+        if self._monitorThread is not None:
+            self._monitorThread.join()
+            self._monitorThread = None
+
+    def onMakeOutput(self, line):
+        for name, pattern, heavy in MAKE_PHASES:
+            if pattern.search(line):
+                if name != self.phase:
+                    self.phase = name
+                    logger.info("make phase %s running with -j%d" % (name, self.target))
+                if heavy:
+                    self.jobMemory = max(self.jobMemory, MAKE_HEAVY_JOB_MEMORY_ESTIMATE)
+                return
+
+    def _withdraw(self):
+        # blocking reads happen here so the monitor never stalls waiting for a job to finish
+        while not self._stopped.is_set():
+            with self._condition:
+                while self._withheld >= self._wanted and not self._stopped.is_set():
+                    self._condition.wait()
+                if self._stopped.is_set():
+                    return
+            try:
+                token = self.jobServer.acquire()
+            except OSError:
+                return
+            with self._condition:
+                if not token:
+                    return
+                if self._stopped.is_set() or self._withheld >= self._wanted:
+                    self.jobServer.release(token)
+                else:
+                    self._withheld += 1
+
+    def computeTarget(self, meminfo, pressure):
+        used = max(0, meminfo['MemTotal'] - meminfo['MemAvailable'] - self._baselineUsed)
+        active = max(1, self.target)
+        self.jobMemory = max(MAKE_JOB_MEMORY_ESTIMATE, 0.7 * self.jobMemory + 0.3 * used / active)
+        budget = (meminfo['MemAvailable'] + used) * (1 - MAKE_MEMORY_RESERVE)
+        target = max(1, min(self.jobServer.slots, int(budget / self.jobMemory)))
+        if pressure is not None and pressure > MAKE_MEMORY_PRESSURE_THRESHOLD:
+            target = min(target, max(1, self.target - max(1, self.target // 4)))
+        return target
+
+    def _monitor(self):
+        while not self._stopped.is_set():
+            try:
+                meminfo = self.readMemInfo()
+            except (IOError, KeyError, ValueError):
+                logger.debug("Unable to read /proc/meminfo, leaving make parallelism alone")
+                return
+            pressure = self.readMemoryPressure()
+            target = self.computeTarget(meminfo, pressure)
+            if target != self.target:
+                logger.info("Adjusting make parallelism to -j%d in phase %s (%.1f GB available, ~%.1f GB per job, memory pressure %s)"
+                            % (target, self.phase, meminfo['MemAvailable'] / 1024.0 ** 3, self.jobMemory / 1024.0 ** 3, pressure))
+                self.target = target
+            with self._condition:
+                self._wanted = self.jobServer.slots - self.target
+                while self._withheld > self._wanted:
+                    self.jobServer.release()
+                    self._withheld -= 1
+                self._condition.notify_all()
+            self._stopped.wait(self.interval)
+
+class ScratchBuildFolder(object):
+    def __init__(self, folder=GCC_SCRATCH_FOLDER, requiredBytes=SCRATCH_BUILD_BYTES, reserveBytes=SCRATCH_RESERVE_BYTES,
+                 interval=SCRATCH_CHECK_INTERVAL):
+        '''
+        Puts build directories on a fast scratch filesystem (tmpfs by default) behind a symlink, if it has
+        requiredBytes free (and, for tmpfs, that much memory available). While a build runs its free space
+        is watched; below reserveBytes the build is stopped so it can be spilled back to disk and resumed.
+        '''
+        self.folder = folder
+        self.requiredBytes = requiredBytes
+        self.reserveBytes = reserveBytes
+        self.interval = interval
+        self.spillRequested = threading.Event()
+        self._stopped = threading.Event()
+        self._monitorThread = None
+        self._processGroups = set()
+
+    def isTmpfs(self):
+        path = os.path.realpath(self.folder)
+        best, fsType = '', None
+        with open('/proc/mounts', 'r') as f:
+            for line in f:
+                fields = line.split()
+                mountPoint = fields[1]
+                if (path == mountPoint or path.startswith(mountPoint.rstrip('/') + '/')) and len(mountPoint) >= len(best):
+                    best, fsType = mountPoint, fields[2]
+        return fsType == 'tmpfs'
+
+    def getFreeBytes(self):
+        stat = os.statvfs(self.folder)
+        free = stat.f_bavail * stat.f_frsize
+        if self.isTmpfs():
+            # tmpfs is usually sized larger than what fits in RAM, past that it only swaps
+            free = min(free, AdaptiveJobController.readMemInfo()['MemAvailable'])
+        return free
+
+    def getScratchPath(self, name):
+        return os.path.join(self.folder, 'ginst', name, 'build')
+
+    def enter(self, buildPath, name):
+        '''
+        Links buildPath to its scratch location. Returns False (leaving buildPath alone) if an on-disk
+        build is already there or there isn't enough room.
+        '''
+        scratchPath = self.getScratchPath(name)
+        if os.path.islink(buildPath):
+            if os.path.realpath(buildPath) == os.path.realpath(scratchPath) and os.path.isdir(scratchPath):
+                logger.info("Reusing the build directory in %s" % scratchPath)
+                return True
+            os.remove(buildPath)
+        elif os.path.isdir(buildPath) and os.listdir(buildPath):
+            logger.info("Keeping the existing build directory on disk")
+            return False
+
+        try:
+            free = self.getFreeBytes()
+        except (IOError, OSError, KeyError) as ex:
+            logger.warning("Unable to check free space in %s, building on disk: %s" % (self.folder, ex))
+            return False
+        if free < self.requiredBytes:
+            logger.info("Only %.1f GB free in %s (%.1f GB wanted), building on disk"
+                        % (free / 1024.0 ** 3, self.folder, self.requiredBytes / 1024.0 ** 3))
+            return False
+
+        logger.info("Building in %s (%.1f GB free)" % (scratchPath, free / 1024.0 ** 3))
+        if os.path.islink(scratchPath):
+            os.remove(scratchPath)
+        if not os.path.isdir(scratchPath):
+            os.makedirs(scratchPath)
+        if os.path.isdir(buildPath):
+            os.rmdir(buildPath)
+        os.symlink(scratchPath, buildPath)
+        return True
+
+    def isActive(self, buildPath):
+        return os.path.islink(buildPath) and os.path.isdir(os.path.realpath(buildPath))
+
+    def track(self, processGroup):
+        '''
+        Registers the process group of a command building in the monitored tree (pass as a SystemCall's onStart)
+        '''
+        self._processGroups.add(processGroup)
+
+    def _stopBuild(self):
+        '''
+        Terminates the tracked commands (make and its jobs); make removes the targets it was writing
+        '''
+        for processGroup in list(self._processGroups):
+            try:
+                os.killpg(processGroup, signal.SIGTERM)
+            except (ProcessLookupError, PermissionError):
+                pass
+
+    def _monitor(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                free = self.getFreeBytes()
+            except (IOError, OSError, KeyError):
+                continue
+            if free < self.reserveBytes:
+                logger.warning("Only %.1f GB left in %s, stopping the build to move it to disk" % (free / 1024.0 ** 3, self.folder))
+                self.spillRequested.set()
+                self._stopBuild()
+                return
+
+    @contextlib.contextmanager
+    def monitor(self):
+        '''
+        Watches the free space while the block runs; commands started inside it should be track()ed
+        '''
+        self.spillRequested.clear()
+        self._stopped.clear()
+        self._processGroups.clear()
+        self._monitorThread = threading.Thread(target=self._monitor, name='ginst-scratch-monitor')
+        self._monitorThread.daemon = True
+        self._monitorThread.start()
+        try:
+            yield
+        finally:
+            self._stopped.set()
+            self._monitorThread.join()
+            self._monitorThread = None
+            self._processGroups.clear()
+
+    def spill(self, buildPath):
+        '''
+        Moves the scratch build tree to buildPath on disk, leaving a symlink behind at the scratch
+        location so absolute paths configure recorded there keep working
+        '''
+        scratchPath = os.path.realpath(buildPath)
+        logger.info("Moving the build directory from %s to disk" % scratchPath)
+        os.remove(buildPath)
+        shutil.move(scratchPath, buildPath)
+        os.symlink(buildPath, scratchPath)
+
+    def release(self, buildPath, name):
+        '''
+        Drops the scratch copy of a finished build (what matters was installed into the prefix)
+        '''
+        scratchPath = self.getScratchPath(name)
+        if os.path.islink(buildPath):
+            os.remove(buildPath)
+            if os.path.isdir(scratchPath) and not os.path.islink(scratchPath):
+                logger.info("Removing the build directory from %s" % scratchPath)
+                shutil.rmtree(scratchPath, ignore_errors=True)
+        elif os.path.islink(scratchPath):
+            os.remove(scratchPath)
+        try:
+            os.rmdir(os.path.dirname(scratchPath))
+        except OSError:
+            pass
+
+class ResourceSummary(object):
+    COUNTERS = ('wallTime', 'userTime', 'systemTime', 'readBytes', 'writeBytes', 'readChars', 'writeChars')
+
+    def __init__(self, name):
+        '''
+        Aggregates SystemCall.resources per step (sums, except maxRss which keeps the peak) into a run summary
+        '''
+        self.name = name
+        self.steps = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, step, call):
+        with self._lock:
+            entry = self.steps.setdefault(step, dict({c: 0 for c in self.COUNTERS}, maxRss=0, calls=0))
+            entry['calls'] += 1
+            for counter in self.COUNTERS:
+                entry[counter] += call.resources.get(counter, 0)
+            entry['maxRss'] = max(entry['maxRss'], call.resources.get('maxRss', 0))
+
+    def getTotals(self):
+        with self._lock:
+            totals = dict({c: sum(e[c] for e in self.steps.values()) for c in self.COUNTERS},
+                          maxRss=max([e['maxRss'] for e in self.steps.values()] or [0]))
+        totals['cpuTime'] = totals['userTime'] + totals['systemTime']
+        return totals
+
+    def getSummary(self):
+        with self._lock:
+            steps = json.loads(json.dumps(self.steps))
+        return {'name': self.name, 'time': time.time(), 'cores': multiprocessing.cpu_count(), 'steps': steps, 'totals': self.getTotals()}
+
+    @classmethod
+    def _loadHistory(cls, historyPath):
+        history = []
+        try:
+            with open(historyPath, 'r') as f:
+                for line in f:
+                    try:
+                        history.append(json.loads(line))
+                    except ValueError:
+                        pass
+        except IOError:
+            pass
+        return history
+
+    def write(self, folder, historyPath):
+        '''
+        Writes resources.json into folder, appends the summary to historyPath (one JSON object per
+        line) and logs how this run compares to the previous one
+        '''
+        summary = self.getSummary()
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        with open(os.path.join(folder, 'resources.json'), 'w') as f:
+            json.dump(summary, f, indent=2)
+
+        totals = summary['totals']
+        logger.info("Resources used: %.1f CPU hours (user %.0fs, sys %.0fs) over %.0fs wall, peak RSS %.1f GB, read %.1f GB, wrote %.1f GB"
+                    % (totals['cpuTime'] / 3600.0, totals['userTime'], totals['systemTime'], totals['wallTime'],
+                       totals['maxRss'] / 1024.0 ** 3, totals['readBytes'] / 1024.0 ** 3, totals['writeBytes'] / 1024.0 ** 3))
+        history = self._loadHistory(historyPath)
+        if history:
+            previous = history[-1]
+            for counter in ('cpuTime', 'wallTime', 'maxRss', 'writeBytes'):
+                before = previous['totals'].get(counter, 0)
+                if before:
+                    logger.info("  %-10s %+.1f%% vs %s" % (counter, 100.0 * (totals[counter] - before) / before, previous['name']))
+
+        with open(historyPath, 'a') as f:
+            f.write(json.dumps(summary) + '\n')
+
+class BuildProfiler(object):
+    def __init__(self, name, sampleInterval=PROFILER_SAMPLE_INTERVAL):
+        '''
+        Records how long each install stage and each make phase (stage1/2/3, target libs, ...) takes,
+        plus periodic samples of how many cores are busy, and writes them out as a JSON timeline
+        and a Chrome trace-event file (chrome://tracing, Perfetto).
+        '''
+        self.name = name
+        self.sampleInterval = sampleInterval
+        self.spans = []
+        self.cpuSamples = []
+        self.start = time.time()
+        self._makePhase = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._sampler = None
+
+    @contextlib.contextmanager
+    def span(self, name, category='stage'):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self._addSpan(name, category, start, time.time())
+
+    def _addSpan(self, name, category, start, end):
+        with self._lock:
+            self.spans.append({'name': name, 'category': category, 'start': start, 'end': end, 'duration': end - start})
+
+    def onMakeOutput(self, line):
+        for name, pattern, heavy in MAKE_PHASES:
+            if not heavy and pattern.search(line):
+                if self._makePhase is None or self._makePhase[0] != name:
+                    now = time.time()
+                    if self._makePhase is not None:
+                        self._addSpan(self._makePhase[0], 'make', self._makePhase[1], now)
+                    self._makePhase = (name, now)
+                return
+
+    def endMakePhases(self):
+        if self._makePhase is not None:
+            self._addSpan(self._makePhase[0], 'make', self._makePhase[1], time.time())
+            self._makePhase = None
+
+    @classmethod
+    def _readCpuTimes(cls):
+        with open('/proc/stat', 'r') as f:
+            values = [int(v) for v in f.readline().split()[1:]]
+        idle = values[3] + (values[4] if len(values) > 4 else 0)
+        return sum(values), idle
+
+    def _sample(self):
+        cores = multiprocessing.cpu_count()
+        try:
+            lastTotal, lastIdle = self._readCpuTimes()
+        except (IOError, ValueError):
+            return
+        while not self._stopped.wait(self.sampleInterval):
+            total, idle = self._readCpuTimes()
+            if total > lastTotal:
+                busy = cores * (1.0 - float(idle - lastIdle) / (total - lastTotal))
+                with self._lock:
+                    self.cpuSamples.append((time.time(), round(busy, 2)))
+            lastTotal, lastIdle = total, idle
+
+    def startSampling(self):
+        self._stopped.clear()
+        self._sampler = threading.Thread(target=self._sample, name='ginst-profiler')
+        self._sampler.daemon = True
+        self._sampler.start()
+
+    def stopSampling(self):
+        self._stopped.set()
+        if self._sampler is not None:
+            self._sampler.join()
+            self._sampler = None
+
+    def getTimeline(self):
+        with self._lock:
+            return {
+                'name': self.name,
+                'start': self.start,
+                'cores': multiprocessing.cpu_count(),
+                'spans': sorted(self.spans, key=lambda s: s['start']),
+                'cpuSamples': list(self.cpuSamples),
+            }
+
+    def getTraceEvents(self):
+        timeline = self.getTimeline()
+        toMicroseconds = lambda t: int((t - timeline['start']) * 1e6)
+        threads = {'stage': 1, 'make': 2}
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': 1, 'args': {'name': self.name}}]
+        for category, tid in threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': category}})
+        for span in timeline['spans']:
+            events.append({'name': span['name'], 'cat': span['category'], 'ph': 'X', 'pid': 1,
+                           'tid': threads.get(span['category'], 3), 'ts': toMicroseconds(span['start']),
+                           'dur': int(span['duration'] * 1e6)})
+        for sampleTime, busy in timeline['cpuSamples']:
+            events.append({'name': 'busy cores', 'ph': 'C', 'pid': 1, 'ts': toMicroseconds(sampleTime),
+                           'args': {'busy': busy, 'idle': round(timeline['cores'] - busy, 2)}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write(self, folder):
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        timelinePath = os.path.join(folder, 'timeline.json')
+        tracePath = os.path.join(folder, 'trace.json')
+        with open(timelinePath, 'w') as f:
+            json.dump(self.getTimeline(), f, indent=2)
+        with open(tracePath, 'w') as f:
+            json.dump(self.getTraceEvents(), f)
+        logger.info("Wrote build timeline to %s and trace to %s" % (timelinePath, tracePath))
+        for span in self.getTimeline()['spans']:
+            logger.info("  %-8s %-24s %8.1fs" % (span['category'], span['name'], span['duration']))
+
+class CompilerBenchmark(object):
+    FLAGS = {'.c': '-O2', '.cpp': '-std=c++17 -O2'}
+
+    def __init__(self, sourceFolder=GCC_BENCHMARK_FOLDER, repeats=BENCHMARK_REPEATS, cancelEvent=None):
+        '''
+        Times how long a compiler takes to build each of the bundled C/C++ sources (median of repeats).
+        Setting cancelEvent stops the benchmark before its next compile.
+        '''
+        self.sourceFolder = sourceFolder
+        self.repeats = repeats
+        self.cancelEvent = cancelEvent
+
+    def getSources(self):
+        return sorted(os.path.join(self.sourceFolder, name) for name in os.listdir(self.sourceFolder)
+                      if os.path.splitext(name)[1] in self.FLAGS)
+
+    def getTrainingCommand(self):
+        '''
+        Shell command compiling every source with $CC/$CXX, for use as a profiledbootstrap training workload
+        '''
+        commands = []
+        for source in self.getSources():
+            extension = os.path.splitext(source)[1]
+            commands.append('$%s %s -c %s -o /dev/null' % ('CC' if extension == '.c' else 'CXX', self.FLAGS[extension], source))
+        return ' && '.join(commands)
+
+    def time(self, cc, cxx):
+        '''
+        Returns {source name: median seconds} for compiling each source with cc or cxx
+        '''
+        times = collections.OrderedDict()
+        for source in self.getSources():
+            extension = os.path.splitext(source)[1]
+            command = '%s %s -c %s -o /dev/null' % (cc if extension == '.c' else cxx, self.FLAGS[extension], source)
+            samples = []
+            for _ in range(self.repeats):
+                if self.cancelEvent is not None and self.cancelEvent.is_set():
+                    raise EnvironmentError("The compile benchmark was cancelled")
+                call = SystemCall(command, tailLines=SYSTEM_CALL_TAIL_LINES)
+                if call.failed():
+                    raise EnvironmentError(call.describeFailure("Unable to compile benchmark source %s" % os.path.basename(source)))
+                samples.append(call.resources['wallTime'])
+            times[os.path.basename(source)] = sorted(samples)[len(samples) // 2]
+        return times
+
+    def compare(self, candidate, reference):
+        '''
+        Benchmarks the candidate and reference (gcc, g++) pairs, logs a table and returns the results
+        '''
+        candidateTimes = self.time(*candidate)
+        referenceTimes = self.time(*reference)
+        logger.info("Compile benchmark, %s vs %s:" % (candidate[0], reference[0]))
+        for name in candidateTimes:
+            logger.info("  %-20s %7.2fs %7.2fs  %.2fx" % (name, candidateTimes[name], referenceTimes[name],
+                        referenceTimes[name] / candidateTimes[name] if candidateTimes[name] else 0.0))
+        candidateTotal = sum(candidateTimes.values())
+        referenceTotal = sum(referenceTimes.values())
+        speedup = referenceTotal / candidateTotal if candidateTotal else 0.0
+        logger.info("  %-20s %7.2fs %7.2fs  %.2fx" % ('total', candidateTotal, referenceTotal, speedup))
+        return {
+            'candidate': {'compilers': list(candidate), 'times': candidateTimes},
+            'reference': {'compilers': list(reference), 'times': referenceTimes},
+            'speedup': speedup,
+        }
 
 class GInst(object):
-    def __init__(self, gccVersion="10.4.0"):
-        os.chdir(THIS_FOLDER)
+    _preReqsLock = threading.Lock()
+    _preReqsInstalled = False
+
+    def __init__(self, gccVersion="10.4.0", sourceCache=None, streaming=False, extractThreads=None, mirrorRanker=None,
+                 incremental=False, resume=False, jobServer=None, adaptiveJobs=False, ccache=False, profile=DEFAULT_BUILD_PROFILE,
+                 trainingWorkload=None, benchmark=False, scratchFolder=None, artifactStore=None, useArtifacts=True, packageArtifact=False,
+                 sharedPrerequisites=False):
+        '''
+        extractThreads - without a parallel decompressor, extract the source in-process with this many writer threads
+                         instead of with tar (which is faster for gcc's many small files on most hosts)
+        trainingWorkload - for profiledbootstrap profiles, a shell command run with $CC/$CXX set to the
+                           instrumented compiler (or 'benchmark' for the bundled sources) before gcc's own training
+        benchmark - after installing, time the bundled sources against the standard build of this version
+        scratchFolder - build on this fast filesystem (e.g. /dev/shm) when it has room, moving back to disk if it fills up
+        useArtifacts - install() unpacks a matching prebuilt install from artifactStore instead of building
+        packageArtifact - after make install, package the install prefix into artifactStore
+        sharedPrerequisites - build gmp/mpfr/mpc/isl once per host into shared prefixes instead of in-tree
+        '''
+        self.cwd = THIS_FOLDER
+        self.ccache = ccache
+        self._buildEnvironment = None
+        self.profiler = None
+        self.resourceSummary = None
+        if jobServer is None and adaptiveJobs:
+            jobServer = JobServer(adaptive=True)
+        self.jobServer = jobServer
+        self.incremental = incremental
+        self.resume = resume
+        self._reuseBuild = False
+        self._skippedStages = set()
+        self.sourceCache = sourceCache if sourceCache is not None else SourceCache()
+        self.mirrorRanker = mirrorRanker if mirrorRanker is not None else MirrorRanker()
+        self.streaming = streaming
+        self.extractThreads = extractThreads
+        self.compressedSourcePath = None
         if gccVersion is None:
-            gccVersion = GccVersion.selectGccVersion()
+            self.gccVersion = GccVersion(GccVersion.selectGccVersion(), profile=profile)
         elif isinstance(gccVersion, GccVersion):
             self.gccVersion = gccVersion
         else:
-            self.gccVersion = GccVersion(gccVersion)
+            self.gccVersion = GccVersion(GccVersion.resolveVersionString(gccVersion), profile=profile)
+        self.trainingWorkload = trainingWorkload
+        self.benchmark = benchmark or self.gccVersion.profile == 'fast-compiler'
+        self.scratch = ScratchBuildFolder(scratchFolder) if scratchFolder else None
+        self.artifactStore = artifactStore if artifactStore is not None else ArtifactStore()
+        self.useArtifacts = useArtifacts
+        self.packageArtifact = packageArtifact
+        self.sharedPrerequisites = sharedPrerequisites
+        self.prerequisiteBuilder = PrerequisiteBuilder(self.sourceCache, logFolder=self.getLogFolder(), runCommand=self._checkedMakeCall,
+                                                       jobsFlag=self._getJobsFlag())
+        # set to abandon the install (see AsyncGInst): passed to everything long-running that doesn't go through _systemCall
+        self._cancelled = threading.Event()
+
+    def getLogFolder(self):
+        return os.path.join(GCC_LOG_FOLDER, self.gccVersion.getBuildName())
+
+    def getLogPath(self, step):
+        return os.path.join(self.getLogFolder(), '%s.log.gz' % step)
+
+    def _systemCall(self, cmd, step, env=None, passFds=(), lineCallback=None, onStart=None, cwd=None):
+        call = SystemCall(cmd, tailLines=SYSTEM_CALL_TAIL_LINES, logPath=self.getLogPath(step), cwd=cwd or self.cwd, env=env, passFds=passFds,
+                          lineCallback=lineCallback, onStart=onStart)
+        if self.resourceSummary is not None:
+            self.resourceSummary.add(step, call)
+        return call
+
+    def _onProgress(self, event, **details):
+        '''
+        Called as stages start, finish or are skipped; subclasses can publish these
+        '''
+        pass
+
+    def _checkCancelled(self, what):
+        if self._cancelled.is_set():
+            raise EnvironmentError("Cancelled before %s" % what)
+
+    def _checkedSystemCall(self, cmd, step, failureMessage, env=None, passFds=(), lineCallback=None, onStart=None, cwd=None):
+        call = self._systemCall(cmd, step, env=env, passFds=passFds, lineCallback=lineCallback, onStart=onStart, cwd=cwd)
+        if call.failed():
+            raise EnvironmentError(call.describeFailure(failureMessage))
+        return call
+
+    def _getJobsFlag(self):
+        if self.jobServer is not None:
+            # parallelism comes from the shared jobserver instead of a fixed -j
+            return ''
+        return ' -j%d' % HostProfile.get().getCpuCount()
+
+    def _checkedMakeCall(self, cmd, step, failureMessage, env=None, lineCallback=None, onStart=None, cwd=None):
+        '''
+        _checkedSystemCall for commands that run make: under a shared jobserver they hold a slot and join it
+        '''
+        if self.jobServer is None:
+            return self._checkedSystemCall(cmd, step, failureMessage, env=env, lineCallback=lineCallback, onStart=onStart, cwd=cwd)
+        env = dict(env or {}, **self.jobServer.getEnvironment())
+        with self.jobServer.slot():
+            return self._checkedSystemCall(cmd, step, failureMessage, env=env, passFds=self.jobServer.fds, lineCallback=lineCallback,
+                                           onStart=onStart, cwd=cwd)
 
     def _isAvailable(self, tool):
-        logger.debug("checking if %s is available.." % tool)
-        return SystemCall("which %s" % tool).succeeded()
+        return HostProfile.get().which(tool) is not None
 
     def _getGInstPreReqs(self):
-        if SystemCall.hasRoot():
-            logger.info("Getting pre-reqs to run this script")
-            if SystemCall('apt-get update -y && apt-get upgrade -y').failed():
-                raise EnvironmentError("Failed to apt-get update/upgrade")
+        # host-wide, so concurrent builds in one process only do this once (and don't fight over the apt lock)
+        with GInst._preReqsLock:
+            if GInst._preReqsInstalled:
+                return
+            resolver = PackageResolver()
+            try:
+                missing = resolver.getMissing(GINST_PREREQ_PACKAGES)
+            except IOError as ex:
+                logger.warning("Unable to read the dpkg database, skipping GInst pre-reqs: %s" % ex)
+                GInst._preReqsInstalled = True
+                return
 
-            if SystemCall('apt-get install wget gcc g++ gcc-multilib g++-multilib build-essential libc6-dev zlib1g-dev flex bison texinfo automake -y').failed():
-                raise EnvironmentError("Failed to get GInst prereqs")
-        else:
-            logger.warning("No root detected, skipping GInst pre-reqs... if this fails, run as root/sudo")
+            if not missing:
+                logger.info("All GInst pre-reqs are already installed")
+            elif HostProfile.get().isRoot():
+                logger.info("Installing missing GInst pre-reqs: %s" % ' '.join(missing))
+                if not resolver.listsAreFresh():
+                    self._checkedSystemCall('apt-get update -y', 'apt-update', "Failed to apt-get update")
+                self._checkedSystemCall('apt-get install -y %s' % ' '.join(missing), 'apt-install', "Failed to get GInst prereqs")
+                HostProfile.get().reload()
+            else:
+                logger.warning("No root detected, skipping missing GInst pre-reqs (%s)... if this fails, install them as root/sudo"
+                               % ' '.join(missing))
+            GInst._preReqsInstalled = True
+
+    def _getSourceUrls(self):
+        return self.mirrorRanker.rank(self.gccVersion.getSourceUrls())
+
+    def _getSourceChecksum(self):
+        '''
+        Returns the sha512 gcc publishes for the source archive, or None for an old release without a sha512.sum
+        '''
+        url = self.gccVersion.getChecksumUrl()
+        name = self.gccVersion.getSourceArchiveName()
+        try:
+            with urllib.request.urlopen(url, timeout=DOWNLOAD_TIMEOUT) as response:
+                sums = response.read().decode('utf-8', 'replace')
+        except urllib.error.HTTPError as ex:
+            if ex.code != 404:
+                raise EnvironmentError("Unable to fetch %s: %s" % (url, ex))
+            logger.warning("gcc %s publishes no sha512.sum, the source can't be verified" % self.gccVersion.rawVersionString)
+            return None
+        except Exception as ex:
+            raise EnvironmentError("Unable to fetch %s: %s" % (url, ex))
+        for line in sums.splitlines():
+            fields = line.split()
+            if len(fields) == 2 and os.path.basename(fields[1]) == name:
+                return fields[0].lower()
+        raise EnvironmentError("%s has no checksum for %s" % (url, name))
 
     def _downloadSource(self):
         logger.info("About to download the gcc source")
-        if self._isAvailable('wget'):
-            fail = True
-            for i in range(5):
-                logger.debug("wget try %d / %d" % (i + 1, 5))
-                if SystemCall('curl -L %s -k > %s' % (self.gccVersion.getSourceUrl(), GCC_LOCAL_COMPRESSED_SOURCE_PATH)).succeeded():
-                    fail = False
-                    break
-            if fail:
-                raise EnvironmentError("Failed to wget the gcc source")
-        else:
-            raise EnvironmentError("wget was unavailable to download the gcc source")
+        name = self.gccVersion.getSourceArchiveName()
+        with self.sourceCache.lockEntry(name):
+            self.compressedSourcePath = self.sourceCache.get(name)
+            if self.compressedSourcePath is not None:
+                logger.info("Using cached gcc source %s" % self.compressedSourcePath)
+                return
+
+            downloader = Downloader(self._getSourceUrls(), self.sourceCache.getDownloadPath(name), checksum=self._getSourceChecksum(),
+                                    algorithm='sha512', cancelEvent=self._cancelled)
+            try:
+                downloadPath = downloader.download()
+            except EnvironmentError as ex:
+                raise EnvironmentError("Failed to download the gcc source: %s" % ex)
+            finally:
+                self.mirrorRanker.recordFailures(downloader.failedMirrors)
+            self.compressedSourcePath = self.sourceCache.put(name, downloadPath)
+
+    def _streamSource(self):
+        '''
+        Returns True if the source was downloaded and extracted in one streaming pass
+        '''
+        logger.info("About to stream and uncompress the gcc source")
+        name = self.gccVersion.getSourceArchiveName()
+        with self.sourceCache.lockEntry(name):
+            self.compressedSourcePath = self.sourceCache.get(name)
+            if self.compressedSourcePath is not None:
+                logger.info("Using cached gcc source %s" % self.compressedSourcePath)
+                return False
+
+            teePath = self.sourceCache.getDownloadPath(name)
+            checksum = self._getSourceChecksum()
+            try:
+                StreamingExtractor(self._getSourceUrls()[0], THIS_FOLDER, teePath=teePath, checksum=checksum, algorithm='sha512',
+                                   cancelEvent=self._cancelled).run()
+            except EnvironmentError as ex:
+                # neither a partial (or unverified) archive nor what was extracted from it may be used
+                if os.path.exists(teePath):
+                    os.remove(teePath)
+                shutil.rmtree(self.gccVersion.getLocalUncompressedSourcePath(), ignore_errors=True)
+                self._checkCancelled('downloading the gcc source')
+                logger.warning("Streaming the gcc source failed, falling back to a regular download: %s" % ex)
+                return False
+            self.compressedSourcePath = self.sourceCache.put(name, teePath)
+            return True
+
+    def _fetchSource(self):
+        if self.streaming and self._streamSource():
+            return
+        if self.compressedSourcePath is None:
+            self._downloadSource()
+        self._unCompressSource()
 
     def _unCompressSource(self):
         logger.info("About to uncompress the gcc source")
-        if not SystemCall('tar xf %s' % GCC_LOCAL_COMPRESSED_SOURCE_PATH).succeeded():
-            raise EnvironmentError("Unable to untar gcc source")
+        decompressor = ParallelExtractor.getParallelDecompressor(self.compressedSourcePath)
+        if decompressor is not None:
+            logger.debug("Using %s to decompress the gcc source" % decompressor)
+            start = time.time()
+            self._checkedSystemCall("tar -I '%s' -xf %s" % (decompressor, self.compressedSourcePath), 'untar', "Unable to untar gcc source")
+            elapsed = time.time() - start
+            logger.info("Extracted %.1f MB archive in %.1fs (%.2f MB/s)" % (os.path.getsize(self.compressedSourcePath) / (1024.0 * 1024),
+                        elapsed, os.path.getsize(self.compressedSourcePath) / elapsed / (1024 * 1024) if elapsed else 0.0))
+            return
+
+        if self.extractThreads:
+            try:
+                ParallelExtractor(THIS_FOLDER, self.extractThreads, cancelEvent=self._cancelled).extract(self.compressedSourcePath)
+                return
+            except EnvironmentError as ex:
+                logger.warning("In-process extraction failed, falling back to tar: %s" % ex)
+
+        self._checkedSystemCall('tar xf %s' % self.compressedSourcePath, 'untar', "Unable to untar gcc source")
 
     def _moveToUncompressedSourceFolder(self):
         logger.info("Moving to uncompressed source folder")
-        os.chdir(self.gccVersion.getLocalUncompressedSourcePath())
+        self.cwd = self.gccVersion.getLocalUncompressedSourcePath()
+        if self.sharedPrerequisites:
+            # known up front (from the pinned versions) so configure's inputs are stable when stages are resumed
+            try:
+                _, archives = PrerequisiteFetcher(self.cwd, self.sourceCache).getPrerequisites()
+                self.gccVersion.prerequisitePrefixes = self.prerequisiteBuilder.getPrefixes(archives)
+            except EnvironmentError as ex:
+                logger.warning("Unable to use shared prerequisites, building them in-tree: %s" % ex)
+                self.gccVersion.prerequisitePrefixes = {}
+
+    def _prerequisitesExist(self):
+        return all(self.prerequisiteBuilder.isBuilt(prefix) for prefix in self.gccVersion.prerequisitePrefixes.values())
 
     def _callDownloadPrereqs(self):
+        logger.info("Fetching gmp, mpfr, mpc and isl")
+        fetcher = PrerequisiteFetcher(self.gccVersion.getLocalUncompressedSourcePath(), self.sourceCache, runCommand=self._checkedSystemCall,
+                                      cancelEvent=self._cancelled)
+        if self.gccVersion.prerequisitePrefixes:
+            try:
+                self.prerequisiteBuilder.build(fetcher.fetch(link=False), fetcher.getPrerequisites()[1])
+                return
+            except EnvironmentError as ex:
+                logger.warning("Unable to build the shared prerequisites, building them in-tree: %s" % ex)
+                self.gccVersion.prerequisitePrefixes = {}
+        try:
+            fetcher.fetch()
+            return
+        except EnvironmentError as ex:
+            logger.warning("Unable to fetch the prerequisites directly, falling back to the script: %s" % ex)
+
         logger.info("Calling contrib/download_prerequisites")
-        if not SystemCall('contrib/download_prerequisites').succeeded():
+        if not self._systemCall('contrib/download_prerequisites', 'download-prerequisites').succeeded():
             logger.warning("Unable to download prereqs via source script... that might be ok if this is an old gcc")
 
     def _makeAndEnterBuildDirectory(self):
         logger.info("Creating and entering the build directory")
-        os.makedirs(self.gccVersion.getLocalBuildPath())
-        os.chdir(self.gccVersion.getLocalBuildPath())
+        if self.scratch is not None:
+            self.scratch.enter(self.gccVersion.getLocalBuildPath(), self.gccVersion.getBuildName())
+        if not os.path.isdir(self.gccVersion.getLocalBuildPath()):
+            os.makedirs(self.gccVersion.getLocalBuildPath())
+        self.cwd = self.gccVersion.getLocalBuildPath()
+
+    def _getFingerprintPath(self):
+        return os.path.join(self.gccVersion.getLocalBuildPath(), '.ginst-fingerprint.json')
+
+    def _fingerprintSourceTree(self):
+        digest = hashlib.sha256(self.gccVersion.rawVersionString.encode())
+        sourcePath = self.gccVersion.getLocalUncompressedSourcePath()
+        for root, dirs, files in os.walk(sourcePath):
+            # build folders of every profile live in the source tree
+            dirs[:] = sorted(d for d in dirs if not (root == sourcePath and (d == 'build' or d.startswith('build-'))))
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                try:
+                    stat = os.lstat(path)
+                except OSError:
+                    continue
+                digest.update(('%s %d %d\n' % (os.path.relpath(path, sourcePath), stat.st_size, int(stat.st_mtime))).encode())
+        return digest.hexdigest()
+
+    def _fingerprintToolchain(self):
+        digest = hashlib.sha256()
+        for tool in (os.environ.get('CC', 'gcc'), os.environ.get('CXX', 'g++'), 'make'):
+            digest.update(SystemCall('%s --version' % tool).output.encode())
+        for variable in ('CC', 'CXX', 'CFLAGS', 'CXXFLAGS', 'LDFLAGS', 'PATH'):
+            digest.update(('%s=%s\n' % (variable, os.environ.get(variable, ''))).encode())
+        return digest.hexdigest()
+
+    def _computeFingerprint(self):
+        return {
+            'source': self._fingerprintSourceTree(),
+            'toolchain': self._fingerprintToolchain(),
+            'configure': self.gccVersion.getConfigureCommand(),
+        }
+
+    def _loadFingerprint(self):
+        try:
+            with open(self._getFingerprintPath(), 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _saveFingerprint(self, fingerprint):
+        with open(self._getFingerprintPath(), 'w') as f:
+            json.dump(fingerprint, f, indent=2)
 
     def _configureBuild(self):
+        fingerprint = None
+        if self.incremental:
+            fingerprint = self._computeFingerprint()
+            previous = self._loadFingerprint()
+            # objects stay valid as long as the same sources were built with the same toolchain;
+            # configure flags (including the prefix) are re-applied by running configure again
+            self._reuseBuild = previous is not None and all(previous.get(k) == fingerprint[k] for k in ('source', 'toolchain'))
+            if self._reuseBuild and previous.get('configure') == fingerprint['configure'] \
+                    and os.path.isfile(os.path.join(self.gccVersion.getLocalBuildPath(), 'Makefile')):
+                logger.info("Build directory matches the previous configure, skipping configure")
+                return
+            if self._reuseBuild:
+                logger.info("Reconfiguring the existing build directory")
+
+        if '--enable-multilib' in self.gccVersion.getConfigureArguments() and not HostProfile.get().hasMultilib():
+            logger.warning("32-bit glibc headers (gnu/stubs-32.h) are missing, a multilib build will likely fail... "
+                           "install gcc-multilib or use the fast profile")
         logger.info("Calling configure")
-        if not SystemCall(self.gccVersion.getConfigureCommand()).succeeded():
-            raise EnvironmentError("Unable to configure the build")
+        self._checkedSystemCall(self.gccVersion.getConfigureCommand(), 'configure', "Unable to configure the build",
+                                env=self._getBuildEnvironment())
+        if fingerprint is not None:
+            self._saveFingerprint(fingerprint)
+
+    def _getBuildEnvironment(self):
+        '''
+        Extra environment for configure and make, e.g. routing the host compiler through ccache
+        '''
+        if self._buildEnvironment is None:
+            self._buildEnvironment = {}
+            if self.ccache:
+                if self._isAvailable('ccache'):
+                    # the host compiler builds stage1 (or everything, without bootstrap); content checks and a
+                    # shared base dir let identical sources hit across gcc versions and build folders
+                    self._buildEnvironment = {
+                        'CC': 'ccache %s' % os.environ.get('CC', 'gcc'),
+                        'CXX': 'ccache %s' % os.environ.get('CXX', 'g++'),
+                        'CCACHE_COMPILERCHECK': 'content',
+                        'CCACHE_BASEDIR': THIS_FOLDER,
+                    }
+                else:
+                    logger.warning("ccache was requested but is not installed, building without it")
+        return self._buildEnvironment
+
+    @classmethod
+    def _readCcacheStats(cls):
+        '''
+        Returns cumulative (hits, misses) from ccache, or None if they can't be read
+        '''
+        call = SystemCall('ccache --print-stats')
+        if call.succeeded():
+            counters = dict(line.split('\t', 1) for line in call.output.splitlines() if '\t' in line)
+            try:
+                hits = int(counters.get('direct_cache_hit', 0)) + int(counters.get('preprocessed_cache_hit', 0))
+                return hits, int(counters.get('cache_miss', 0))
+            except ValueError:
+                return None
+        # ccache < 3.7 only has the human readable form
+        output = SystemCall('ccache -s').output
+        hits = sum(int(n) for n in re.findall(r'cache hit \((?:direct|preprocessed)\)\s+(\d+)', output))
+        misses = re.search(r'cache miss\s+(\d+)', output)
+        return (hits, int(misses.group(1))) if misses else None
+
+    def _logCcacheStats(self, before):
+        after = self._readCcacheStats()
+        if before is None or after is None:
+            return
+        hits, misses = after[0] - before[0], after[1] - before[1]
+        total = hits + misses
+        logger.info("ccache: %d hits, %d misses (%.1f%% hit rate)" % (hits, misses, 100.0 * hits / total if total else 0.0))
 
     def _make(self):
         logger.info("Calling make... this will take a while")
-        cpuCount = multiprocessing.cpu_count()
-        makeCommand = 'make clean && make -j%d' % cpuCount
-        if not SystemCall(makeCommand).succeeded():
-            raise EnvironmentError("compilation via make failed")
+        jobsFlag = self._getJobsFlag()
+        if self._reuseBuild or 'configure' in self._skippedStages:
+            logger.info("Reusing the existing build directory, skipping make clean")
+            clean = ''
+        else:
+            clean = 'make clean && '
+        target = self.gccVersion.getMakeTarget()
+        if target == 'profiledbootstrap' and self.trainingWorkload:
+            # stop once the instrumented compiler is built, train it on the workload, then let profiledbootstrap
+            # carry on; its own training run adds to the profile before the feedback stage is built
+            steps = [('%smake%s stageprofile-bubble' % (clean, jobsFlag), 'make'),
+                     (None, 'training'),
+                     ('make%s %s' % (jobsFlag, target), 'make-feedback')]
+        else:
+            steps = [('%smake%s%s' % (clean, jobsFlag, ' ' + target if target else ''), 'make')]
+
+        def onMakeOutput(line):
+            if self.profiler is not None:
+                self.profiler.onMakeOutput(line)
+            if self.jobServer is not None:
+                self.jobServer.onMakeOutput(line)
+
+        env = dict(self._getBuildEnvironment())
+        ccacheStats = self._readCcacheStats() if 'CCACHE_BASEDIR' in env else None
+
+        def runMake(makeCommand, step, onStart=None):
+            self._checkedMakeCall(makeCommand, step, "compilation via make failed", env=env, lineCallback=onMakeOutput, onStart=onStart)
+
+        buildPath = self.gccVersion.getLocalBuildPath()
+        try:
+            for makeCommand, step in steps:
+                if makeCommand is None:
+                    self._runTrainingWorkload()
+                elif self.scratch is not None and self.scratch.isActive(buildPath):
+                    try:
+                        with self.scratch.monitor():
+                            runMake(makeCommand, step, onStart=self.scratch.track)
+                    except EnvironmentError:
+                        if not self.scratch.spillRequested.is_set():
+                            raise
+                        self.scratch.spill(buildPath)
+                        # carry on from where make was stopped
+                        runMake(makeCommand[len(clean):] if makeCommand.startswith(clean) else makeCommand, '%s-resumed' % step)
+                else:
+                    runMake(makeCommand, step)
+        finally:
+            if self.profiler is not None:
+                self.profiler.endMakePhases()
+            if ccacheStats is not None:
+                self._logCcacheStats(ccacheStats)
+
+    def _runTrainingWorkload(self):
+        buildPath = self.gccVersion.getLocalBuildPath()
+        gccFolder = os.path.join(buildPath, 'gcc')
+        libstdcxxFolder = os.path.join(buildPath, GCC_TRIPLE, 'libstdc++-v3')
+        # the instrumented stage isn't installed, so point it at its own specs and at the in-tree libstdc++ headers
+        env = {
+            'CC': '%s/xgcc -B%s/' % (gccFolder, gccFolder),
+            'CXX': '%s/xg++ -B%s/ -nostdinc++ -I%s/include -I%s/include/%s -I%s/libstdc++-v3/libsupc++'
+                   % (gccFolder, gccFolder, libstdcxxFolder, libstdcxxFolder, GCC_TRIPLE, self.gccVersion.getLocalUncompressedSourcePath()),
+        }
+        if self.trainingWorkload == 'benchmark':
+            command = CompilerBenchmark().getTrainingCommand()
+        else:
+            command = self.trainingWorkload
+        logger.info("Training the instrumented compiler: %s" % command)
+        self._checkedSystemCall(command, 'training', "The training workload failed", env=env)
+
+    def _benchmarkCompiler(self):
+        candidate = self.gccVersion.getCompilerPaths()
+        reference = GccVersion(self.gccVersion.rawVersionString).getCompilerPaths()
+        if self.gccVersion.profile == DEFAULT_BUILD_PROFILE:
+            logger.info("This is the standard build of gcc %s, benchmarking it against the system compiler"
+                        % self.gccVersion.rawVersionString)
+            reference = (os.environ.get('CC', 'gcc'), os.environ.get('CXX', 'g++'))
+        elif not os.path.isfile(reference[0]):
+            logger.warning("The reference (standard) build of gcc %s is missing, benchmarking against the system compiler"
+                           % self.gccVersion.rawVersionString)
+            reference = (os.environ.get('CC', 'gcc'), os.environ.get('CXX', 'g++'))
+        try:
+            results = CompilerBenchmark(cancelEvent=self._cancelled).compare(candidate, reference)
+        except EnvironmentError as ex:
+            logger.warning("Compile benchmark failed: %s" % ex)
+            return
+        if not os.path.isdir(self.getLogFolder()):
+            os.makedirs(self.getLogFolder())
+        with open(os.path.join(self.getLogFolder(), 'benchmark.json'), 'w') as f:
+            json.dump(results, f, indent=2)
 
     def _install(self):
         logger.info("Installing the new gcc")
-        if not SystemCall('make install').succeeded():
-            raise EnvironmentError("Unable to install the new gcc")
+        self._checkedSystemCall('make install', 'install', "Unable to install the new gcc")
+        if self.packageArtifact:
+            self.artifactStore.package(self.gccVersion, self.gccVersion.getInstallPrefix(), runCommand=self._checkedSystemCall)
+        # incremental builds keep their tree, wherever it is, for the next run
+        if self.scratch is not None and not self.incremental:
+            self.cwd = self.gccVersion.getLocalUncompressedSourcePath()
+            self.scratch.release(self.gccVersion.getLocalBuildPath(), self.gccVersion.getBuildName())
+
+    def getStatePath(self):
+        return os.path.join(GCC_STATE_FOLDER, '%s.json' % self.gccVersion.getBuildName())
+
+    def _loadStageState(self):
+        try:
+            with open(self.getStatePath(), 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _saveStageState(self, state):
+        _atomicWriteJson(self.getStatePath(), state)
+
+    def _getStages(self, fetchSource):
+        '''
+        Returns (name, function, inputs, outputsExist) for each install stage. inputs is a callable
+        returning what the stage depends on, or None for stages (like changing directory) that must
+        always run. outputsExist checks that what the stage produced is still on disk.
+        '''
+        sourcePath = self.gccVersion.getLocalUncompressedSourcePath()
+        makefilePath = os.path.join(self.gccVersion.getLocalBuildPath(), 'Makefile')
+        always = lambda: True
+        return [
+            ('prereqs', self._getGInstPreReqs, lambda: '', always),
+            ('source', fetchSource, self.gccVersion.getSourceArchiveName, lambda: os.path.isdir(sourcePath)),
+            ('enter-source', self._moveToUncompressedSourceFolder, None, None),
+            ('download-prerequisites', self._callDownloadPrereqs, lambda: '', self._prerequisitesExist),
+            ('enter-build', self._makeAndEnterBuildDirectory, None, None),
+            ('configure', self._configureBuild, self.gccVersion.getConfigureCommand, lambda: os.path.isfile(makefilePath)),
+            ('make', self._make, lambda: '', always),
+            ('install', self._install, lambda: '', always),
+        ]
+
+    def _runStages(self, stages):
+        '''
+        Runs stages in order, recording each completed stage with a hash of its inputs chained to the
+        previous stage. With resume set, leading stages whose hash matches the state file are skipped.
+        '''
+        self.profiler = BuildProfiler(self.gccVersion.getBuildName())
+        self.resourceSummary = ResourceSummary(self.gccVersion.getBuildName())
+        self.profiler.startSampling()
+        start = time.time()
+        try:
+            self._runStagesProfiled(stages)
+            self._recordProfileCost(time.time() - start)
+        finally:
+            self.profiler.stopSampling()
+            self.profiler.write(self.getLogFolder())
+            self.resourceSummary.write(self.getLogFolder(), os.path.join(GCC_LOG_FOLDER, 'resource-history.jsonl'))
+
+    def _runStagesProfiled(self, stages):
+        state = self._loadStageState() if self.resume else {}
+        if not self.resume:
+            self._saveStageState(state)
+        chainHash = ''
+        invalidated = False
+        self._skippedStages = set()
+        for name, function, inputs, outputsExist in stages:
+            self._checkCancelled(name)
+            if inputs is None:
+                function()
+                continue
+
+            chainHash = hashlib.sha256(('%s|%s|%s' % (chainHash, name, inputs())).encode()).hexdigest()
+            if not invalidated and state.get(name) == chainHash and outputsExist():
+                logger.info("Skipping stage %s, it completed in a previous run" % name)
+                self._skippedStages.add(name)
+                self._onProgress('stage-skipped', stage=name)
+                continue
+
+            invalidated = True
+            # drop this and every later stage so a failure here can't leave stale entries behind
+            names = [stage[0] for stage in stages if stage[2] is not None]
+            for laterName in names[names.index(name):]:
+                state.pop(laterName, None)
+            self._saveStageState(state)
+
+            self._onProgress('stage-started', stage=name)
+            with self.profiler.span(name):
+                function()
+            self._onProgress('stage-finished', stage=name)
+            state[name] = chainHash
+            self._saveStageState(state)
+
+    def _recordProfileCost(self, wallTime):
+        '''
+        Appends this build's wall-clock time to the profile history and compares it with the latest
+        complete build of the same version under each other profile
+        '''
+        record = {
+            'version': self.gccVersion.rawVersionString,
+            'profile': self.gccVersion.profile,
+            'wallTime': wallTime,
+            'complete': not self._skippedStages,
+            'time': time.time(),
+        }
+        latest = {}
+        try:
+            with open(GCC_PROFILE_HISTORY_PATH, 'r') as f:
+                for line in f:
+                    try:
+                        previous = json.loads(line)
+                    except ValueError:
+                        continue
+                    if previous.get('version') == record['version'] and previous.get('complete'):
+                        latest[previous['profile']] = previous['wallTime']
+        except IOError:
+            pass
+
+        if not os.path.isdir(os.path.dirname(GCC_PROFILE_HISTORY_PATH)):
+            os.makedirs(os.path.dirname(GCC_PROFILE_HISTORY_PATH))
+        with open(GCC_PROFILE_HISTORY_PATH, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+        if not record['complete']:
+            logger.info("Build with the %s profile took %.0fs (resumed, not recorded as the profile's cost)" % (record['profile'], wallTime))
+            return
+        latest[record['profile']] = wallTime
+        logger.info("Build with the %s profile took %.0fs" % (record['profile'], wallTime))
+        for profile in sorted(latest, key=latest.get):
+            if profile != record['profile']:
+                logger.info("  %-10s %8.0fs (%.2fx this build)" % (profile, latest[profile], latest[profile] / wallTime if wallTime else 0.0))
+
+    def _installFromArtifact(self):
+        manifest = self.artifactStore.find(self.gccVersion, cancelEvent=self._cancelled)
+        if manifest is None:
+            return False
+        logger.info("Found a prebuilt gcc %s (%s, %s), installing it instead of building"
+                    % (self.gccVersion.rawVersionString, manifest['glibc'], manifest['triple']))
+        try:
+            self.artifactStore.unpack(manifest, self.gccVersion.getInstallPrefix(), runCommand=self._checkedSystemCall, cancelEvent=self._cancelled)
+        except EnvironmentError as ex:
+            logger.warning("Unable to install the prebuilt gcc, building it instead: %s" % ex)
+            return False
+        return True
 
     def install(self):
-        self._getGInstPreReqs()
-        self._downloadSource()
-        self._unCompressSource()
-        self._moveToUncompressedSourceFolder()
-        self._callDownloadPrereqs()
-        self._configureBuild()
-        self._make()
-        self._install()
+        if not (self.useArtifacts and self._installFromArtifact()):
+            self._runStages(self._getStages(self._fetchSource))
         logger.info("Done installing gcc")
+        if self.benchmark:
+            self._benchmarkCompiler()
 
     def installFromFolder(self, gccFolder):
-        self._getGInstPreReqs()
-        logger.info("Moving gcc to expected uncompressed source path folder")
-        shutil.move(gccFolder, self.gccVersion.getLocalUncompressedSourcePath())
-        self._moveToUncompressedSourceFolder()
-        self._callDownloadPrereqs()
-        self._configureBuild()
-        self._make()
-        self._install()
+        def moveSource():
+            logger.info("Moving gcc to expected uncompressed source path folder")
+            shutil.move(gccFolder, self.gccVersion.getLocalUncompressedSourcePath())
+
+        self._runStages(self._getStages(moveSource))
         logger.info("Done installing gcc")
+        if self.benchmark:
+            self._benchmarkCompiler()
+
+class GInstBatch(object):
+    def __init__(self, gccVersions, jobs=None, adaptiveJobs=False, **kwargs):
+        '''
+        Builds several gcc versions concurrently. All of their makes share one jobserver with jobs
+        slots (the core count by default), sized to available memory when adaptiveJobs is set;
+        kwargs are passed on to each GInst.
+        '''
+        self.jobServer = JobServer(jobs, adaptive=adaptiveJobs)
+        self.builds = [GInst(v, jobServer=self.jobServer, **kwargs) for v in gccVersions]
+
+    def _installOne(self, build):
+        threading.current_thread().name = build.gccVersion.getBuildName()
+        build.install()
+
+    def install(self):
+        logger.info("Building gcc %s with %d shared make job slots" % (', '.join(b.gccVersion.rawVersionString for b in self.builds),
+                    self.jobServer.slots))
+        failures = []
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.builds)) as pool:
+                futures = [(b, pool.submit(self._installOne, b)) for b in self.builds]
+                for build, future in futures:
+                    try:
+                        future.result()
+                    except EnvironmentError as ex:
+                        logger.error("Building gcc %s failed: %s" % (build.gccVersion.rawVersionString, ex))
+                        failures.append(build.gccVersion.rawVersionString)
+        finally:
+            self.jobServer.close()
+        if failures:
+            raise EnvironmentError("Failed to build gcc %s" % ', '.join(failures))
+        logger.info("Done installing all gcc versions")
+
+class AsyncGInst(GInst):
+    def __init__(self, *args, **kwargs):
+        '''
+        GInst for asyncio. await install() runs the stages on a worker thread, but every command they
+        run is an AsyncSystemCall on the event loop, so one loop can drive many builds. Cancelling
+        install() kills the running command; downloads, extraction and the benchmark stop at their next
+        check, and the remaining stages are skipped. Progress is published as dicts (event, build, time,
+        ...) on self.events, an asyncio.Queue; outputEvents adds one per line of command output, dropped
+        (and counted in droppedOutputEvents) while ASYNC_OUTPUT_EVENT_BACKLOG events are waiting.
+        Takes the same arguments as GInst.
+        '''
+        self.outputEvents = kwargs.pop('outputEvents', False)
+        GInst.__init__(self, *args, **kwargs)
+        self.events = asyncio.Queue()
+        self.droppedOutputEvents = 0
+        self._loop = None
+        # the AsyncSystemCalls in flight (the prerequisite archives unpack concurrently)
+        self._running = set()
+
+    def _publish(self, details):
+        # stage and command events are few, so only output is dropped for a consumer that falls behind
+        if details['event'] == 'output' and self.events.qsize() >= ASYNC_OUTPUT_EVENT_BACKLOG:
+            self.droppedOutputEvents += 1
+            return
+        self.events.put_nowait(details)
+
+    def _onProgress(self, event, **details):
+        details.update(event=event, build=self.gccVersion.getBuildName(), time=time.time())
+        self._loop.call_soon_threadsafe(self._publish, details)
+
+    async def _runCall(self, call):
+        # runs on the loop, as does cancellation, so a command can't start unnoticed after install() was cancelled
+        if self._cancelled.is_set():
+            call.cancel()
+        self._running.add(call)
+        try:
+            return await call.run()
+        finally:
+            self._running.discard(call)
+
+    def _systemCall(self, cmd, step, env=None, passFds=(), lineCallback=None, onStart=None, cwd=None):
+        self._checkCancelled(step)
+        if self.outputEvents:
+            def onLine(line):
+                self._onProgress('output', step=step, line=line)
+                if lineCallback is not None:
+                    lineCallback(line)
+        else:
+            onLine = lineCallback
+
+        self._onProgress('command-started', step=step, command=cmd)
+        call = AsyncSystemCall(cmd, tailLines=SYSTEM_CALL_TAIL_LINES, logPath=self.getLogPath(step), cwd=cwd or self.cwd, env=env,
+                               passFds=passFds, lineCallback=onLine, onStart=onStart)
+        asyncio.run_coroutine_threadsafe(self._runCall(call), self._loop).result()
+        if self.resourceSummary is not None:
+            self.resourceSummary.add(step, call)
+        self._onProgress('command-finished', step=step, returnCode=call.retCode)
+        if call.cancelled:
+            raise EnvironmentError("Cancelled while running %s" % step)
+        return call
+
+    async def install(self):
+        self._loop = asyncio.get_running_loop()
+        self._cancelled.clear()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix=self.gccVersion.getBuildName())
+        work = executor.submit(GInst.install, self)
+        try:
+            await asyncio.wrap_future(work)
+        except asyncio.CancelledError:
+            self._cancelled.set()
+            for call in list(self._running):
+                call.cancel()
+            # let the stages unwind (saving state, logs and the timeline) before passing the cancellation on
+            unwound = asyncio.wrap_future(work)
+            await asyncio.wait([unwound])
+            if not unwound.cancelled():
+                unwound.exception()  # the stages failed with 'Cancelled while running ...', which is expected
+            self._onProgress('cancelled')
+            raise
+        except EnvironmentError as ex:
+            self._onProgress('failed', error=str(ex))
+            raise
+        finally:
+            executor.shutdown(wait=False)
+        self._onProgress('done')
+
+async def asyncInstall(gccVersions, jobs=None, adaptiveJobs=False, **kwargs):
+    '''
+    Builds several gcc versions concurrently from the running event loop (like GInstBatch, sharing
+    one make jobserver) and returns their AsyncGInsts. kwargs are passed on to each AsyncGInst.
+    '''
+    jobServer = JobServer(jobs, adaptive=adaptiveJobs)
+    builds = [AsyncGInst(v, jobServer=jobServer, **kwargs) for v in gccVersions]
+    try:
+        results = await asyncio.gather(*[build.install() for build in builds], return_exceptions=True)
+    finally:
+        jobServer.close()
+
+    failures = []
+    for build, result in zip(builds, results):
+        if isinstance(result, EnvironmentError):
+            logger.error("Building gcc %s failed: %s" % (build.gccVersion.rawVersionString, result))
+            failures.append(build.gccVersion.rawVersionString)
+        elif isinstance(result, BaseException):
+            raise result
+    if failures:
+        raise EnvironmentError("Failed to build gcc %s" % ', '.join(failures))
+    return builds
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('-g', '--gcc', help='Gcc version', default='10.4.0')
+    parser.add_argument('-g', '--gcc', help="Gcc version, or a query like 'latest' or '12.x'. A comma separated list builds several concurrently",
+                        default='10.4.0')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Total make jobs shared by concurrent builds (defaults to the core count)')
+    parser.add_argument('--adaptive-jobs', action='store_true', help='Lower make parallelism while memory is short (reads /proc/meminfo and /proc/pressure)')
+    parser.add_argument('--stream', action='store_true', help='Extract the gcc source while it downloads')
+    parser.add_argument('--extract-threads', type=int, default=None, metavar='THREADS',
+                        help='Extract the gcc source in-process with this many writer threads instead of with tar (when pigz is missing)')
+    parser.add_argument('--incremental', action='store_true', help='Reuse an existing build directory when its sources and toolchain match')
+    parser.add_argument('--resume', action='store_true', help='Skip stages that completed in a previous run with the same inputs')
+    parser.add_argument('--ccache', action='store_true', help='Compile with ccache and report its hit rate')
+    parser.add_argument('--profile', choices=sorted(BUILD_PROFILES), default=DEFAULT_BUILD_PROFILE,
+                        help='fast: no bootstrap, c only. standard: full bootstrap. optimized: profiled, LTO-linked bootstrap. '
+                             'fast-compiler: optimized without multilib, then benchmarked')
+    parser.add_argument('--training-workload', default=None,
+                        help="Shell command (using $CC/$CXX) to train profiled builds on, or 'benchmark' for the bundled sources")
+    parser.add_argument('--scratch', nargs='?', const=GCC_SCRATCH_FOLDER, default=None, metavar='FOLDER',
+                        help='Build on tmpfs (%s, or FOLDER) when it has room, moving the build to disk if it fills up' % GCC_SCRATCH_FOLDER)
+    parser.add_argument('--package', action='store_true', help='Package the finished install into the artifact store')
+    parser.add_argument('--artifact-store', default=GCC_ARTIFACT_FOLDER, help='Folder of packaged gcc installs to reuse instead of building')
+    parser.add_argument('--no-artifacts', action='store_true', help='Always build, even if the artifact store has a matching install')
+    parser.add_argument('--artifact-server', action='append', default=[], metavar='URL',
+                        help='Fetch prebuilt installs missing from the artifact store from this server (repeatable)')
+    parser.add_argument('--serve-artifacts', nargs='?', const=ARTIFACT_SERVER_PORT, type=int, default=None, metavar='PORT',
+                        help='Serve the artifact store over HTTP (port %d by default) instead of installing' % ARTIFACT_SERVER_PORT)
+    parser.add_argument('--shared-prereqs', action='store_true',
+                        help='Build gmp/mpfr/mpc/isl once per version into shared prefixes and reuse them across gcc builds')
+    parser.add_argument('--benchmark', action='store_true', help='Time compiling the bundled sources against the standard build after installing')
     args = parser.parse_args()
     
-    g = GInst(args.gcc)
+    if args.serve_artifacts is not None:
+        ArtifactServer(ArtifactStore(args.artifact_store), port=args.serve_artifacts).serveForever()
+        sys.exit(0)
+
+    options = dict(streaming=args.stream, extractThreads=args.extract_threads, incremental=args.incremental, resume=args.resume,
+                   ccache=args.ccache, profile=args.profile, trainingWorkload=args.training_workload, benchmark=args.benchmark,
+                   scratchFolder=args.scratch, artifactStore=ArtifactStore(args.artifact_store, args.artifact_server), useArtifacts=not args.no_artifacts,
+                   packageArtifact=args.package, sharedPrerequisites=args.shared_prereqs)
+    versions = [v.strip() for v in args.gcc.split(',') if v.strip()]
+    if len(versions) > 1:
+        g = GInstBatch(versions, jobs=args.jobs, adaptiveJobs=args.adaptive_jobs, **options)
+    else:
+        jobServer = JobServer(args.jobs, adaptive=args.adaptive_jobs) if args.jobs or args.adaptive_jobs else None
+        g = GInst(versions[0], jobServer=jobServer, **options)
     g.install()
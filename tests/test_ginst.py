@@ -0,0 +1,1676 @@
+'''
+Tests for ginst against local stand-ins (http and ftp servers, fake commands and fixture files), no network needed
+
+Run from the repository root with: python -m unittest discover tests (or pytest)
+'''
+import asyncio
+import gzip
+import hashlib
+import http.server
+import io
+import json
+import logging
+import os
+import re
+import shutil
+import signal
+import socket
+import socketserver
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import ginst
+
+ginst.logger.setLevel(logging.ERROR)
+
+class _FileRequestHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    GET/HEAD for the files of server.folder, with Range support, keep-alive and the server's quirks
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        http.server.BaseHTTPRequestHandler.setup(self)
+        self.server.count('connections')
+
+    def do_HEAD(self):
+        self._send(False)
+
+    def do_GET(self):
+        self._send(True)
+
+    def _send(self, body):
+        self.server.count('requests')
+        path = os.path.join(self.server.folder, self.path.lstrip('/'))
+        if not os.path.isfile(path) or (body and self.server.failGets):
+            self.send_error(404 if not os.path.isfile(path) else 500)
+            return
+        with open(path, 'rb') as f:
+            data = f.read()
+        start, end = 0, len(data) - 1
+        rangeMatch = re.match(r'^bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if rangeMatch and self.server.ranges:
+            start = int(rangeMatch.group(1))
+            end = min(int(rangeMatch.group(2)), end) if rangeMatch.group(2) else end
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start + 1))
+        if self.server.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        if not body:
+            return
+        data = data[start:end + 1]
+        step = 16 * 1024
+        for offset in range(0, len(data), step):
+            if self.server.rate:
+                time.sleep(float(step) / self.server.rate)
+            self.wfile.write(data[offset:offset + step])
+
+class _FileServer(http.server.ThreadingHTTPServer):
+    '''
+    A local stand-in for a download mirror: serves folder, optionally throttled to rate bytes per second,
+    without range support or failing every GET, and counts connections and requests
+    '''
+    daemon_threads = True
+
+    def __init__(self, folder, rate=None, ranges=True, failGets=False):
+        http.server.ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0), _FileRequestHandler)
+        self.folder = folder
+        self.rate = rate
+        self.ranges = ranges
+        self.failGets = failGets
+        self.stats = {'connections': 0, 'requests': 0}
+        self._lock = threading.Lock()
+
+    def count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def getUrl(self, path=''):
+        return 'http://127.0.0.1:%d/%s' % (self.server_address[1], path)
+
+class _FtpHandler(socketserver.StreamRequestHandler):
+    '''
+    Just enough of an anonymous ftp server for VersionCatalogue: MLST of the release folder and a passive NLST
+    '''
+    modified = '20260101000000'
+    listing = []
+
+    def handle(self):
+        self._reply('220 ready')
+        dataSocket = None
+        for line in self.rfile:
+            command = line.decode().split()[0].upper()
+            if command == 'USER':
+                self._reply('331 anonymous ok')
+            elif command == 'PASS':
+                self._reply('230 logged in')
+            elif command == 'MLST':
+                self._reply('250-listing\r\n modify=%s; %s\r\n250 end' % (self.modified, ginst.GCC_FTP_VERSION_FOLDER))
+            elif command == 'TYPE':
+                self._reply('200 ok')
+            elif command == 'PASV':
+                dataSocket = socket.socket()
+                dataSocket.bind(('127.0.0.1', 0))
+                dataSocket.listen(1)
+                port = dataSocket.getsockname()[1]
+                self._reply('227 Entering Passive Mode (127,0,0,1,%d,%d)' % (port // 256, port % 256))
+            elif command == 'NLST':
+                self._reply('150 listing')
+                connection, _ = dataSocket.accept()
+                with connection:
+                    connection.sendall(''.join('%s/gcc-%s\r\n' % (ginst.GCC_FTP_VERSION_FOLDER, v) for v in self.listing).encode())
+                dataSocket.close()
+                self._reply('226 done')
+            elif command == 'QUIT':
+                self._reply('221 bye')
+                return
+            else:
+                self._reply('502 not implemented')
+
+    def _reply(self, text):
+        self.wfile.write((text + '\r\n').encode())
+
+class TempFolderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='ginst-test-')
+        self.addCleanup(shutil.rmtree, self.folder, True)
+
+    def writeFile(self, name, content, mode='w', executable=False):
+        path = os.path.join(self.folder, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, mode) as f:
+            f.write(content)
+        if executable:
+            os.chmod(path, 0o755)
+        return path
+
+    def startServer(self, folder=None, **kwargs):
+        server = _FileServer(folder or self.folder, **kwargs)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def patch(self, target, name, value):
+        patcher = mock.patch.object(target, name, value)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @classmethod
+    def makeTarball(cls, files, mode='w:gz'):
+        '''
+        Returns a tarball of {name: content} (content None for a folder), top level folders first
+        '''
+        data = io.BytesIO()
+        with tarfile.open(fileobj=data, mode=mode) as tar:
+            for name in sorted(files):
+                info = tarfile.TarInfo(name)
+                info.mtime = 1600000000
+                if files[name] is None:
+                    info.type = tarfile.DIRTYPE
+                    info.mode = 0o755
+                    tar.addfile(info)
+                else:
+                    content = files[name].encode() if isinstance(files[name], str) else files[name]
+                    info.size = len(content)
+                    info.mode = 0o755 if name.endswith(('.sh', '/configure')) or '/bin/' in name else 0o644
+                    tar.addfile(info, io.BytesIO(content))
+        return data.getvalue()
+
+class GInstTestCase(TempFolderTestCase):
+    '''
+    Keeps everything a GInst writes (source trees, logs, state, caches) in the test's folder
+    '''
+    VERSION = '9.9.9'
+    CONFIGURE = '#!/bin/sh\necho "$@" >> configure.runs\nprintf "all:\\n\\t@echo built\\n" > Makefile\n'
+
+    def setUp(self):
+        TempFolderTestCase.setUp(self)
+        self.patch(ginst, 'THIS_FOLDER', self.folder)
+        self.patch(ginst, 'GCC_LOG_FOLDER', os.path.join(self.folder, 'logs'))
+        self.patch(ginst, 'GCC_STATE_FOLDER', os.path.join(self.folder, 'state'))
+        self.patch(ginst, 'GCC_PROFILE_HISTORY_PATH', os.path.join(self.folder, 'logs', 'profile-history.jsonl'))
+        self.patch(ginst.HostProfile, 'instance', ginst.HostProfile(os.path.join(self.folder, 'host.json')))
+
+    def makeGInst(self, profile=ginst.DEFAULT_BUILD_PROFILE, cls=ginst.GInst, **kwargs):
+        kwargs.setdefault('sourceCache', ginst.SourceCache(os.path.join(self.folder, 'cache')))
+        kwargs.setdefault('mirrorRanker', ginst.MirrorRanker(os.path.join(self.folder, 'mirrors.json')))
+        kwargs.setdefault('artifactStore', ginst.ArtifactStore(os.path.join(self.folder, 'artifacts')))
+        kwargs.setdefault('useArtifacts', False)
+        return cls(ginst.GccVersion(self.VERSION, profile=profile), **kwargs)
+
+    def makeSourceArchive(self, extraFiles=None):
+        files = {'gcc-%s' % self.VERSION: None, 'gcc-%s/configure' % self.VERSION: self.CONFIGURE,
+                 'gcc-%s/README' % self.VERSION: 'gcc %s\n' % self.VERSION}
+        files.update(extraFiles or {})
+        return self.makeTarball(files)
+
+    def makeSourceTree(self):
+        '''
+        Unpacks a fake gcc source tree where the GInst expects it, returning its path
+        '''
+        with tarfile.open(fileobj=io.BytesIO(self.makeSourceArchive())) as tar:
+            tar.extractall(self.folder)
+        return os.path.join(self.folder, 'gcc-%s' % self.VERSION)
+
+    def serveRelease(self, archive, checksum=None, **kwargs):
+        '''
+        Serves archive as this version's source with a sha512.sum next to it (checksum False for none)
+        and points the source and checksum urls at it
+        '''
+        releaseFolder = os.path.join(self.folder, 'mirror', 'gcc-%s' % self.VERSION)
+        os.makedirs(releaseFolder)
+        name = 'gcc-%s.tar.gz' % self.VERSION
+        with open(os.path.join(releaseFolder, name), 'wb') as f:
+            f.write(archive)
+        if checksum is not False:
+            with open(os.path.join(releaseFolder, 'sha512.sum'), 'w') as f:
+                f.write('%s  gcc-%s.tar.xz\n%s  %s\n' % ('0' * 128, self.VERSION, checksum or hashlib.sha512(archive).hexdigest(), name))
+        server = self.startServer(os.path.join(self.folder, 'mirror'), **kwargs)
+        self.patch(ginst, 'GCC_SOURCE_URL', server.getUrl('gcc-%s/gcc-%s.tar.gz'))
+        self.patch(ginst, 'GCC_SOURCE_MIRRORS', [ginst.GCC_SOURCE_URL])
+        self.patch(ginst, 'GCC_CHECKSUM_URL', server.getUrl('gcc-%s/sha512.sum'))
+        return server
+
+class SystemCallTests(TempFolderTestCase):
+    def test_outputAndReturnCode(self):
+        call = ginst.SystemCall("printf 'one\\r\\ntwo\\n'; echo three >&2; exit 3")
+        self.assertEqual(call.output, 'one\ntwo\nthree')
+        self.assertEqual(call.retCode, 3)
+        self.assertTrue(call.failed())
+        self.assertTrue(ginst.SystemCall('true').succeeded())
+
+    def test_sleepsWhileTheCommandIsQuiet(self):
+        call = ginst.SystemCall('sleep 1; echo done')
+        self.assertEqual(call.output, 'done')
+        # one wakeup per chunk of output (and one for the end), not one per poll
+        self.assertLessEqual(call.stats['wakeups'], 3)
+        self.assertLess(call.stats['parentCpuTime'], 0.2)
+
+    def test_linesAndCharactersSplitAcrossReads(self):
+        call = ginst.SystemCall("printf 'caf\\303'; sleep 0.2; printf '\\251 au\\n'; sleep 0.2; printf 'lait'")
+        self.assertEqual(call.output, 'caf\u00e9 au\nlait')
+
+    def test_tailIsBounded(self):
+        call = ginst.SystemCall('seq 1 5000', tailLines=10)
+        self.assertEqual(call.output, '\n'.join(str(i) for i in range(4991, 5001)))
+        self.assertEqual(call.getTail(3), '4998\n4999\n5000')
+
+    def test_logHoldsTheFullOutput(self):
+        logPath = os.path.join(self.folder, 'logs', 'seq.log.gz')
+        ginst.SystemCall('seq 1 5000', tailLines=10, logPath=logPath)
+        with gzip.open(logPath, 'rt') as f:
+            self.assertEqual(f.read(), ''.join('%d\n' % i for i in range(1, 5001)))
+
+    def test_describeFailure(self):
+        logPath = os.path.join(self.folder, 'failed.log.gz')
+        call = ginst.SystemCall('seq 1 100; exit 2', tailLines=50, logPath=logPath)
+        message = call.describeFailure('It broke', numLines=2)
+        self.assertTrue(message.startswith('It broke (return code: 2)'))
+        self.assertIn('Full log: %s' % logPath, message)
+        self.assertTrue(message.endswith('Last 2 lines of output:\n99\n100'))
+
+    def test_resources(self):
+        script = ('import time\n'
+                  'block = bytearray(64 * 1024 * 1024)\n'
+                  'start = time.process_time()\n'
+                  'while time.process_time() - start < 0.3:\n'
+                  '    pass\n'
+                  'open(__import__("os").devnull, "wb").write(b"x" * 1024 * 1024)\n')
+        scriptPath = self.writeFile('busy.py', script)
+        # run through the shell, so what is measured is a child of the command
+        call = ginst.SystemCall('%s %s && true' % (sys.executable, scriptPath))
+        self.assertTrue(call.succeeded())
+        self.assertGreaterEqual(call.resources['maxRss'], 64 * 1024 * 1024)
+        self.assertGreaterEqual(call.resources['userTime'] + call.resources['systemTime'], 0.25)
+        self.assertGreaterEqual(call.resources['writeChars'], 1024 * 1024)
+        self.assertGreaterEqual(call.resources['wallTime'], 0.25)
+
+class DownloaderTests(TempFolderTestCase):
+    SIZE = 3 * 1024 * 1024 + 17
+
+    def setUp(self):
+        TempFolderTestCase.setUp(self)
+        self.data = os.urandom(self.SIZE)
+        self.writeFile('mirror/archive.bin', self.data, 'wb')
+        self.server = self.startServer(os.path.join(self.folder, 'mirror'))
+        self.url = self.server.getUrl('archive.bin')
+        self.destination = os.path.join(self.folder, 'downloaded.bin')
+
+    def readDestination(self):
+        with open(self.destination, 'rb') as f:
+            return f.read()
+
+    def test_rangeDownload(self):
+        downloader = ginst.Downloader(self.url, self.destination, connections=4, expectedSize=self.SIZE,
+                                      checksum=hashlib.sha256(self.data).hexdigest())
+        downloader.download()
+        self.assertEqual(self.readDestination(), self.data)
+        self.assertEqual(downloader.stats['bytes'], self.SIZE)
+        self.assertFalse(os.path.exists(downloader.partPath))
+        self.assertFalse(os.path.exists(downloader.statePath))
+        # a HEAD and one request per range
+        self.assertEqual(self.server.stats['requests'], 5)
+
+    def test_otherChecksumAlgorithms(self):
+        ginst.Downloader(self.url, self.destination, checksum=hashlib.sha512(self.data).hexdigest(), algorithm='sha512').download()
+        self.assertEqual(self.readDestination(), self.data)
+
+    def test_resume(self):
+        downloader = ginst.Downloader(self.url, self.destination, connections=2)
+        half = -(-self.SIZE // 2)
+        done = 1024 * 1024
+        ranges = [[0, half - 1, done], [half, self.SIZE - 1, done]]
+        with open(downloader.partPath, 'wb') as f:
+            f.truncate(self.SIZE)
+            for start, _, length in ranges:
+                f.seek(start)
+                f.write(self.data[start:start + length])
+        with open(downloader.statePath, 'w') as f:
+            json.dump({'resource': 'archive.bin', 'size': self.SIZE, 'ranges': ranges}, f)
+
+        downloader.download()
+        self.assertEqual(self.readDestination(), self.data)
+        self.assertEqual(downloader.stats['bytes'], self.SIZE - 2 * done)
+
+    def test_staleStateIsIgnored(self):
+        downloader = ginst.Downloader(self.url, self.destination, connections=2)
+        with open(downloader.partPath, 'wb') as f:
+            f.write(b'\0' * 10)
+        with open(downloader.statePath, 'w') as f:
+            json.dump({'resource': 'archive.bin', 'size': 10, 'ranges': [[0, 9, 10]]}, f)
+        downloader.download()
+        self.assertEqual(self.readDestination(), self.data)
+        self.assertEqual(downloader.stats['bytes'], self.SIZE)
+
+    def test_serverWithoutRanges(self):
+        server = self.startServer(os.path.join(self.folder, 'mirror'), ranges=False)
+        downloader = ginst.Downloader(server.getUrl('archive.bin'), self.destination, connections=4)
+        downloader.download()
+        self.assertEqual(self.readDestination(), self.data)
+        self.assertEqual(server.stats['requests'], 2)
+
+    def test_checksumMismatchDiscardsTheDownload(self):
+        downloader = ginst.Downloader(self.url, self.destination, checksum='0' * 64)
+        with self.assertRaises(EnvironmentError):
+            downloader.download()
+        for path in (self.destination, downloader.partPath, downloader.statePath):
+            self.assertFalse(os.path.exists(path))
+
+    def test_unexpectedSize(self):
+        with self.assertRaises(EnvironmentError):
+            ginst.Downloader(self.url, self.destination, expectedSize=self.SIZE + 1).download()
+        self.assertFalse(os.path.exists(self.destination))
+
+    def test_failover(self):
+        broken = self.startServer(os.path.join(self.folder, 'mirror'), failGets=True)
+        downloader = ginst.Downloader([broken.getUrl('archive.bin'), self.url], self.destination, connections=2)
+        downloader.download()
+        self.assertEqual(self.readDestination(), self.data)
+        self.assertEqual(downloader.failedMirrors, {broken.getUrl('archive.bin')})
+
+    def test_unreachableMirrorIsSkipped(self):
+        closedUrl = 'http://127.0.0.1:1/archive.bin'
+        ginst.Downloader([closedUrl, self.url], self.destination).download()
+        self.assertEqual(self.readDestination(), self.data)
+        with self.assertRaises(EnvironmentError):
+            ginst.Downloader([closedUrl, self.server.getUrl('missing.bin')], os.path.join(self.folder, 'other.bin')).download()
+
+    def test_pooledConnections(self):
+        pool = ginst.HttpConnectionPool()
+        self.addCleanup(pool.close)
+        ginst.Downloader(self.url, self.destination, connections=2, pool=pool).download()
+        ginst.Downloader(self.url, os.path.join(self.folder, 'again.bin'), connections=2, pool=pool).download()
+        self.assertEqual(self.readDestination(), self.data)
+        self.assertEqual(pool.stats['requests'], 6)
+        # the second download reuses the first one's connections
+        self.assertEqual(self.server.stats['connections'], pool.stats['connections'])
+        self.assertLessEqual(pool.stats['connections'], 2)
+
+    def test_cancel(self):
+        server = self.startServer(os.path.join(self.folder, 'mirror'), rate=512 * 1024)
+        cancelEvent = threading.Event()
+        downloader = ginst.Downloader(server.getUrl('archive.bin'), self.destination, connections=2, cancelEvent=cancelEvent)
+        threading.Timer(0.5, cancelEvent.set).start()
+        start = time.time()
+        with self.assertRaises(EnvironmentError):
+            downloader.download()
+        self.assertLess(time.time() - start, 3)
+        self.assertFalse(os.path.exists(self.destination))
+        # the progress is kept for the next run to resume
+        with open(downloader.statePath, 'r') as f:
+            self.assertGreater(sum(r[2] for r in json.load(f)['ranges']), 0)
+
+class SourceDownloadTests(GInstTestCase):
+    def test_sourceIsVerifiedAgainstTheReleaseChecksums(self):
+        archive = self.makeSourceArchive()
+        self.serveRelease(archive)
+        build = self.makeGInst()
+        build._fetchSource()
+        with open(build.compressedSourcePath, 'rb') as f:
+            self.assertEqual(f.read(), archive)
+        self.assertTrue(os.path.isfile(os.path.join(self.folder, 'gcc-%s' % self.VERSION, 'configure')))
+
+    def test_checksumMismatch(self):
+        self.serveRelease(self.makeSourceArchive(), checksum='f' * 128)
+        build = self.makeGInst()
+        with self.assertRaises(EnvironmentError):
+            build._fetchSource()
+        self.assertIsNone(build.sourceCache.get('gcc-%s.tar.gz' % self.VERSION))
+
+    def test_releaseWithoutChecksums(self):
+        self.serveRelease(self.makeSourceArchive(), checksum=False)
+        build = self.makeGInst()
+        with self.assertLogs(ginst.logger, 'WARNING') as logs:
+            build._fetchSource()
+        self.assertIn('publishes no sha512.sum', '\n'.join(logs.output))
+        self.assertTrue(os.path.isdir(os.path.join(self.folder, 'gcc-%s' % self.VERSION)))
+
+    def test_cachedSourceIsNotDownloadedAgain(self):
+        server = self.serveRelease(self.makeSourceArchive())
+        self.makeGInst()._fetchSource()
+        requests = server.stats['requests']
+        shutil.rmtree(os.path.join(self.folder, 'gcc-%s' % self.VERSION))
+        self.makeGInst()._fetchSource()
+        self.assertEqual(server.stats['requests'], requests)
+        self.assertTrue(os.path.isdir(os.path.join(self.folder, 'gcc-%s' % self.VERSION)))
+
+    def test_streamedSourceIsVerifiedAndCached(self):
+        archive = self.makeSourceArchive()
+        self.serveRelease(archive)
+        build = self.makeGInst(streaming=True)
+        with mock.patch.object(build, '_downloadSource', side_effect=AssertionError('not streamed')):
+            build._fetchSource()
+        self.assertTrue(os.path.isfile(os.path.join(self.folder, 'gcc-%s' % self.VERSION, 'configure')))
+        with open(build.compressedSourcePath, 'rb') as f:
+            self.assertEqual(f.read(), archive)
+
+    def test_unverifiedStreamIsDiscarded(self):
+        self.serveRelease(self.makeSourceArchive(), checksum='f' * 128)
+        build = self.makeGInst(streaming=True)
+        # the regular download that streaming falls back to fails the same check
+        with self.assertRaises(EnvironmentError):
+            build._fetchSource()
+        self.assertFalse(os.path.exists(os.path.join(self.folder, 'gcc-%s' % self.VERSION)))
+        self.assertIsNone(build.sourceCache.get('gcc-%s.tar.gz' % self.VERSION))
+        self.assertEqual(os.listdir(build.sourceCache.downloadsFolder), [])
+
+    def test_tarExtractsByDefault(self):
+        self.serveRelease(self.makeSourceArchive())
+        with mock.patch.object(ginst.ParallelExtractor, 'extract', side_effect=AssertionError('not opted in')):
+            self.makeGInst()._fetchSource()
+        self.assertTrue(os.path.isfile(os.path.join(self.folder, 'gcc-%s' % self.VERSION, 'configure')))
+
+    def test_inProcessExtractionIsOptIn(self):
+        self.serveRelease(self.makeSourceArchive())
+        with mock.patch.object(ginst.ParallelExtractor, 'getParallelDecompressor', return_value=None), \
+                mock.patch.object(ginst.ParallelExtractor, 'extract', autospec=True) as extract:
+            self.makeGInst(extractThreads=2)._fetchSource()
+        self.assertEqual(extract.call_args[0][0].threads, 2)
+
+class SourceCacheTests(TempFolderTestCase):
+    def setUp(self):
+        TempFolderTestCase.setUp(self)
+        self.cache = ginst.SourceCache(os.path.join(self.folder, 'cache'), maxBytes=2500)
+
+    def put(self, name, content):
+        return self.cache.put(name, self.writeFile('incoming/%s' % name, content))
+
+    def test_putAndGet(self):
+        path = self.put('gcc-1.0.0.tar.gz', 'one')
+        self.assertEqual(os.path.basename(path), hashlib.sha256(b'one').hexdigest())
+        self.assertEqual(self.cache.get('gcc-1.0.0.tar.gz'), path)
+        self.assertIsNone(self.cache.get('gcc-2.0.0.tar.gz'))
+        self.assertFalse(os.path.exists(os.path.join(self.folder, 'incoming', 'gcc-1.0.0.tar.gz')))
+
+    def test_identicalArchivesAreStoredOnce(self):
+        self.assertEqual(self.put('a.tar.gz', 'same'), self.put('b.tar.gz', 'same'))
+        self.assertEqual(len(os.listdir(self.cache.objectsFolder)), 1)
+
+    def test_corruptEntryIsDropped(self):
+        path = self.put('gcc-1.0.0.tar.gz', 'one')
+        with open(path, 'w') as f:
+            f.write('two')
+        self.assertIsNone(self.cache.get('gcc-1.0.0.tar.gz'))
+        self.assertFalse(os.path.exists(path))
+        with open(self.cache.indexPath, 'r') as f:
+            self.assertEqual(json.load(f), {})
+
+    def test_missingObjectIsDropped(self):
+        os.remove(self.put('gcc-1.0.0.tar.gz', 'one'))
+        self.assertIsNone(self.cache.get('gcc-1.0.0.tar.gz'))
+
+    def test_leastRecentlyUsedIsEvicted(self):
+        now = time.time()
+        first = self.put('first.tar.gz', 'a' * 1000)
+        second = self.put('second.tar.gz', 'b' * 1000)
+        os.utime(first, (now - 100, now - 100))
+        os.utime(second, (now - 50, now - 50))
+        # using the first archive makes the second the least recently used one
+        self.cache.get('first.tar.gz')
+        third = self.put('third.tar.gz', 'c' * 1000)
+        self.assertIsNone(self.cache.get('second.tar.gz'))
+        self.assertEqual(self.cache.get('first.tar.gz'), first)
+        self.assertEqual(self.cache.get('third.tar.gz'), third)
+        self.assertFalse(os.path.exists(second))
+
+class StreamingExtractorTests(TempFolderTestCase):
+    FILES = {'pkg': None, 'pkg/bin': None, 'pkg/bin/tool': '#!/bin/sh\n', 'pkg/data.txt': 'x' * 200000}
+
+    def setUp(self):
+        TempFolderTestCase.setUp(self)
+        self.archive = self.makeTarball(self.FILES)
+        self.writeFile('mirror/pkg.tar.gz', self.archive, 'wb')
+        self.destination = os.path.join(self.folder, 'out')
+
+    def test_extractsWhileDownloading(self):
+        server = self.startServer(os.path.join(self.folder, 'mirror'), rate=1024 * 1024)
+        teePath = os.path.join(self.folder, 'pkg.tar.gz')
+        extractor = ginst.StreamingExtractor(server.getUrl('pkg.tar.gz'), self.destination, teePath=teePath,
+                                             checksum=hashlib.sha512(self.archive).hexdigest(), algorithm='sha512')
+        extractor.run()
+        with open(os.path.join(self.destination, 'pkg', 'data.txt'), 'r') as f:
+            self.assertEqual(f.read(), self.FILES['pkg/data.txt'])
+        self.assertTrue(os.access(os.path.join(self.destination, 'pkg', 'bin', 'tool'), os.X_OK))
+        with open(teePath, 'rb') as f:
+            self.assertEqual(f.read(), self.archive)
+        self.assertEqual(extractor.stats['bytes'], len(self.archive))
+
+    def test_otherCompressions(self):
+        for extension, mode in (('.tar.xz', 'w:xz'), ('.tar.bz2', 'w:bz2'), ('.tar', 'w')):
+            self.writeFile('mirror/pkg%s' % extension, self.makeTarball(self.FILES, mode), 'wb')
+        server = self.startServer(os.path.join(self.folder, 'mirror'))
+        for extension in ('.tar.xz', '.tar.bz2', '.tar'):
+            destination = os.path.join(self.folder, 'out%s' % extension)
+            ginst.StreamingExtractor(server.getUrl('pkg%s' % extension), destination).run()
+            self.assertTrue(os.path.isfile(os.path.join(destination, 'pkg', 'data.txt')))
+
+    def test_checksumMismatch(self):
+        server = self.startServer(os.path.join(self.folder, 'mirror'))
+        with self.assertRaisesRegex(EnvironmentError, 'Checksum mismatch'):
+            ginst.StreamingExtractor(server.getUrl('pkg.tar.gz'), self.destination, checksum='0' * 64).run()
+
+    def test_corruptArchive(self):
+        self.writeFile('mirror/corrupt.tar.gz', self.archive[:2] + b'\0' * 4096, 'wb')
+        server = self.startServer(os.path.join(self.folder, 'mirror'))
+        with self.assertRaisesRegex(EnvironmentError, 'Unable to extract'):
+            ginst.StreamingExtractor(server.getUrl('corrupt.tar.gz'), self.destination).run()
+
+    def test_missingArchive(self):
+        server = self.startServer(os.path.join(self.folder, 'mirror'))
+        with self.assertRaises(EnvironmentError):
+            ginst.StreamingExtractor(server.getUrl('missing.tar.gz'), self.destination).run()
+
+    def test_cancel(self):
+        self.writeFile('mirror/big.tar', self.makeTarball({'big.bin': os.urandom(4 * 1024 * 1024)}, 'w'), 'wb')
+        server = self.startServer(os.path.join(self.folder, 'mirror'), rate=512 * 1024)
+        cancelEvent = threading.Event()
+        threading.Timer(0.5, cancelEvent.set).start()
+        start = time.time()
+        with self.assertRaisesRegex(EnvironmentError, 'cancelled'):
+            ginst.StreamingExtractor(server.getUrl('big.tar'), self.destination, cancelEvent=cancelEvent).run()
+        self.assertLess(time.time() - start, 3)
+
+class ParallelExtractorTests(TempFolderTestCase):
+    def writeArchive(self, files, mode='w:gz'):
+        return self.writeFile('archive.tar', self.makeTarball(files, mode), 'wb')
+
+    def test_extractsFilesAndLinks(self):
+        files = dict(('src/file%03d.c' % i, 'int f%d;\n' % i) for i in range(600))
+        files.update({'src': None, 'src/bin/run.sh': '#!/bin/sh\n', 'src/big.bin': os.urandom(5 * 1024 * 1024)})
+        data = io.BytesIO()
+        with tarfile.open(fileobj=data, mode='w:gz') as tar:
+            for name in sorted(files):
+                info = tarfile.TarInfo(name)
+                if files[name] is None:
+                    info.type = tarfile.DIRTYPE
+                    tar.addfile(info)
+                    continue
+                content = files[name].encode() if isinstance(files[name], str) else files[name]
+                info.size = len(content)
+                info.mode = 0o755 if name.endswith('.sh') else 0o644
+                tar.addfile(info, io.BytesIO(content))
+            symlink = tarfile.TarInfo('src/link.c')
+            symlink.type, symlink.linkname = tarfile.SYMTYPE, 'file001.c'
+            tar.addfile(symlink)
+            hardlink = tarfile.TarInfo('src/hard.c')
+            hardlink.type, hardlink.linkname = tarfile.LNKTYPE, 'src/file002.c'
+            tar.addfile(hardlink)
+        archivePath = self.writeFile('archive.tar.gz', data.getvalue(), 'wb')
+
+        extractor = ginst.ParallelExtractor(os.path.join(self.folder, 'out'), threads=4)
+        extractor.extract(archivePath)
+        out = os.path.join(self.folder, 'out', 'src')
+        self.assertEqual(extractor.stats['files'], 602)
+        with open(os.path.join(out, 'file599.c'), 'r') as f:
+            self.assertEqual(f.read(), 'int f599;\n')
+        with open(os.path.join(out, 'big.bin'), 'rb') as f:
+            self.assertEqual(f.read(), files['src/big.bin'])
+        self.assertTrue(os.access(os.path.join(out, 'bin', 'run.sh'), os.X_OK))
+        self.assertEqual(os.readlink(os.path.join(out, 'link.c')), 'file001.c')
+        self.assertEqual(os.stat(os.path.join(out, 'hard.c')).st_ino, os.stat(os.path.join(out, 'file002.c')).st_ino)
+
+    def test_refusesMembersOutsideTheFolder(self):
+        for name in ('../evil.txt', '/tmp/evil.txt', 'ok/../../evil.txt'):
+            with self.assertRaisesRegex(EnvironmentError, 'Refusing'):
+                ginst.ParallelExtractor(os.path.join(self.folder, 'out')).extract(self.writeArchive({name: 'evil'}))
+        self.assertFalse(os.path.exists(os.path.join(self.folder, 'evil.txt')))
+
+    def test_rootMember(self):
+        # what tar -C <folder> . writes: the folder itself comes first, as ./
+        source = os.path.join(self.folder, 'prefix')
+        self.writeFile('prefix/bin/tool', 'tool')
+        archivePath = os.path.join(self.folder, 'prefix.tar.xz')
+        subprocess.check_call(['tar', '-cJf', archivePath, '-C', source, '.'])
+        ginst.ParallelExtractor(os.path.join(self.folder, 'out')).extract(archivePath)
+        self.assertTrue(os.path.isfile(os.path.join(self.folder, 'out', 'bin', 'tool')))
+        with self.assertRaisesRegex(EnvironmentError, 'Refusing'):
+            ginst.ParallelExtractor(os.path.join(self.folder, 'out')).extract(self.writeArchive({'.': 'not a folder'}))
+
+    def test_corruptArchive(self):
+        with self.assertRaises(EnvironmentError):
+            ginst.ParallelExtractor(os.path.join(self.folder, 'out')).extract(self.writeFile('bad.tar.gz', b'\x1f\x8b' + b'\0' * 100, 'wb'))
+
+    def test_cancel(self):
+        cancelEvent = threading.Event()
+        cancelEvent.set()
+        with self.assertRaisesRegex(EnvironmentError, 'cancelled'):
+            ginst.ParallelExtractor(os.path.join(self.folder, 'out'), cancelEvent=cancelEvent).extract(self.writeArchive({'a.txt': 'a'}))
+
+class MirrorRankerTests(TempFolderTestCase):
+    def setUp(self):
+        TempFolderTestCase.setUp(self)
+        self.writeFile('mirror/gcc.tar.gz', os.urandom(ginst.MirrorRanker.PROBE_BYTES), 'wb')
+        self.rankingPath = os.path.join(self.folder, 'mirrors.json')
+        self.ranker = ginst.MirrorRanker(self.rankingPath, halfLife=60, reprobeInterval=3600)
+
+    def writeRanking(self, ranking):
+        with open(self.rankingPath, 'w') as f:
+            json.dump(ranking, f)
+
+    def test_ranksByMeasuredBandwidth(self):
+        fast = self.startServer(os.path.join(self.folder, 'mirror'))
+        slow = self.startServer(os.path.join(self.folder, 'mirror'), rate=1024 * 1024)
+        dead = 'http://127.0.0.1:1/gcc.tar.gz'
+        urls = [slow.getUrl('gcc.tar.gz'), dead, fast.getUrl('gcc.tar.gz')]
+        self.assertEqual(self.ranker.rank(urls), [urls[2], urls[0], urls[1]])
+        with open(self.rankingPath, 'r') as f:
+            ranking = json.load(f)
+        self.assertGreater(ranking['127.0.0.1:%d' % fast.server_address[1]]['score'], ranking['127.0.0.1:%d' % slow.server_address[1]]['score'])
+        self.assertEqual(ranking['127.0.0.1:1']['score'], 0.0)
+
+        # measurements are reused until they are older than reprobeInterval
+        requests = fast.stats['requests'], slow.stats['requests']
+        self.assertEqual(self.ranker.rank(urls), [urls[2], urls[0], urls[1]])
+        self.assertEqual((fast.stats['requests'], slow.stats['requests']), requests)
+
+    def test_oldScoresDecay(self):
+        now = time.time()
+        self.writeRanking({
+            'slow.example': {'score': 2.0, 'latency': 0.1, 'updated': now, 'probed': now},
+            'fast.example': {'score': 10.0, 'latency': 0.1, 'updated': now - 10 * 60, 'probed': now},
+            'new.example': {'score': 1.0, 'latency': 0.1, 'updated': now, 'probed': now},
+        })
+        urls = ['http://fast.example/gcc.tar.gz', 'http://slow.example/gcc.tar.gz', 'http://new.example/gcc.tar.gz']
+        self.assertEqual(self.ranker.rank(urls), [urls[1], urls[2], urls[0]])
+
+    def test_failuresDropAMirror(self):
+        now = time.time()
+        self.writeRanking({
+            'slow.example': {'score': 4.0, 'latency': 0.1, 'updated': now, 'probed': now},
+            'fast.example': {'score': 10.0, 'latency': 0.1, 'updated': now, 'probed': now},
+        })
+        urls = ['http://fast.example/gcc.tar.gz', 'http://slow.example/gcc.tar.gz']
+        self.ranker.recordFailures([urls[0]])
+        self.ranker.recordFailures([urls[0]])
+        self.assertEqual(self.ranker.rank(urls), [urls[1], urls[0]])
+
+class VersionCatalogueTests(TempFolderTestCase):
+    VERSIONS = ['9.5.0', '10.1.0', '12.1.0', '12.3.0', '12.2.0', '13.1.0', '9.1.0']
+
+    def makeCatalogue(self, fetched=None, **kwargs):
+        cachePath = self.writeFile('versions.json', json.dumps({
+            'fetched': time.time() if fetched is None else fetched, 'modified': _FtpHandler.modified, 'versions': self.VERSIONS}))
+        return ginst.VersionCatalogue(cachePath, **kwargs)
+
+    def startFtpServer(self, modified=_FtpHandler.modified, listing=()):
+        handler = type('Handler', (_FtpHandler,), {'modified': modified, 'listing': list(listing)})
+        server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), handler)
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server.server_address[1]
+
+    def test_versionsAreSortedNumerically(self):
+        self.assertEqual(self.makeCatalogue().getVersions(), ['9.1.0', '9.5.0', '10.1.0', '12.1.0', '12.2.0', '12.3.0', '13.1.0'])
+
+    def test_query(self):
+        catalogue = self.makeCatalogue()
+        self.assertEqual(catalogue.query('latest'), ['13.1.0'])
+        self.assertEqual(catalogue.query('latest 12.x'), ['12.3.0'])
+        self.assertEqual(catalogue.query('latest 12'), ['12.3.0'])
+        self.assertEqual(catalogue.query('12.x'), ['12.1.0', '12.2.0', '12.3.0'])
+        self.assertEqual(catalogue.query('9.x'), ['9.1.0', '9.5.0'])
+        self.assertEqual(catalogue.query('>= 12.2'), ['12.2.0', '12.3.0', '13.1.0'])
+        self.assertEqual(catalogue.query(' 10.1.0 '), ['10.1.0'])
+        self.assertEqual(catalogue.query('11.x'), [])
+        self.assertEqual(catalogue.query('latest 11.x'), [])
+        self.assertEqual(catalogue.query('10.2.0'), [])
+
+    def test_invalidQueries(self):
+        catalogue = self.makeCatalogue()
+        for spec in ('latest foo', 'foo.x', '>= x', '12.x.1', ''):
+            with self.assertRaisesRegex(EnvironmentError, 'No gcc version matches'):
+                catalogue.query(spec)
+        with mock.patch.object(ginst.GccVersion, 'catalogue', catalogue):
+            with self.assertRaises(EnvironmentError):
+                ginst.GccVersion.resolveVersionString('foo.x')
+            self.assertEqual(ginst.GccVersion.resolveVersionString('latest 12.x'), '12.3.0')
+
+    def test_unchangedFolderIsNotListedAgain(self):
+        port = self.startFtpServer(listing=['1.0.0'])
+        catalogue = self.makeCatalogue(fetched=0, ftpHost='127.0.0.1', ftpPort=port)
+        catalogue.refresh()
+        self.assertEqual(catalogue.query('latest'), ['13.1.0'])
+        with open(catalogue.cachePath, 'r') as f:
+            self.assertGreater(json.load(f)['fetched'], 0)
+
+    def test_staleListingIsRefreshedInTheBackground(self):
+        port = self.startFtpServer(modified='20270101000000', listing=['13.1.0', '14.1.0', '14.2.0'])
+        catalogue = self.makeCatalogue(fetched=0, ftpHost='127.0.0.1', ftpPort=port)
+        # the stale listing is answered from straight away
+        self.assertEqual(catalogue.query('latest'), ['13.1.0'])
+        catalogue._refreshThread.join(10)
+        self.assertEqual(catalogue.getVersions(), ['13.1.0', '14.1.0', '14.2.0'])
+        self.assertEqual(catalogue.query('latest 14'), ['14.2.0'])
+
+    def test_missingCacheIsFetched(self):
+        port = self.startFtpServer(listing=['8.1.0', '8.10.0', '8.2.0'])
+        catalogue = ginst.VersionCatalogue(os.path.join(self.folder, 'new', 'versions.json'), ftpHost='127.0.0.1', ftpPort=port)
+        self.assertEqual(catalogue.getVersions(), ['8.1.0', '8.2.0', '8.10.0'])
+        self.assertTrue(os.path.isfile(os.path.join(self.folder, 'new', 'versions.json')))
+
+class IncrementalBuildTests(GInstTestCase):
+    def configure(self, build):
+        build._moveToUncompressedSourceFolder()
+        build._makeAndEnterBuildDirectory()
+        build._configureBuild()
+        with open(os.path.join(build.gccVersion.getLocalBuildPath(), 'configure.runs'), 'r') as f:
+            return len(f.readlines())
+
+    def test_matchingBuildIsReused(self):
+        self.makeSourceTree()
+        self.assertEqual(self.configure(self.makeGInst(incremental=True)), 1)
+        build = self.makeGInst(incremental=True)
+        self.assertEqual(self.configure(build), 1)
+        self.assertTrue(build._reuseBuild)
+
+    def test_changedSourcesRebuild(self):
+        sourcePath = self.makeSourceTree()
+        self.configure(self.makeGInst(incremental=True))
+        with open(os.path.join(sourcePath, 'README'), 'a') as f:
+            f.write('patched\n')
+        build = self.makeGInst(incremental=True)
+        self.assertEqual(self.configure(build), 2)
+        self.assertFalse(build._reuseBuild)
+
+    def test_changedConfigureArgumentsReconfigure(self):
+        self.makeSourceTree()
+        self.configure(self.makeGInst(incremental=True))
+        build = self.makeGInst(incremental=True)
+        build.gccVersion.extraConfigureArgs = '--disable-nls'
+        self.assertEqual(self.configure(build), 2)
+        # same sources and toolchain, so the objects are still reused
+        self.assertTrue(build._reuseBuild)
+
+    def test_withoutIncrementalConfigureAlwaysRuns(self):
+        self.makeSourceTree()
+        self.configure(self.makeGInst())
+        self.assertEqual(self.configure(self.makeGInst()), 2)
+
+class StageResumeTests(GInstTestCase):
+    def setUp(self):
+        GInstTestCase.setUp(self)
+        self.calls = []
+        self.inputs = {'download': 'gcc.tar.gz', 'configure': '--prefix=/a'}
+        self.outputs = {'download': True, 'configure': True}
+        self.failing = None
+
+    def stage(self, name):
+        def run():
+            self.calls.append(name)
+            if name == self.failing:
+                raise EnvironmentError("%s failed" % name)
+        return run
+
+    def getStages(self):
+        return [
+            ('download', self.stage('download'), lambda: self.inputs['download'], lambda: self.outputs['download']),
+            ('enter', self.stage('enter'), None, None),
+            ('configure', self.stage('configure'), lambda: self.inputs['configure'], lambda: self.outputs['configure']),
+            ('make', self.stage('make'), lambda: '', lambda: True),
+        ]
+
+    def runStages(self, resume=True):
+        self.calls = []
+        self.makeGInst(resume=resume)._runStages(self.getStages())
+        return self.calls
+
+    def test_completedStagesAreSkipped(self):
+        self.assertEqual(self.runStages(), ['download', 'enter', 'configure', 'make'])
+        # stages without inputs always run
+        self.assertEqual(self.runStages(), ['enter'])
+
+    def test_changedInputsRunTheStageAndEverythingAfterIt(self):
+        self.runStages()
+        self.inputs['configure'] = '--prefix=/b'
+        self.assertEqual(self.runStages(), ['enter', 'configure', 'make'])
+        self.inputs['download'] = 'gcc-other.tar.gz'
+        self.assertEqual(self.runStages(), ['download', 'enter', 'configure', 'make'])
+
+    def test_missingOutputsRunTheStageAgain(self):
+        self.runStages()
+        self.outputs['configure'] = False
+        self.assertEqual(self.runStages(), ['enter', 'configure', 'make'])
+
+    def test_resumeAfterAFailure(self):
+        self.failing = 'configure'
+        with self.assertRaises(EnvironmentError):
+            self.runStages()
+        self.failing = None
+        self.assertEqual(self.runStages(), ['enter', 'configure', 'make'])
+
+    def test_withoutResumeEverythingRuns(self):
+        self.runStages()
+        self.assertEqual(self.runStages(resume=False), ['download', 'enter', 'configure', 'make'])
+        # and the state starts over
+        self.assertEqual(self.runStages(), ['enter'])
+
+class JobServerTests(TempFolderTestCase):
+    MAKEFILE = ('JOBS := a b c d e f\n'
+                'all: $(JOBS)\n'
+                '$(JOBS):\n'
+                '\t@echo start >> %(log)s; sleep 0.3; echo end >> %(log)s\n')
+
+    def countTokens(self, jobServer):
+        os.set_blocking(jobServer.readFd, False)
+        try:
+            tokens = os.read(jobServer.readFd, 1024)
+        except BlockingIOError:
+            tokens = b''
+        finally:
+            os.set_blocking(jobServer.readFd, True)
+        if tokens:
+            os.write(jobServer.writeFd, tokens)
+        return len(tokens)
+
+    def test_slotsHoldATokenEach(self):
+        jobServer = ginst.JobServer(3)
+        self.addCleanup(jobServer.close)
+        self.assertEqual(self.countTokens(jobServer), 3)
+        with jobServer.slot():
+            self.assertEqual(self.countTokens(jobServer), 2)
+            with jobServer.slot():
+                self.assertEqual(self.countTokens(jobServer), 1)
+        self.assertEqual(self.countTokens(jobServer), 3)
+
+    def test_concurrentMakesShareTheSlots(self):
+        jobServer = ginst.JobServer(3)
+        self.addCleanup(jobServer.close)
+        logPath = os.path.join(self.folder, 'jobs.log')
+        makefile = self.writeFile('Makefile', self.MAKEFILE % {'log': logPath})
+        calls = []
+
+        def runMake():
+            with jobServer.slot():
+                calls.append(ginst.SystemCall('make -f %s' % makefile, cwd=self.folder, env=jobServer.getEnvironment(), passFds=jobServer.fds))
+
+        threads = [threading.Thread(target=runMake) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(all(call.succeeded() for call in calls))
+        running = peak = 0
+        with open(logPath, 'r') as f:
+            for line in f:
+                running += 1 if line.strip() == 'start' else -1
+                peak = max(peak, running)
+        self.assertEqual(peak, 3)
+        self.assertEqual(self.countTokens(jobServer), 3)
+
+class AdaptiveJobControllerTests(unittest.TestCase):
+    GB = 1024 ** 3
+
+    def setUp(self):
+        self.memory = {'MemTotal': 16 * self.GB, 'MemAvailable': 2.5 * self.GB}
+        for name, value in (('readMemInfo', lambda: dict(self.memory)), ('readMemoryPressure', lambda: None)):
+            patcher = mock.patch.object(ginst.AdaptiveJobController, name, staticmethod(value))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.jobServer = ginst.JobServer(4, adaptive=True)
+        self.jobServer.controller.interval = 0.05
+        self.addCleanup(self.jobServer.close)
+
+    def waitFor(self, condition):
+        deadline = time.time() + 5
+        while not condition() and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertTrue(condition())
+
+    def test_tokensFollowAvailableMemory(self):
+        controller = self.jobServer.controller
+        with self.jobServer.slot():
+            # 90% of 2.5 GB at 1 GB per job leaves room for 2 of the 4 slots
+            self.waitFor(lambda: controller.target == 2 and controller._withheld == 2)
+            self.memory['MemAvailable'] = 12 * self.GB
+            self.waitFor(lambda: controller.target == 4 and controller._withheld == 0)
+        self.assertEqual(controller._withheld, 0)
+
+    def test_pressureAndHeavyPhases(self):
+        controller = self.jobServer.controller
+        controller._baselineUsed = 0
+        meminfo = {'MemTotal': 16 * self.GB, 'MemAvailable': 16 * self.GB}
+        self.assertEqual(controller.computeTarget(meminfo, None), 4)
+        controller.target = 4
+        self.assertEqual(controller.computeTarget(meminfo, 50.0), 3)
+        controller.onMakeOutput('lto-wrapper -fresolution=foo.res')
+        self.assertEqual(controller.phase, 'lto')
+        self.assertGreaterEqual(controller.jobMemory, ginst.MAKE_HEAVY_JOB_MEMORY_ESTIMATE)
+
+class BuildProfilerTests(TempFolderTestCase):
+    def test_stagesAndMakePhases(self):
+        profiler = ginst.BuildProfiler('gcc-test', sampleInterval=0.05)
+        profiler.startSampling()
+        with profiler.span('configure'):
+            time.sleep(0.1)
+        with profiler.span('make'):
+            profiler.onMakeOutput('Configuring stage 1 in ./gcc')
+            time.sleep(0.05)
+            profiler.onMakeOutput('make[2]: Entering directory')
+            profiler.onMakeOutput('Configuring stage 2 in ./gcc')
+            time.sleep(0.05)
+            profiler.endMakePhases()
+        profiler.stopSampling()
+
+        spans = profiler.getTimeline()['spans']
+        self.assertEqual([(s['category'], s['name']) for s in spans],
+                         [('stage', 'configure'), ('stage', 'make'), ('make', 'stage1'), ('make', 'stage2')])
+        self.assertGreaterEqual(spans[0]['duration'], 0.1)
+        self.assertTrue(profiler.getTimeline()['cpuSamples'])
+
+        profiler.write(self.folder)
+        with open(os.path.join(self.folder, 'trace.json'), 'r') as f:
+            events = json.load(f)['traceEvents']
+        self.assertEqual(sorted(e['name'] for e in events if e['ph'] == 'X'), ['configure', 'make', 'stage1', 'stage2'])
+        self.assertTrue(any(e['ph'] == 'C' for e in events))
+        self.assertTrue(os.path.isfile(os.path.join(self.folder, 'timeline.json')))
+
+class ResourceSummaryTests(TempFolderTestCase):
+    def test_stepsAndTotals(self):
+        summary = ginst.ResourceSummary('gcc-test')
+        for step, resources in (('make', {'userTime': 10.0, 'systemTime': 1.0, 'maxRss': 100, 'wallTime': 5.0}),
+                                ('make', {'userTime': 5.0, 'systemTime': 1.0, 'maxRss': 300, 'wallTime': 2.0}),
+                                ('install', {'userTime': 1.0, 'systemTime': 0.5, 'maxRss': 50, 'wallTime': 1.0})):
+            summary.add(step, mock.Mock(resources=resources))
+        self.assertEqual(summary.steps['make']['calls'], 2)
+        self.assertEqual(summary.steps['make']['userTime'], 15.0)
+        self.assertEqual(summary.steps['make']['maxRss'], 300)
+        totals = summary.getTotals()
+        self.assertEqual(totals['cpuTime'], 18.5)
+        self.assertEqual(totals['maxRss'], 300)
+
+        historyPath = os.path.join(self.folder, 'history.jsonl')
+        summary.write(os.path.join(self.folder, 'run1'), historyPath)
+        summary.write(os.path.join(self.folder, 'run2'), historyPath)
+        with open(historyPath, 'r') as f:
+            self.assertEqual(len(f.readlines()), 2)
+        with open(os.path.join(self.folder, 'run2', 'resources.json'), 'r') as f:
+            self.assertEqual(json.load(f)['totals']['wallTime'], 8.0)
+
+class CcacheTests(GInstTestCase):
+    STATS = 'direct_cache_hit\t%d\npreprocessed_cache_hit\t%d\ncache_miss\t%d\n'
+
+    def installFakeCcache(self, hits, misses):
+        statsPath = self.writeFile('ccache.stats', self.STATS % (hits, 0, misses))
+        self.writeFile('bin/ccache', '#!/bin/sh\n[ "$1" = --print-stats ] && cat %s\n' % statsPath, executable=True)
+        patcher = mock.patch.dict(os.environ, {'PATH': '%s%s%s' % (os.path.join(self.folder, 'bin'), os.pathsep, os.environ['PATH'])})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.patch(ginst.HostProfile, 'instance', ginst.HostProfile(os.path.join(self.folder, 'host.json')))
+        return statsPath
+
+    def test_compilersGoThroughCcache(self):
+        self.installFakeCcache(0, 0)
+        environment = self.makeGInst(ccache=True)._getBuildEnvironment()
+        self.assertEqual(environment['CC'], 'ccache %s' % os.environ.get('CC', 'gcc'))
+        self.assertEqual(environment['CCACHE_COMPILERCHECK'], 'content')
+        self.assertEqual(self.makeGInst()._getBuildEnvironment(), {})
+
+    def test_missingCcache(self):
+        with mock.patch.object(ginst.HostProfile, 'which', return_value=None):
+            self.assertEqual(self.makeGInst(ccache=True)._getBuildEnvironment(), {})
+
+    def test_hitRate(self):
+        statsPath = self.installFakeCcache(10, 5)
+        build = self.makeGInst(ccache=True)
+        before = build._readCcacheStats()
+        self.assertEqual(before, (10, 5))
+        with open(statsPath, 'w') as f:
+            f.write(self.STATS % (40, 5, 15))
+        with self.assertLogs(ginst.logger, 'INFO') as logs:
+            build._logCcacheStats(before)
+        self.assertIn('ccache: 35 hits, 10 misses (77.8% hit rate)', logs.output[0])
+
+class BuildProfileTests(GInstTestCase):
+    MAKEFILE = ''.join('%s:\n\t@echo %s >> targets.log\n' % (target, target)
+                       for target in ('all', 'clean', 'install', 'stageprofile-bubble', 'profiledbootstrap'))
+
+    def makeTargets(self, build):
+        '''
+        Runs the make stage against a Makefile that records its targets
+        '''
+        buildPath = build.gccVersion.getLocalBuildPath()
+        os.makedirs(buildPath)
+        with open(os.path.join(buildPath, 'Makefile'), 'w') as f:
+            f.write(self.MAKEFILE)
+        build.cwd = buildPath
+        build._make()
+        with open(os.path.join(buildPath, 'targets.log'), 'r') as f:
+            return f.read().split()
+
+    def test_configureArguments(self):
+        fast = ginst.GccVersion('12.2.0', profile='fast')
+        self.assertIn('--disable-bootstrap', fast.getConfigureArguments())
+        self.assertIn('--enable-languages=c ', fast.getConfigureArguments())
+        optimized = ginst.GccVersion('12.2.0', profile='optimized')
+        self.assertIn('--with-build-config=bootstrap-lto', optimized.getConfigureArguments())
+        self.assertEqual(optimized.getMakeTarget(), 'profiledbootstrap')
+        with self.assertRaises(AttributeError):
+            ginst.GccVersion('12.2.0', profile='ludicrous')
+
+    def test_profilesBuildSideBySide(self):
+        standard = ginst.GccVersion('12.2.0')
+        fast = ginst.GccVersion('12.2.0', profile='fast')
+        self.assertEqual((standard.getBuildName(), fast.getBuildName()), ('gcc-12.2.0', 'gcc-12.2.0-fast'))
+        self.assertNotEqual(standard.getLocalBuildPath(), fast.getLocalBuildPath())
+        self.assertNotEqual(standard.getInstallPrefix(), fast.getInstallPrefix())
+
+    def test_makeTargets(self):
+        self.assertEqual(self.makeTargets(self.makeGInst()), ['clean', 'all'])
+        self.assertEqual(self.makeTargets(self.makeGInst(profile='optimized')), ['clean', 'profiledbootstrap'])
+
+    def test_profileCostsAreCompared(self):
+        for profile, wallTime in (('standard', 100.0), ('fast', 25.0)):
+            self.makeGInst(profile=profile)._recordProfileCost(wallTime)
+        with open(ginst.GCC_PROFILE_HISTORY_PATH, 'r') as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual([(r['profile'], r['wallTime']) for r in records], [('standard', 100.0), ('fast', 25.0)])
+
+class CompilerBenchmarkTests(GInstTestCase):
+    def makeCompiler(self, name, seconds):
+        return self.writeFile('bin/%s' % name, '#!/bin/sh\nsleep %s\n' % seconds, executable=True)
+
+    def test_compare(self):
+        self.writeFile('sources/a.c', 'int a;\n')
+        self.writeFile('sources/b.cpp', 'int b;\n')
+        self.writeFile('sources/notes.txt', '')
+        benchmark = ginst.CompilerBenchmark(os.path.join(self.folder, 'sources'), repeats=1)
+        results = benchmark.compare((self.makeCompiler('fast-cc', 0.05), self.makeCompiler('fast-cxx', 0.05)),
+                                    (self.makeCompiler('slow-cc', 0.3), self.makeCompiler('slow-cxx', 0.3)))
+        self.assertEqual(sorted(results['candidate']['times']), ['a.c', 'b.cpp'])
+        self.assertGreater(results['speedup'], 2)
+
+    def test_trainingCommand(self):
+        self.writeFile('sources/a.c', 'int a;\n')
+        self.writeFile('sources/b.cpp', 'int b;\n')
+        command = ginst.CompilerBenchmark(os.path.join(self.folder, 'sources')).getTrainingCommand()
+        call = ginst.SystemCall(command, env={'CC': 'gcc', 'CXX': 'g++'})
+        self.assertTrue(call.succeeded(), call.output)
+        self.assertIn('$CXX -std=c++17 -O2 -c', command)
+
+    def test_trainingWorkloadRunsBetweenTheProfileStages(self):
+        build = self.makeGInst(profile='optimized', trainingWorkload='echo trained >> targets.log')
+        self.assertEqual(BuildProfileTests.makeTargets(BuildProfileTests('makeTargets'), build),
+                         ['clean', 'stageprofile-bubble', 'trained', 'profiledbootstrap'])
+
+    def test_referenceMessages(self):
+        with self.assertLogs(ginst.logger, 'INFO') as logs:
+            self.makeGInst()._benchmarkCompiler()
+        self.assertIn('This is the standard build of gcc %s' % self.VERSION, '\n'.join(logs.output))
+        with self.assertLogs(ginst.logger, 'INFO') as logs:
+            self.makeGInst(profile='fast-compiler')._benchmarkCompiler()
+        self.assertIn('The reference (standard) build of gcc %s is missing' % self.VERSION, '\n'.join(logs.output))
+
+class ScratchBuildFolderTests(TempFolderTestCase):
+    def setUp(self):
+        TempFolderTestCase.setUp(self)
+        self.scratch = ginst.ScratchBuildFolder(os.path.join(self.folder, 'scratch'), requiredBytes=1, reserveBytes=0, interval=0.1)
+        os.makedirs(self.scratch.folder)
+        self.buildPath = os.path.join(self.folder, 'gcc', 'build')
+        os.makedirs(self.buildPath)
+
+    def test_enterSpillAndRelease(self):
+        self.assertTrue(self.scratch.enter(self.buildPath, 'gcc-test'))
+        self.assertTrue(self.scratch.isActive(self.buildPath))
+        self.writeFile('gcc/build/Makefile', 'all:\n')
+        scratchPath = self.scratch.getScratchPath('gcc-test')
+        self.assertTrue(os.path.isfile(os.path.join(scratchPath, 'Makefile')))
+
+        self.scratch.spill(self.buildPath)
+        self.assertFalse(os.path.islink(self.buildPath))
+        self.assertTrue(os.path.isfile(os.path.join(self.buildPath, 'Makefile')))
+        # paths recorded in the scratch location still lead to the build
+        self.assertEqual(os.path.realpath(scratchPath), self.buildPath)
+
+        self.scratch.release(self.buildPath, 'gcc-test')
+        self.assertFalse(os.path.lexists(scratchPath))
+        self.assertTrue(os.path.isdir(self.buildPath))
+
+    def test_notEnoughRoom(self):
+        self.scratch.requiredBytes = 1024 ** 5
+        self.assertFalse(self.scratch.enter(self.buildPath, 'gcc-test'))
+        self.assertFalse(os.path.islink(self.buildPath))
+
+    def test_existingBuildStaysOnDisk(self):
+        self.writeFile('gcc/build/Makefile', 'all:\n')
+        self.assertFalse(self.scratch.enter(self.buildPath, 'gcc-test'))
+
+    def test_spillStopsOnlyTheTrackedBuild(self):
+        self.assertTrue(self.scratch.enter(self.buildPath, 'gcc-test'))
+        # something ginst didn't start, working in the same tree
+        bystander = subprocess.Popen(['sleep', '30'], cwd=self.buildPath)
+        self.addCleanup(bystander.wait)
+        self.addCleanup(bystander.kill)
+        self.scratch.reserveBytes = 1024 ** 5
+        start = time.time()
+        with self.scratch.monitor():
+            call = ginst.SystemCall('sleep 30', cwd=self.buildPath, onStart=self.scratch.track)
+        self.assertLess(time.time() - start, 5)
+        self.assertTrue(self.scratch.spillRequested.is_set())
+        self.assertTrue(call.failed())
+        self.assertIsNone(bystander.poll())
+
+class ArtifactStoreTests(GInstTestCase):
+    def setUp(self):
+        GInstTestCase.setUp(self)
+        self.store = ginst.ArtifactStore(os.path.join(self.folder, 'artifacts'))
+        self.gccVersion = ginst.GccVersion(self.VERSION)
+        self.prefix = os.path.join(self.folder, 'install', 'gcc-%s' % self.VERSION)
+        self.writeFile('install/gcc-%s/bin/gcc-%s' % (self.VERSION, self.VERSION), '#!/bin/sh\necho gcc\n', executable=True)
+        self.writeFile('install/gcc-%s/lib/libgcc_s.la' % self.VERSION, "libdir='%s/lib'\n" % self.prefix)
+        os.symlink('gcc-%s' % self.VERSION, os.path.join(self.prefix, 'bin', 'gcc'))
+
+    def checkUnpacked(self, manifest):
+        target = os.path.join(self.folder, 'elsewhere')
+        self.store.unpack(manifest, target)
+        self.assertTrue(os.access(os.path.join(target, 'bin', 'gcc-%s' % self.VERSION), os.X_OK))
+        self.assertEqual(os.readlink(os.path.join(target, 'bin', 'gcc')), 'gcc-%s' % self.VERSION)
+        with open(os.path.join(target, 'lib', 'libgcc_s.la'), 'r') as f:
+            self.assertEqual(f.read(), "libdir='%s/lib'\n" % target)
+
+    def test_packageAndUnpack(self):
+        manifest = self.store.package(self.gccVersion, self.prefix)
+        self.assertEqual(self.store.find(self.gccVersion), manifest)
+        self.assertEqual(manifest['key'], ginst.ArtifactStore.getKey(ginst.ArtifactStore.getBuildDescription(self.gccVersion)))
+        self.checkUnpacked(manifest)
+        self.assertIsNone(self.store.find(ginst.GccVersion(self.VERSION, profile='fast')))
+
+    def test_unpackWithoutTheDecompressorTool(self):
+        # tarfile reads xz on its own, including the ./ entry tar -C <prefix> . writes
+        self.patch(ginst, 'ARTIFACT_COMPRESSORS', [('xz', '.tar.xz', 'xz -T0 -6')])
+        manifest = self.store.package(self.gccVersion, self.prefix)
+        with mock.patch.object(ginst.ParallelExtractor, 'getParallelDecompressor', return_value=None):
+            self.checkUnpacked(manifest)
+
+    def test_zstdArtifactsNeedZstd(self):
+        self.patch(ginst, 'ARTIFACT_COMPRESSORS', [('zstd', '.tar.zst', 'zstd -T0 -12')])
+        with mock.patch.object(ginst.HostProfile, 'which', return_value='/usr/bin/zstd'):
+            manifest = self.store.package(self.gccVersion, self.prefix)
+        with mock.patch.object(ginst.HostProfile, 'which', return_value=None):
+            self.assertIsNone(self.store.find(self.gccVersion))
+        with mock.patch.object(ginst.HostProfile, 'which', return_value='/usr/bin/zstd'):
+            self.assertEqual(self.store.find(self.gccVersion), manifest)
+
+    def test_corruptArchiveIsRejected(self):
+        manifest = self.store.package(self.gccVersion, self.prefix)
+        with open(os.path.join(self.store.folder, manifest['archive']), 'ab') as f:
+            f.write(b'\0')
+        with self.assertRaisesRegex(EnvironmentError, 'Checksum mismatch'):
+            self.store.unpack(manifest, os.path.join(self.folder, 'elsewhere'))
+
+    def test_installFromArtifact(self):
+        self.store.package(self.gccVersion, self.prefix)
+        build = self.makeGInst(artifactStore=self.store, useArtifacts=True)
+        self.patch(ginst.GccVersion, 'getInstallPrefix', lambda gccVersion: os.path.join(self.folder, 'elsewhere'))
+        with mock.patch.object(build, '_runStages', side_effect=AssertionError('built from source')):
+            build.install()
+        self.assertTrue(os.path.isfile(os.path.join(self.folder, 'elsewhere', 'bin', 'gcc-%s' % self.VERSION)))
+
+class ArtifactServerTests(GInstTestCase):
+    def setUp(self):
+        GInstTestCase.setUp(self)
+        self.gccVersion = ginst.GccVersion(self.VERSION)
+        self.served = ginst.ArtifactStore(os.path.join(self.folder, 'served'))
+        prefix = os.path.join(self.folder, 'install')
+        self.writeFile('install/bin/gcc-%s' % self.VERSION, '#!/bin/sh\n' + 'x' * 300000, executable=True)
+        self.manifest = self.served.package(self.gccVersion, prefix)
+        self.server = ginst.ArtifactServer(self.served, '127.0.0.1', 0)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+    def makeClient(self, servers=None):
+        return ginst.ArtifactStore(os.path.join(self.folder, 'client'), servers or [self.server.getUrl()])
+
+    def writeManifest(self, store, manifest):
+        with open(store.getManifestPath(self.manifest['key']), 'w') as f:
+            json.dump(manifest, f)
+
+    def test_fetchAndUnpack(self):
+        client = self.makeClient()
+        manifest = client.find(self.gccVersion)
+        self.assertEqual(manifest, self.manifest)
+        with open(os.path.join(client.folder, manifest['archive']), 'rb') as f:
+            self.assertEqual(hashlib.sha256(f.read()).hexdigest(), manifest['sha256'])
+        client.unpack(manifest, os.path.join(self.folder, 'unpacked'))
+        self.assertTrue(os.path.isfile(os.path.join(self.folder, 'unpacked', 'bin', 'gcc-%s' % self.VERSION)))
+        # now local, so no server is needed
+        self.server.stop()
+        self.assertEqual(self.makeClient(['http://127.0.0.1:1']).find(self.gccVersion), manifest)
+
+    def test_serversAreMirrorsOfEachOther(self):
+        other = ginst.ArtifactServer(ginst.ArtifactStore(os.path.join(self.folder, 'empty')), '127.0.0.1', 0)
+        other.start()
+        self.addCleanup(other.stop)
+        self.assertEqual(self.makeClient(['http://127.0.0.1:1', other.getUrl(), self.server.getUrl()]).find(self.gccVersion), self.manifest)
+
+    def test_rangesAndNames(self):
+        url = '%s/artifacts/%s' % (self.server.getUrl(), self.manifest['archive'])
+        request = urllib_request('GET', url, {'Range': 'bytes=10-19'})
+        with open(os.path.join(self.served.folder, self.manifest['archive']), 'rb') as f:
+            f.seek(10)
+            self.assertEqual(request, (206, f.read(10)))
+        for name in ('..%2Fserved%2F' + self.manifest['archive'], '.hidden', '../%s' % self.manifest['archive']):
+            self.assertEqual(urllib_request('GET', '%s/artifacts/%s' % (self.server.getUrl(), name))[0], 404)
+
+    def test_invalidManifestsAreIgnored(self):
+        for changes in ({'archive': '../../evil.tar.xz'}, {'archive': '.hidden'}, {'key': 'f' * 64}, {'version': '1.0.0'}):
+            self.writeManifest(self.served, dict(self.manifest, **changes))
+            client = self.makeClient()
+            self.assertIsNone(client.find(self.gccVersion), changes)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.folder, 'client'))), [])
+        with self.assertRaises(EnvironmentError):
+            client.unpack(dict(self.manifest, archive='../served/%s' % self.manifest['archive']), os.path.join(self.folder, 'unpacked'))
+
+    def test_streamingAnArtifact(self):
+        url = '%s/artifacts/%s' % (self.server.getUrl(), self.manifest['archive'])
+        ginst.StreamingExtractor(url, os.path.join(self.folder, 'streamed'), checksum=self.manifest['sha256']).run()
+        self.assertTrue(os.path.isfile(os.path.join(self.folder, 'streamed', 'bin', 'gcc-%s' % self.VERSION)))
+
+    def test_inProcessExtractionOfAFetchedArtifact(self):
+        client = self.makeClient()
+        manifest = client.find(self.gccVersion)
+        ginst.ParallelExtractor(os.path.join(self.folder, 'extracted')).extract(os.path.join(client.folder, manifest['archive'])) \
+            if not manifest['archive'].endswith('.zst') else client.unpack(manifest, os.path.join(self.folder, 'extracted'))
+        self.assertTrue(os.path.isfile(os.path.join(self.folder, 'extracted', 'bin', 'gcc-%s' % self.VERSION)))
+
+def urllib_request(method, url, headers=None):
+    import urllib.error
+    import urllib.request
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers or {}, method=method), timeout=10) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as ex:
+        return ex.code, b''
+
+class HostProfileTests(TempFolderTestCase):
+    def setUp(self):
+        TempFolderTestCase.setUp(self)
+        self.binFolder = os.path.join(self.folder, 'bin')
+        os.makedirs(self.binFolder)
+        patcher = mock.patch.dict(os.environ, {'PATH': '%s%s%s' % (self.binFolder, os.pathsep, os.environ['PATH'])})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cachePath = os.path.join(self.folder, 'host.json')
+
+    def test_probes(self):
+        self.writeFile('bin/pigz', '#!/bin/sh\n', executable=True)
+        self.writeFile('bin/zstd', 'not executable')
+        profile = ginst.HostProfile(self.cachePath)
+        self.assertEqual(profile.which('pigz'), os.path.join(self.binFolder, 'pigz'))
+        self.assertNotEqual(profile.which('zstd'), os.path.join(self.binFolder, 'zstd'))
+        self.assertEqual(profile.which('sh'), shutil.which('sh'))
+        self.assertIsNone(profile.which('no-such-tool'))
+        self.assertEqual(profile.isRoot(), os.geteuid() == 0)
+        self.assertGreaterEqual(profile.getCpuCount(), 1)
+        self.assertGreater(profile.facts['memTotal'], 0)
+
+    def test_cacheKeepsOnlyStableFacts(self):
+        ginst.HostProfile(self.cachePath)
+        with open(self.cachePath, 'r') as f:
+            cached = json.load(f)
+        for fact in ginst.HostProfile.VOLATILE:
+            self.assertNotIn(fact, cached['facts'])
+        # a cache claiming other cores (say, written under another taskset) is not believed
+        cached['facts']['cores'] = 64
+        cached['facts']['glibc'] = 'glibc 0.0'
+        with open(self.cachePath, 'w') as f:
+            json.dump(cached, f)
+        profile = ginst.HostProfile(self.cachePath)
+        self.assertEqual(profile.facts['glibc'], 'glibc 0.0')
+        self.assertEqual(profile.facts['cores'], len(os.sched_getaffinity(0)))
+
+    def test_installingAToolInvalidatesTheCache(self):
+        self.assertIsNone(ginst.HostProfile(self.cachePath).facts['tools']['pixz'])
+        time.sleep(1.1)
+        self.writeFile('bin/pixz', '#!/bin/sh\n', executable=True)
+        self.assertEqual(ginst.HostProfile(self.cachePath).facts['tools']['pixz'], os.path.join(self.binFolder, 'pixz'))
+
+    def test_cpuQuotaCapsTheCores(self):
+        profile = ginst.HostProfile(self.cachePath)
+        profile.facts.update(cores=8, cpuQuota=2.5)
+        self.assertEqual(profile.getCpuCount(), 3)
+        profile.facts.update(cpuQuota=None)
+        self.assertEqual(profile.getCpuCount(), 8)
+
+class PackageResolverTests(TempFolderTestCase):
+    STATUS = '''Package: make
+Status: install ok installed
+Architecture: amd64
+Version: 4.3-4.1
+
+Package: gcc-multilib
+Status: deinstall ok config-files
+Architecture: amd64
+
+Package: libc6-dev
+Status: install ok installed
+Architecture: amd64
+Provides: libc-dev (= 2.36), libc6-dev-amd64
+Description: GNU C Library: Development Libraries
+ Status: install ok installed
+ Package: not-a-package
+
+Package: half-installed
+Status: install reinstreq half-installed
+'''
+
+    def setUp(self):
+        TempFolderTestCase.setUp(self)
+        self.resolver = ginst.PackageResolver(self.writeFile('status', self.STATUS), os.path.join(self.folder, 'lists'), maxListAge=60)
+
+    def test_installed(self):
+        installed = self.resolver.getInstalled()
+        self.assertTrue({'make', 'make:amd64', 'libc6-dev', 'libc-dev', 'libc6-dev-amd64'} <= installed)
+        self.assertNotIn('gcc-multilib', installed)
+        self.assertNotIn('half-installed', installed)
+        self.assertNotIn('not-a-package', installed)
+
+    def test_missing(self):
+        self.assertEqual(self.resolver.getMissing(['make', 'gcc-multilib', 'libc-dev', 'flex']), ['gcc-multilib', 'flex'])
+
+    def test_listsAreFresh(self):
+        self.assertFalse(self.resolver.listsAreFresh())
+        listPath = self.writeFile('lists/deb.debian.org_dists_stable_main_binary-amd64_Packages', '')
+        self.writeFile('lists/lock', '')
+        self.assertTrue(self.resolver.listsAreFresh())
+        old = time.time() - 120
+        os.utime(listPath, (old, old))
+        self.assertFalse(self.resolver.listsAreFresh())
+
+class PrerequisiteFetcherTests(TempFolderTestCase):
+    SCRIPT = '''#! /bin/sh
+gmp='gmp-6.1.0.tar.bz2'
+mpfr='mpfr-3.1.4.tar.bz2'
+mpc='mpc-1.0.3.tar.gz'
+isl='isl-0.18.tar.bz2'
+
+base_url='%s'
+
+echo_archives() {
+    echo "${gmp}"
+}
+'''
+    ARCHIVES = {'gmp': 'gmp-6.1.0.tar.bz2', 'mpfr': 'mpfr-3.1.4.tar.bz2', 'mpc': 'mpc-1.0.3.tar.gz', 'isl': 'isl-0.18.tar.bz2'}
+
+    def setUp(self):
+        TempFolderTestCase.setUp(self)
+        self.cache = ginst.SourceCache(os.path.join(self.folder, 'cache'))
+        self.checksums = {}
+        for archive in self.ARCHIVES.values():
+            name = re.sub(r'\.tar\.(gz|bz2)$', '', archive)
+            data = self.makeTarball({name: None, '%s/configure' % name: '#!/bin/sh\n', '%s/README' % name: name},
+                                    'w:gz' if archive.endswith('.gz') else 'w:bz2')
+            self.writeFile('infrastructure/%s' % archive, data, 'wb')
+            self.checksums[archive] = hashlib.sha512(data).hexdigest()
+
+    def makeFetcher(self, sourceName='gcc', baseUrl='ftp://gcc.gnu.org/pub/gcc/infrastructure/', checksums=None, script=SCRIPT):
+        self.writeFile('%s/contrib/download_prerequisites' % sourceName, script % baseUrl)
+        if checksums is not None:
+            self.writeFile('%s/contrib/prerequisites.sha512' % sourceName, ''.join('%s  %s\n' % (c, a) for a, c in checksums.items()))
+        return ginst.PrerequisiteFetcher(os.path.join(self.folder, sourceName), self.cache, folder=os.path.join(self.folder, 'shared'))
+
+    def test_parsesPinnedArchives(self):
+        baseUrl, archives = self.makeFetcher().getPrerequisites()
+        self.assertEqual(baseUrl, 'https://gcc.gnu.org/pub/gcc/infrastructure/')
+        self.assertEqual(archives, self.ARCHIVES)
+
+    def test_parsesChecksums(self):
+        fetcher = self.makeFetcher(checksums={'gmp-6.1.0.tar.bz2': 'a' * 128, 'isl-0.18.tar.bz2': 'b' * 128})
+        with open(os.path.join(fetcher.sourcePath, 'contrib', 'prerequisites.sha512'), 'a') as f:
+            f.write('\nmalformed line here\n')
+        self.assertEqual(fetcher.getChecksums(), {'gmp-6.1.0.tar.bz2': 'a' * 128, 'isl-0.18.tar.bz2': 'b' * 128})
+        self.assertEqual(ginst.PrerequisiteFetcher(os.path.join(self.folder, 'missing'), None).getChecksums(), {})
+
+    def test_unknownFormat(self):
+        with self.assertRaises(EnvironmentError):
+            self.makeFetcher(script=self.SCRIPT.replace("isl='isl-0.18.tar.bz2'\n", '')).getPrerequisites()
+        with self.assertRaises(EnvironmentError):
+            ginst.PrerequisiteFetcher(os.path.join(self.folder, 'missing'), None).getPrerequisites()
+
+    def test_fetchAndLink(self):
+        server = self.startServer(os.path.join(self.folder, 'infrastructure'))
+        unpacked = self.makeFetcher(baseUrl=server.getUrl(), checksums=self.checksums).fetch()
+        self.assertEqual(sorted(unpacked), ['gmp', 'isl', 'mpc', 'mpfr'])
+        for package, archive in self.ARCHIVES.items():
+            linkPath = os.path.join(self.folder, 'gcc', package)
+            self.assertEqual(os.path.realpath(linkPath), unpacked[package])
+            self.assertTrue(os.path.isfile(os.path.join(linkPath, 'configure')))
+        # a HEAD and a GET per archive, each archive over a connection of its own at most
+        self.assertEqual(server.stats['requests'], 8)
+        self.assertLessEqual(server.stats['connections'], 4)
+
+        # another gcc release pinning the same versions downloads and unpacks nothing
+        other = self.makeFetcher(sourceName='gcc-other', baseUrl=server.getUrl(), checksums=self.checksums)
+        self.assertEqual(other.fetch(), unpacked)
+        self.assertEqual(server.stats['requests'], 8)
+        self.assertTrue(os.path.islink(os.path.join(self.folder, 'gcc-other', 'mpc')))
+
+    def test_checksumMismatch(self):
+        server = self.startServer(os.path.join(self.folder, 'infrastructure'))
+        fetcher = self.makeFetcher(baseUrl=server.getUrl(), checksums=dict(self.checksums, **{'mpc-1.0.3.tar.gz': 'f' * 128}))
+        with self.assertRaisesRegex(EnvironmentError, 'Checksum mismatch'):
+            fetcher.fetch()
+        self.assertIsNone(self.cache.get('mpc-1.0.3.tar.gz'))
+        self.assertFalse(os.path.exists(os.path.join(self.folder, 'shared', 'mpc-1.0.3')))
+
+class HttpConnectionPoolTests(TempFolderTestCase):
+    def test_reuseAndErrors(self):
+        self.writeFile('mirror/a.txt', 'a' * 1000)
+        server = self.startServer(os.path.join(self.folder, 'mirror'))
+        pool = ginst.HttpConnectionPool()
+        self.addCleanup(pool.close)
+        for _ in range(3):
+            with pool.request('GET', server.getUrl('a.txt')) as response:
+                self.assertEqual(response.read(), b'a' * 1000)
+        self.assertEqual((pool.stats['requests'], pool.stats['connections'], server.stats['connections']), (3, 1, 1))
+        with self.assertRaisesRegex(EnvironmentError, 'HTTP 404'):
+            with pool.request('GET', server.getUrl('missing.txt')):
+                pass
+        with self.assertRaises(EnvironmentError):
+            with pool.request('GET', 'ftp://127.0.0.1/a.txt'):
+                pass
+
+class PrerequisiteBuilderTests(GInstTestCase):
+    ARCHIVES = {'gmp': 'gmp-6.1.0.tar.bz2', 'mpfr': 'mpfr-3.1.4.tar.bz2', 'mpc': 'mpc-1.0.3.tar.gz', 'isl': 'isl-0.18.tar.bz2'}
+    # records its arguments and installs a static library named after its package
+    CONFIGURE = ('#!/bin/sh\n'
+                 'for arg; do case "$arg" in --prefix=*) prefix=${arg#--prefix=};; esac; done\n'
+                 'echo "$@" > "$(dirname "$0")/configured-with"\n'
+                 'printf "all:\\n\\t@echo making %(package)s\\ninstall:\\n\\tmkdir -p %%s/lib && touch %%s/lib/lib%(package)s.a\\n" "$prefix" "$prefix" > Makefile\n')
+
+    def setUp(self):
+        GInstTestCase.setUp(self)
+        self.unpacked = {}
+        for package in self.ARCHIVES:
+            self.unpacked[package] = os.path.dirname(self.writeFile('sources/%s/configure' % package, self.CONFIGURE % {'package': package},
+                                                                    executable=True))
+        self.cache = ginst.SourceCache(os.path.join(self.folder, 'cache'))
+        self.commands = []
+
+    def runCommand(self, command, step, failureMessage, cwd=None):
+        self.commands.append(step)
+        call = ginst.SystemCall(command, cwd=cwd)
+        if call.failed():
+            raise EnvironmentError(call.describeFailure(failureMessage))
+        return call
+
+    def test_buildOnceAndReuse(self):
+        builder = ginst.PrerequisiteBuilder(self.cache, folder=os.path.join(self.folder, 'prefixes'), runCommand=self.runCommand, jobsFlag=' -j2')
+        prefixes = builder.build(self.unpacked, self.ARCHIVES)
+        self.assertEqual(self.commands, ['prerequisite-gmp', 'prerequisite-mpfr', 'prerequisite-isl', 'prerequisite-mpc'])
+        for package, prefix in prefixes.items():
+            self.assertTrue(builder.isBuilt(prefix))
+            self.assertTrue(os.path.isfile(os.path.join(prefix, 'lib', 'lib%s.a' % package)))
+        self.assertEqual(os.path.basename(prefixes['mpc']), 'mpc-1.0.3+gmp-6.1.0+mpfr-3.1.4')
+        with open(os.path.join(self.unpacked['mpc'], 'configured-with'), 'r') as f:
+            arguments = f.read()
+        self.assertIn('--with-gmp=%s --with-mpfr=%s' % (prefixes['gmp'], prefixes['mpfr']), arguments)
+        self.assertIn('--disable-shared --enable-static', arguments)
+        # the build folders are gone, only the prefixes remain
+        self.assertEqual(sorted(os.listdir(os.path.join(self.folder, 'prefixes'))), sorted(os.path.basename(p) for p in prefixes.values()))
+
+        self.commands = []
+        self.assertEqual(builder.build(self.unpacked, self.ARCHIVES), prefixes)
+        self.assertEqual(self.commands, [])
+
+    def test_failedBuildIsNotMarkedBuilt(self):
+        with open(os.path.join(self.unpacked['isl'], 'configure'), 'w') as f:
+            f.write('#!/bin/sh\nexit 1\n')
+        builder = ginst.PrerequisiteBuilder(self.cache, folder=os.path.join(self.folder, 'prefixes'), runCommand=self.runCommand)
+        with self.assertRaisesRegex(EnvironmentError, 'Unable to build isl-0.18'):
+            builder.build(self.unpacked, self.ARCHIVES)
+        prefixes = builder.getPrefixes(self.ARCHIVES)
+        self.assertTrue(builder.isBuilt(prefixes['mpfr']))
+        self.assertFalse(builder.isBuilt(prefixes['isl']))
+
+    def test_buildsJoinTheSharedJobserver(self):
+        jobServer = ginst.JobServer(2)
+        self.addCleanup(jobServer.close)
+        build = self.makeGInst(jobServer=jobServer)
+        build.prerequisiteBuilder.folder = os.path.join(self.folder, 'prefixes')
+        build.resourceSummary = ginst.ResourceSummary(build.gccVersion.getBuildName())
+        with open(os.path.join(self.unpacked['gmp'], 'configure'), 'a') as f:
+            f.write('echo "MAKEFLAGS=$MAKEFLAGS" > %s\n' % os.path.join(self.folder, 'makeflags'))
+        build.prerequisiteBuilder.build(self.unpacked, self.ARCHIVES)
+        with open(os.path.join(self.folder, 'makeflags'), 'r') as f:
+            self.assertIn('--jobserver-auth=%d,%d' % jobServer.fds, f.read())
+        self.assertEqual(sorted(build.resourceSummary.steps), ['prerequisite-gmp', 'prerequisite-isl', 'prerequisite-mpc', 'prerequisite-mpfr'])
+
+class AsyncSystemCallTests(TempFolderTestCase):
+    def run_async(self, coroutine):
+        return asyncio.run(coroutine)
+
+    def test_outputAndResources(self):
+        seen = []
+        call = ginst.AsyncSystemCall("printf 'one\\ntwo\\n'; %s -c 'bytearray(48 * 1024 * 1024)'; exit 4" % sys.executable,
+                                     lineCallback=seen.append)
+        self.run_async(call.run())
+        self.assertEqual((call.retCode, call.output, seen), (4, 'one\ntwo', ['one', 'two']))
+        self.assertGreaterEqual(call.resources['maxRss'], 48 * 1024 * 1024)
+        self.assertGreater(call.resources['wallTime'], 0)
+
+    def checkLongCallsDontDelayShortOnes(self):
+        async def main():
+            longCalls = [asyncio.ensure_future(ginst.AsyncSystemCall('sleep 2').run()) for _ in range(40)]
+            await asyncio.sleep(0.2)
+            start = time.time()
+            await ginst.AsyncSystemCall('true').run()
+            elapsed = time.time() - start
+            await asyncio.gather(*longCalls)
+            return elapsed
+        self.assertLess(self.run_async(main()), 1)
+
+    def test_longCallsDontDelayShortOnes(self):
+        self.checkLongCallsDontDelayShortOnes()
+
+    def test_withoutPidfds(self):
+        with mock.patch.object(os, 'pidfd_open', side_effect=OSError('unsupported'), create=True):
+            self.checkLongCallsDontDelayShortOnes()
+
+    def test_cancelStopsTheWholeProcessGroup(self):
+        pidPath = os.path.join(self.folder, 'child.pid')
+
+        async def main():
+            call = ginst.AsyncSystemCall('sleep 30 & echo $! > %s; wait' % pidPath)
+            task = asyncio.ensure_future(call.run())
+            while not os.path.exists(pidPath) or not open(pidPath).read().strip():
+                await asyncio.sleep(0.05)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            return call
+
+        start = time.time()
+        call = self.run_async(main())
+        self.assertLess(time.time() - start, 5)
+        self.assertTrue(call.cancelled)
+        self.assertEqual(call.retCode, -signal.SIGTERM)
+        with open(pidPath, 'r') as f:
+            childPid = int(f.read())
+        deadline = time.time() + 5
+        while isRunning(childPid) and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertFalse(isRunning(childPid))
+
+def isRunning(pid):
+    try:
+        with open('/proc/%d/stat' % pid, 'r') as f:
+            return f.read().split(') ')[1][0] != 'Z'
+    except IOError:
+        return False
+
+class AsyncGInstTests(GInstTestCase):
+    class Build(ginst.AsyncGInst):
+        command = 'sleep 30'
+
+        def _getStages(self, fetchSource):
+            return [('first', lambda: self._checkedSystemCall('echo first', 'first', "first failed"), lambda: '', lambda: True),
+                    ('slow', lambda: self._checkedSystemCall(self.command, 'slow', "slow failed"), lambda: '', lambda: True),
+                    ('never', lambda: self._checkedSystemCall('echo never', 'never', "never failed"), lambda: '', lambda: True)]
+
+    def test_cancel(self):
+        async def main():
+            build = self.makeGInst(cls=self.Build, outputEvents=True)
+            task = asyncio.ensure_future(build.install())
+            events = []
+            while True:
+                event = await build.events.get()
+                events.append(event)
+                if event['event'] == 'command-started' and event['step'] == 'slow':
+                    break
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            while not build.events.empty():
+                events.append(build.events.get_nowait())
+            return build, events
+
+        start = time.time()
+        build, events = asyncio.run(main())
+        self.assertLess(time.time() - start, 10)
+        names = [(e['event'], e.get('step') or e.get('stage')) for e in events]
+        self.assertIn(('output', 'first'), names)
+        self.assertIn(('command-finished', 'slow'), names)
+        self.assertEqual(names[-1], ('cancelled', None))
+        self.assertNotIn(('command-started', 'never'), names)
+        # the state, logs and timeline were still written
+        self.assertTrue(os.path.isfile(os.path.join(build.getLogFolder(), 'trace.json')))
+
+    def test_outputEventsAreBounded(self):
+        async def main():
+            build = self.makeGInst(cls=self.Build, outputEvents=True)
+            build.command = 'seq 1 3000'
+            await build.install()
+            return build
+
+        self.patch(ginst, 'ASYNC_OUTPUT_EVENT_BACKLOG', 100)
+        build = asyncio.run(main())
+        events = []
+        while not build.events.empty():
+            events.append(build.events.get_nowait())
+        self.assertGreater(build.droppedOutputEvents, 2800)
+        self.assertEqual(events[-1]['event'], 'done')
+        self.assertIn(('command-finished', 'never'), [(e['event'], e.get('step')) for e in events])
+
+if __name__ == '__main__':
+    unittest.main()